@@ -0,0 +1,74 @@
+'''
+Times filtering synthetic telescope states by nightly site intervals over growing spans of days, up to a year, to
+show the time taken per state stays flat as the span grows. Nothing is read from a database or elasticsearch.
+
+Run from the repository root with:
+    python benchmarks/interval_sweep.py --sites 8
+'''
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valhalla.settings')
+
+import django  # noqa
+django.setup()
+
+from django.utils import timezone  # noqa
+
+from valhalla.common.configdb import TelescopeKey  # noqa
+from valhalla.common.telescope_states import filter_telescope_states_by_intervals  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', type=int, default=8, help='Number of sites')
+    parser.add_argument('--telescopes', type=int, default=3, help='Number of telescopes per site')
+    parser.add_argument('--minutes-per-state', type=float, default=20.0, help='Mean length of a state')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    end = timezone.now().replace(minute=0, second=0, microsecond=0)
+    mean_state = timedelta(minutes=options.minutes_per_state)
+
+    for days in (30, 91, 182, 365):
+        start = end - timedelta(days=days)
+        telescope_states = {}
+        sites_intervals = {}
+        for site_number in range(options.sites):
+            site = 'st{}'.format(site_number)
+            offset = timedelta(hours=24 * site_number / options.sites)
+            sites_intervals[site] = [
+                (start + timedelta(days=day) + offset,
+                 start + timedelta(days=day) + offset + timedelta(hours=random.uniform(8, 12)))
+                for day in range(days)
+            ]
+            for telescope_number in range(options.telescopes):
+                telescope_key = TelescopeKey(site, 'doma', '1m0{}'.format(chr(ord('a') + telescope_number)))
+                states = []
+                state_start = start
+                while state_start < end:
+                    state_end = min(end, state_start + mean_state * random.uniform(0.1, 1.9))
+                    states.append({'telescope': str(telescope_key), 'event_type': 'AVAILABLE',
+                                   'event_reason': 'Available for scheduling', 'start': state_start,
+                                   'end': state_end})
+                    state_start = state_end
+                telescope_states[telescope_key] = states
+
+        state_count = sum(len(states) for states in telescope_states.values())
+        start_time = time.time()
+        filtered_states = filter_telescope_states_by_intervals(telescope_states, sites_intervals, start, end)
+        elapsed = time.time() - start_time
+        print('{:>3} days: {} states, {} clipped, {:.3f}s, {:.2f}us per state'.format(
+            days, state_count, sum(len(states) for states in filtered_states.values()), elapsed,
+            elapsed / state_count * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
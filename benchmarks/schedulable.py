@@ -0,0 +1,132 @@
+'''
+Times the schedulable_requests serialization with model instances and as_dict against the compact .values() path,
+and reports their peak python memory. Generated requests are rolled back afterwards.
+
+Run from the repository root with the settings of the database to use:
+    python benchmarks/schedulable.py --requests 50000
+'''
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valhalla.settings')
+
+import django  # noqa
+django.setup()
+
+from django.contrib.auth.models import User  # noqa
+from django.db import transaction  # noqa
+from django.utils import timezone  # noqa
+from rest_framework.utils.encoders import JSONEncoder  # noqa
+
+from valhalla.proposals.models import Proposal, Semester, TimeAllocation, TimeAllocationGroup  # noqa
+from valhalla.userrequests.models import UserRequest, Request, Target, Molecule, Window, Location, Constraints  # noqa
+from valhalla.userrequests.schedulable import iter_schedulable_userrequests, stream_json_list  # noqa
+from valhalla.userrequests.state_changes import TERMINAL_STATES  # noqa
+
+
+class Rollback(Exception):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50000, help='Number of requests to generate, 0 to use the '
+                                                                    'requests already in the database')
+    parser.add_argument('--requests-per-ur', type=int, default=5, help='Number of requests per generated ur')
+    options = parser.parse_args()
+
+    try:
+        with transaction.atomic():
+            if options.requests:
+                start, end = create_requests(options.requests, options.requests_per_ur)
+            else:
+                semester = Semester.current_semesters().first()
+                start, end = semester.start, semester.end
+            queryset = UserRequest.objects.exclude(state__in=TERMINAL_STATES).filter(
+                window_start__lte=end, window_end__gte=start,
+                requests__windows__start__lte=end, requests__windows__start__gte=start,
+                proposal__active=True).distinct()
+
+            as_dict_time, as_dict_memory, as_dict_size = measure(as_dict_response, queryset)
+            compact_time, compact_memory, compact_size = measure(compact_response, queryset)
+            if as_dict_size != compact_size:
+                sys.stderr.write('The two responses differ in size: {} and {} bytes\n'.format(as_dict_size,
+                                                                                           compact_size))
+            print('as_dict: {:.2f}s, {:.1f}MB peak'.format(as_dict_time, as_dict_memory / 2 ** 20))
+            print('compact: {:.2f}s, {:.1f}MB peak'.format(compact_time, compact_memory / 2 ** 20))
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+def measure(response_function, queryset):
+    # timed and traced in separate runs, as tracing the allocations slows the run down several times
+    start_time = time.time()
+    size = sum(len(chunk) for chunk in response_function(queryset))
+    elapsed = time.time() - start_time
+    tracemalloc.start()
+    sum(len(chunk) for chunk in response_function(queryset))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def as_dict_response(queryset):
+    ''' The serialization schedulable_requests used before the compact path, less its time allocation checks '''
+    queryset = queryset.prefetch_related(
+        'requests', 'requests__windows', 'requests__target', 'proposal', 'proposal__timeallocation_set',
+        'requests__molecules', 'submitter', 'requests__location', 'requests__constraints'
+    )
+    ur_data = []
+    for ur in queryset.all():
+        ur.total_duration
+        ur_data.append(ur.as_dict)
+    return [json.dumps(ur_data, cls=JSONEncoder)]
+
+
+def compact_response(queryset):
+    return stream_json_list(iter_schedulable_userrequests(queryset))
+
+
+def create_requests(request_count, requests_per_ur):
+    now = timezone.now()
+    semester = Semester.objects.create(id='BENCH', start=now - timedelta(days=1), end=now + timedelta(days=180))
+    tag = TimeAllocationGroup.objects.create(id='BENCH')
+    proposal = Proposal.objects.create(id='BENCHMARK', active=True, tag=tag)
+    user = User.objects.create(username='benchmark_schedulable')
+    TimeAllocation.objects.create(proposal=proposal, semester=semester, telescope_class='1m0',
+                                  instrument_name='1M0-SCICAM-SBIG', std_allocation=1e9, too_allocation=1e9)
+    window_start, window_end = now + timedelta(days=1), now + timedelta(days=8)
+    user_requests = UserRequest.objects.bulk_create([
+        UserRequest(submitter=user, proposal=proposal, group_id='benchmark', observation_type='NORMAL',
+                    operator='MANY', ipp_value=1.0, window_start=window_start, window_end=window_end)
+        for _ in range(request_count // requests_per_ur)
+    ])
+    if not user_requests[0].id:
+        user_requests = list(UserRequest.objects.filter(proposal=proposal).order_by('id'))
+    requests = Request.objects.bulk_create([
+        Request(user_request=ur, window_start=window_start, window_end=window_end, duration_seconds=1200,
+                semester_code=semester.id, instrument_name='1M0-SCICAM-SBIG', telescope_class='1m0')
+        for ur in user_requests for _ in range(requests_per_ur)
+    ])
+    if not requests[0].id:
+        requests = list(Request.objects.filter(user_request__proposal=proposal).order_by('id'))
+    Target.objects.bulk_create([Target(request=r, name='bench', type='SIDEREAL', ra=10.0, dec=-20.0)
+                                for r in requests])
+    Molecule.objects.bulk_create([Molecule(request=r, type='EXPOSE', instrument_name='1M0-SCICAM-SBIG',
+                                           filter='air', exposure_time=100, exposure_count=1, bin_x=2, bin_y=2)
+                                  for r in requests])
+    Window.objects.bulk_create([Window(request=r, start=window_start, end=window_end) for r in requests])
+    Location.objects.bulk_create([Location(request=r, telescope_class='1m0') for r in requests])
+    Constraints.objects.bulk_create([Constraints(request=r) for r in requests])
+    return now, now + timedelta(days=30)
+
+
+if __name__ == '__main__':
+    main()
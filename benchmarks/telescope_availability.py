@@ -0,0 +1,94 @@
+'''
+Times the telescope availability the telescope availability endpoint serves over synthetic telescope events for the
+schedulable telescopes in configdb, and reports its peak python memory. Elasticsearch is not queried. With
+--store-nights the nights are first stored as the update_telescope_availability task would, and rolled back after.
+
+Run from the repository root with the settings of the database to use:
+    python benchmarks/telescope_availability.py --days 30
+'''
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valhalla.settings')
+
+import django  # noqa
+django.setup()
+
+from django.db import transaction  # noqa
+from django.utils import timezone  # noqa
+
+from valhalla.common.configdb import configdb  # noqa
+from valhalla.common.telescope_states import TelescopeStates, ES_STRING_FORMATTER  # noqa
+from valhalla.userrequests.availability import get_telescope_availability_per_day, update_telescope_availability  # noqa
+
+EVENT_TYPES = (
+    ('AVAILABLE', 'Available for scheduling'),
+    ('NOT_OK_TO_OPEN', 'Sky transparency too low'),
+    ('SEQUENCER_UNAVAILABLE', 'Sequencer unavailable for scheduling'),
+    ('SITE_AGENT_UNRESPONSIVE', 'No update since'),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=float, default=30.0, help='Number of days of availability')
+    parser.add_argument('--events-per-hour', type=int, default=60, help='Telescope events per telescope per hour')
+    parser.add_argument('--store-nights', action='store_true', help='Store the nights before timing')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    options = parser.parse_args()
+
+    end = timezone.now().replace(minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=options.days)
+    telescopes = sorted(configdb.get_instrument_types_per_telescope(only_schedulable=True).keys())
+    event_count = int(len(telescopes) * (options.days * 24 + 1) * options.events_per_hour)
+
+    def get_es_data(states, sites, telescope_codes, query_start, query_end):
+        random.seed(options.seed)
+        step = timedelta(hours=1) / options.events_per_hour
+        for telescope in telescopes:
+            if telescope.site not in sites or telescope.telescope not in telescope_codes:
+                continue
+            timestamp = query_start
+            event_type, reason = EVENT_TYPES[0]
+            while timestamp <= query_end:
+                if random.random() < 0.01:
+                    event_type, reason = random.choice(EVENT_TYPES)
+                yield {'_source': {'timestamp': timestamp.strftime(ES_STRING_FORMATTER), 'site': telescope.site,
+                                   'enclosure': telescope.observatory, 'telescope': telescope.telescope,
+                                   'type': event_type, 'reason': reason}}
+                timestamp += step
+
+    try:
+        with transaction.atomic(), patch.object(TelescopeStates, '_get_es_data', get_es_data):
+            if options.store_nights:
+                update_telescope_availability(end=end, days=options.days)
+            start_time = time.time()
+            availability = get_telescope_availability_per_day(start, end)
+            elapsed = time.time() - start_time
+            tracemalloc.start()
+            get_telescope_availability_per_day(start, end)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            raise Rollback()
+    except Rollback:
+        pass
+
+    print('{} events on {} telescopes over {} days, {} telescope nights'.format(
+        event_count, len(telescopes), options.days, sum(len(nights) for nights in availability.values())
+    ))
+    print('availability: {:.2f}s, {:.1f}MB peak'.format(elapsed, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from valhalla.accounts.models import ProposalTimeUsage, calculate_time_used_in_proposal
+from valhalla.proposals.models import Proposal, Semester
+from valhalla.userrequests.models import UserRequest
+
+
+class Command(BaseCommand):
+    help = ('Recalculates the time each user has requested in each proposal from their requests, correcting the '
+            'stored time used where it has drifted. Reconciles the current semesters unless one is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', help='Id of the semester to reconcile')
+
+    def handle(self, *args, **options):
+        if options['semester']:
+            semesters = Semester.objects.filter(pk=options['semester'])
+        else:
+            semesters = Semester.current_semesters()
+
+        for semester in semesters:
+            pairs = set(UserRequest.objects.filter(
+                created__gte=semester.start, created__lte=semester.end
+            ).order_by().values_list('submitter', 'proposal').distinct())
+            pairs.update(ProposalTimeUsage.objects.filter(semester=semester).values_list('user', 'proposal'))
+            users = User.objects.in_bulk({user_id for user_id, _ in pairs})
+            proposals = Proposal.objects.in_bulk({proposal_id for _, proposal_id in pairs})
+
+            corrected = 0
+            for user_id, proposal_id in sorted(pairs):
+                with transaction.atomic():
+                    time_used = calculate_time_used_in_proposal(users[user_id], proposals[proposal_id], semester)
+                    usage, created = ProposalTimeUsage.objects.select_for_update().get_or_create(
+                        user_id=user_id, proposal_id=proposal_id, semester=semester,
+                        defaults={'time_used': time_used}
+                    )
+                    if not created and usage.time_used != time_used:
+                        self.stdout.write('Correcting time used by {} in {} {} from {}s to {}s'.format(
+                            usage.user, usage.proposal, semester, usage.time_used, time_used
+                        ))
+                        usage.time_used = time_used
+                        usage.save()
+                        corrected += 1
+            self.stdout.write('Reconciled {} users in semester {}, corrected {}'.format(len(pairs), semester,
+                                                                                        corrected))
@@ -0,0 +1,31 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proposals', '0012_proposal_non_science'),
+        ('accounts', '0004_auto_20170418_0219'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProposalTimeUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time_used', models.FloatField(default=0)),
+                ('proposal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='proposals.Proposal')),
+                ('semester', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='proposals.Semester')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='proposaltimeusage',
+            unique_together={('user', 'proposal', 'semester')},
+        ),
+    ]
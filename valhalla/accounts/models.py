@@ -1,7 +1,8 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import F
 from django.utils.functional import cached_property
 import uuid
 import logging
@@ -10,7 +11,8 @@ from django.contrib.auth.models import User
 from oauth2_provider.models import AccessToken, Application
 from rest_framework.authtoken.models import Token
 
-from valhalla.proposals.models import Proposal
+from valhalla.proposals.models import Proposal, Semester, Membership
+from valhalla.userrequests.models import Request
 
 logger = logging.getLogger()
 
@@ -29,10 +31,12 @@ class Profile(models.Model):
     def time_used_in_proposal(self, proposal):
         if not proposal.current_semester:
             return 0
-        user_requests = self.user.userrequest_set.filter(
-            proposal=proposal, created__gte=proposal.current_semester.start
-        ).prefetch_related('requests')
-        return sum(request.duration for user_request in user_requests for request in user_request.requests.all())
+        try:
+            return ProposalTimeUsage.objects.get(
+                user=self.user, proposal=proposal, semester=proposal.current_semester
+            ).time_used
+        except ProposalTimeUsage.DoesNotExist:
+            return calculate_time_used_in_proposal(self.user, proposal, proposal.current_semester)
 
     @property
     def archive_bearer_token(self):
@@ -72,3 +76,53 @@ class Profile(models.Model):
 
     def __str__(self):
         return '{0} {1} at {2}'.format(self.user, self.title, self.institution)
+
+
+class ProposalTimeUsage(models.Model):
+    '''
+    The time in seconds a user has requested in a proposal during a semester. It is added to as user requests are
+    submitted, so membership time limits can be checked without summing the duration of every request the user has
+    submitted. Run the reconcile_time_used command to correct it after requests are changed or deleted, and to store
+    it for users who have not submitted since it was first stored.
+    '''
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    proposal = models.ForeignKey(Proposal, on_delete=models.CASCADE)
+    semester = models.ForeignKey(Semester, on_delete=models.CASCADE)
+    time_used = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'proposal', 'semester')
+
+    def __str__(self):
+        return '{0} used {1}s in {2} {3}'.format(self.user, self.time_used, self.proposal, self.semester)
+
+
+def calculate_time_used_in_proposal(user, proposal, semester):
+    ''' Sums the durations of the requests a user submitted to a proposal during a semester '''
+    requests = Request.objects.filter(
+        user_request__submitter=user, user_request__proposal=proposal,
+        user_request__created__gte=semester.start, user_request__created__lte=semester.end
+    ).prefetch_related('molecules')
+    return sum(request.duration for request in requests)
+
+
+def add_time_used_in_proposal(user, proposal, time_used):
+    ''' Adds the duration in seconds of newly submitted requests to the user's time used in the proposal '''
+    semester = proposal.current_semester
+    if not semester:
+        return
+    usage = ProposalTimeUsage.objects.filter(user=user, proposal=proposal, semester=semester)
+    if usage.update(time_used=F('time_used') + time_used):
+        return
+    with transaction.atomic():
+        # a concurrent first submission waits here for this one to commit, then adds to the row it created rather
+        # than summing requests that were already added
+        list(Membership.objects.select_for_update().filter(user=user, proposal=proposal))
+        if not usage.update(time_used=F('time_used') + time_used):
+            # the sum includes the new requests, which a row created meanwhile by reconcile_time_used could not see
+            _, created = ProposalTimeUsage.objects.get_or_create(
+                user=user, proposal=proposal, semester=semester,
+                defaults={'time_used': calculate_time_used_in_proposal(user, proposal, semester)}
+            )
+            if not created:
+                usage.update(time_used=F('time_used') + time_used)
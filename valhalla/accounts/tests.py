@@ -1,12 +1,17 @@
 from django.test import TestCase
+from django.core.management import call_command
 from django.utils import timezone
 from django.contrib.auth.models import User
 from datetime import timedelta
+from io import StringIO
 from mixer.backend.django import mixer
 from oauth2_provider.models import Application, AccessToken
 from unittest.mock import patch
 
-from valhalla.accounts.models import Profile
+from valhalla.accounts.models import Profile, ProposalTimeUsage, calculate_time_used_in_proposal
+from valhalla.proposals.models import Proposal, Semester, TimeAllocation, Membership
+from valhalla.userrequests.models import UserRequest, Molecule
+from valhalla.common.test_helpers import create_simple_userrequest, ConfigDBTestMixin
 
 
 class TestArchiveBearerToken(TestCase):
@@ -52,3 +57,30 @@ class TestAPIQuota(TestCase):
     @patch('django.core.cache.cache.get', return_value=([1504903107.1322677, 1504903106.6130717]))
     def test_quota_used(self, cache_mock):
         self.assertEqual(self.profile.api_quota['used'], 2)
+
+
+class TestReconcileTimeUsed(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.proposal = mixer.blend(Proposal)
+        self.semester = mixer.blend(Semester, start=timezone.now() - timedelta(days=1),
+                                    end=timezone.now() + timedelta(days=180))
+        mixer.blend(TimeAllocation, proposal=self.proposal, semester=self.semester)
+        self.users = mixer.cycle(2).blend(User)
+        for user in self.users:
+            mixer.blend(Profile, user=user)
+            mixer.blend(Membership, user=user, proposal=self.proposal)
+            molecule = mixer.blend(Molecule, instrument_name='1M0-SCICAM-SBIG', exposure_time=30)
+            create_simple_userrequest(user, self.proposal, molecule=molecule)
+        # the requests mixer made for the molecules are left without any
+        UserRequest.objects.exclude(submitter__in=self.users).delete()
+
+    def test_reconcile_corrects_and_creates_time_used(self):
+        time_used = self.users[0].profile.time_used_in_proposal(self.proposal)
+        mixer.blend(ProposalTimeUsage, user=self.users[0], proposal=self.proposal, semester=self.semester,
+                    time_used=time_used + 1000)
+        call_command('reconcile_time_used', stdout=StringIO())
+        for user in self.users:
+            usage = ProposalTimeUsage.objects.get(user=user, proposal=self.proposal, semester=self.semester)
+            self.assertEqual(usage.time_used, calculate_time_used_in_proposal(user, self.proposal, self.semester))
+        self.assertEqual(self.users[0].profile.time_used_in_proposal(self.proposal), time_used)
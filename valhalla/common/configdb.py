@@ -1,15 +1,22 @@
 import requests
-from django.core.cache import caches
+import threading
+import time
+from django.core.cache import cache
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from collections import namedtuple
 import logging
 
+from valhalla.common.tiered_cache import TieredCache
+
 logger = logging.getLogger(__name__)
 
 CONFIGDB_ERROR_MSG = _(("ConfigDB connection is currently down, please wait a few minutes and try again."
                        " If this problem persists then please contact support."))
 
+# configdb resources are kept live in each process, and only read from the shared cache again when they change
+configdb_cache = TieredCache('configdb', settings.CONFIGDB_LOCAL_CACHE_TIMEOUT)
+
 
 class ConfigDBException(Exception):
     pass
@@ -22,32 +29,188 @@ class TelescopeKey(namedtuple('TelescopeKey', ['site', 'observatory', 'telescope
         return ".".join(s for s in [self.site, self.observatory, self.telescope] if s)
 
 
+class ConfigDBSnapshot(object):
+    ''' Pre-parsed view of the configdb sites structure. The site -> enclosure -> telescope -> instrument tree is
+        walked once when the snapshot is built, and every lookup afterwards is a dictionary access.
+    '''
+    def __init__(self, site_data):
+        self.site_data = site_data
+        self.instruments = []
+        self.schedulable_instruments = []
+        self.camera_types = {}
+        self.filters = {}
+        self.telescope_details = {}
+        self.telescope_keys = []
+        self.instrument_types_per_telescope = {True: {}, False: {}}
+        self.telescopes_per_instrument_type = {True: {}, False: {}}
+        self._active_instrument_types = {}
+
+        for site in site_data:
+            for enclosure in site['enclosure_set']:
+                for telescope in enclosure['telescope_set']:
+                    telescope_key = TelescopeKey(
+                        site=site['code'],
+                        observatory=enclosure['code'],
+                        telescope=telescope['code']
+                    )
+                    details = {
+                        'latitude': telescope['lat'],
+                        'longitude': telescope['long'],
+                        'horizon': telescope['horizon'],
+                        'altitude': site['elevation'],
+                        'ha_limit_pos': telescope['ha_limit_pos'],
+                        'ha_limit_neg': telescope['ha_limit_neg']
+                    }
+                    for instrument in telescope['instrument_set']:
+                        self._add_instrument(telescope_key, details, instrument)
+
+    def _add_instrument(self, telescope_key, details, instrument):
+        instrument['telescope_key'] = telescope_key
+        schedulable = instrument['state'] == 'SCHEDULABLE'
+        camera_type = instrument['science_camera']['camera_type']
+        instrument_type = camera_type['code'].upper()
+
+        self.instruments.append(instrument)
+        # The first instrument found of a type defines its camera type parameters
+        self.camera_types.setdefault(instrument_type, camera_type)
+        self._index_telescope(False, telescope_key, instrument_type)
+        if not schedulable:
+            return
+
+        self.schedulable_instruments.append(instrument)
+        self._index_telescope(True, telescope_key, instrument_type)
+        self.filters.setdefault(instrument_type, set()).update(
+            camera_filter.lower() for camera_filter in instrument['science_camera']['filters'].split(',')
+        )
+        if telescope_key not in self.telescope_details:
+            self.telescope_details[telescope_key] = {'details': details, 'instrument_types': set()}
+            self.telescope_keys.append(telescope_key)
+        self.telescope_details[telescope_key]['instrument_types'].add(instrument_type)
+
+    def _index_telescope(self, only_schedulable, telescope_key, instrument_type):
+        instrument_types = self.instrument_types_per_telescope[only_schedulable].setdefault(telescope_key, [])
+        if instrument_type not in instrument_types:
+            instrument_types.append(instrument_type)
+        self.telescopes_per_instrument_type[only_schedulable].setdefault(instrument_type, set()).add(telescope_key)
+
+    def get_camera_type(self, instrument_type):
+        return self.camera_types.get(instrument_type.upper())
+
+    def get_telescope_details(self, instrument_type='', site_code='', observatory_code='', telescope_code=''):
+        telescope_details = {}
+        for telescope_key in self.telescope_keys:
+            if ((not site_code or site_code == telescope_key.site)
+                    and (not observatory_code or observatory_code == telescope_key.observatory)
+                    and (not telescope_code or telescope_code == telescope_key.telescope)):
+                entry = self.telescope_details[telescope_key]
+                if not instrument_type or instrument_type.upper() in entry['instrument_types']:
+                    code = '.'.join([telescope_key.telescope, telescope_key.observatory, telescope_key.site])
+                    telescope_details[code] = entry['details']
+        return telescope_details
+
+    def get_active_instrument_types(self, location):
+        location_key = tuple(location.get(field, '').lower() for field in
+                             ['site', 'observatory', 'telescope_class', 'telescope'])
+        if location_key not in self._active_instrument_types:
+            site, observatory, telescope_class, telescope = location_key
+            instrument_types = set()
+            for instrument in self.schedulable_instruments:
+                split_string = instrument['__str__'].lower().split('.')
+                if (site in split_string[0] and observatory in split_string[1]
+                        and telescope_class in split_string[2] and telescope in split_string[2]):
+                    instrument_types.add(instrument['science_camera']['camera_type']['code'].upper())
+            self._active_instrument_types[location_key] = instrument_types
+        return set(self._active_instrument_types[location_key])
+
+
 class ConfigDB(object):
-    def _get_configdb_data(self, resource):
-        ''' Gets all the data from configdb (the sites structure with everything in it)
-        :return: list of dictionaries of site data
-        '''
+    def __init__(self):
+        self._snapshot = None
 
-        data = caches['locmem'].get(resource)
-        if not data:
-            try:
-                r = requests.get(settings.CONFIGDB_URL + '/{}/'.format(resource))
-                r.raise_for_status()
-            except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-                msg = "{}: {}".format(e.__class__.__name__, CONFIGDB_ERROR_MSG)
-                raise ConfigDBException(msg)
+    def _fetch_configdb_data(self, resource, entry=None):
+        ''' Fetches a resource from configdb, sending the validators of a previously fetched entry so an unchanged
+            resource costs only a 304 response
+        :return: dictionary with the resource data, its validators and the time it was fetched
+        '''
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            r = requests.get(settings.CONFIGDB_URL + '/{}/'.format(resource), headers=headers,
+                             timeout=settings.CONFIGDB_REQUEST_TIMEOUT)
+            r.raise_for_status()
+        except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
+            msg = "{}: {}".format(e.__class__.__name__, CONFIGDB_ERROR_MSG)
+            raise ConfigDBException(msg)
+
+        if entry and r.status_code == 304:
+            data = entry['data']
+        else:
             try:
                 data = r.json()['results']
             except KeyError:
                 raise ConfigDBException(CONFIGDB_ERROR_MSG)
-            # cache the results for 15 minutes
-            caches['locmem'].set(resource, data, 900)
 
-        return data
+        return {
+            'data': data,
+            'etag': r.headers.get('ETag', ''),
+            'last_modified': r.headers.get('Last-Modified', ''),
+            'fetched': time.time()
+        }
+
+    def _refresh_configdb_data(self, resource, entry):
+        ''' Refreshes the shared cache entry for a resource. Called with the refresh lock held, which is released
+            once the refresh succeeds. On failure the last known good entry is kept, and the lock is held for
+            CONFIGDB_RETRY_DELAY more seconds so that workers do not all retry while configdb is down.
+        '''
+        lock = 'configdb.{}.lock'.format(resource)
+        try:
+            configdb_cache.set(resource, self._fetch_configdb_data(resource, entry))
+        except ConfigDBException as e:
+            logger.warning(repr(e))
+            cache.set(lock, True, settings.CONFIGDB_RETRY_DELAY)
+        else:
+            cache.delete(lock)
+
+    def _get_configdb_data(self, resource):
+        ''' Gets all the data from configdb (the sites structure with everything in it)
+
+            Data is kept in the shared cache with no expiry. Once it is older than CONFIGDB_CACHE_TIMEOUT it is still
+            served while a single worker, holding the refresh lock, fetches a new copy in the background. ConfigDB is
+            only queried in the request path when there is no copy at all. Each process keeps the entry it last read,
+            and only checks whether it is stale when it checks the shared cache for a new version.
+        :return: list of dictionaries of site data
+        '''
+        entry, checked = configdb_cache.lookup(resource)
+        if not entry:
+            entry = self._fetch_configdb_data(resource)
+            configdb_cache.set(resource, entry)
+        elif checked and time.time() - entry['fetched'] > settings.CONFIGDB_CACHE_TIMEOUT:
+            if cache.add('configdb.{}.lock'.format(resource), True, settings.CONFIGDB_CACHE_TIMEOUT):
+                if settings.CONFIGDB_BACKGROUND_REFRESH:
+                    threading.Thread(target=self._refresh_configdb_data, args=(resource, entry), daemon=True).start()
+                else:
+                    self._refresh_configdb_data(resource, entry)
+                    entry = configdb_cache.get(resource, entry)
+
+        return entry['data']
 
     def get_site_data(self):
         return self._get_configdb_data('sites')
 
+    def get_snapshot(self):
+        ''' Returns the indexed ConfigDBSnapshot of the site data, building it only when the site data this process
+            keeps is replaced
+        '''
+        site_data = self.get_site_data()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.site_data is not site_data:
+            snapshot = ConfigDBSnapshot(site_data)
+            self._snapshot = snapshot
+        return snapshot
+
     def get_sites_with_instrument_type_and_location(self, instrument_type='', site_code='',
                                                     observatory_code='', telescope_code=''):
         telescope_details = self.get_telescopes_with_instrument_type_and_location(instrument_type, site_code,
@@ -62,76 +225,28 @@ class ConfigDB(object):
 
     def get_telescopes_with_instrument_type_and_location(self, instrument_type='', site_code='',
                                                     observatory_code='', telescope_code=''):
-        site_data = self.get_site_data()
-        telescope_details = {}
-        for site in site_data:
-            if not site_code or site_code == site['code']:
-                for enclosure in site['enclosure_set']:
-                    if not observatory_code or observatory_code == enclosure['code']:
-                        for telescope in enclosure['telescope_set']:
-                            if not telescope_code or telescope_code == telescope['code']:
-                                code = '.'.join([telescope['code'], enclosure['code'], site['code']])
-                                for instrument in telescope['instrument_set']:
-                                    if instrument['state'] == 'SCHEDULABLE':
-                                        camera_type = instrument['science_camera']['camera_type']['code']
-                                        if not instrument_type or instrument_type.upper() == camera_type.upper():
-                                            if code not in telescope_details:
-                                                telescope_details[code] = {
-                                                    'latitude': telescope['lat'],
-                                                    'longitude': telescope['long'],
-                                                    'horizon': telescope['horizon'],
-                                                    'altitude': site['elevation'],
-                                                    'ha_limit_pos': telescope['ha_limit_pos'],
-                                                    'ha_limit_neg': telescope['ha_limit_neg']
-                                                }
-
-        return telescope_details
+        return self.get_snapshot().get_telescope_details(instrument_type, site_code, observatory_code, telescope_code)
 
     def get_instruments(self, only_schedulable=False):
-        site_data = self.get_site_data()
-        instruments = []
-        for site in site_data:
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        if only_schedulable and instrument['state'] != 'SCHEDULABLE':
-                            pass
-                        else:
-                            telescope_key = TelescopeKey(
-                                site=site['code'],
-                                observatory=enclosure['code'],
-                                telescope=telescope['code']
-                            )
-                            instrument['telescope_key'] = telescope_key
-                            instruments.append(instrument)
-
-        return instruments
+        snapshot = self.get_snapshot()
+        if only_schedulable:
+            return list(snapshot.schedulable_instruments)
+        return list(snapshot.instruments)
 
     def get_instrument_types_per_telescope(self, only_schedulable=False):
         '''
             Function uses the configdb to get a set of available instrument types per telescope
         :return: set of available instrument types per TelescopeKey
         '''
-        telescope_instrument_types = {}
-        for instrument in self.get_instruments(only_schedulable=only_schedulable):
-            if instrument['telescope_key'] not in telescope_instrument_types:
-                telescope_instrument_types[instrument['telescope_key']] = []
-            instrument_type = instrument['science_camera']['camera_type']['code'].upper()
-            if instrument_type not in telescope_instrument_types[instrument['telescope_key']]:
-                telescope_instrument_types[instrument['telescope_key']].append(instrument_type)
-
-        return telescope_instrument_types
+        return {telescope_key: list(instrument_types) for telescope_key, instrument_types in
+                self.get_snapshot().instrument_types_per_telescope[only_schedulable].items()}
 
     def get_telescopes_per_instrument_type(self, instrument_type, only_schedulable=False):
         '''
         Function returns a set of telescope keys that have an instrument of instrument_type
         associated with them
         '''
-        instrument_telescopes = set()
-        for instrument in self.get_instruments(only_schedulable=only_schedulable):
-            if instrument['science_camera']['camera_type']['code'].upper() == instrument_type:
-                instrument_telescopes.add(instrument['telescope_key'])
-        return instrument_telescopes
+        return set(self.get_snapshot().telescopes_per_instrument_type[only_schedulable].get(instrument_type, set()))
 
     def get_filters(self, instrument_type):
         '''
@@ -139,13 +254,7 @@ class ConfigDB(object):
         :param instrument_type:
         :return: returns the available set of filters for an instrument_type
         '''
-        available_filters = set()
-        for instrument in self.get_instruments(only_schedulable=True):
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                for camera_filter in instrument['science_camera']['filters'].split(','):
-                    available_filters.add(camera_filter.lower())
-
-        return available_filters
+        return set(self.get_snapshot().filters.get(instrument_type.upper(), set()))
 
     def get_filter_map(self):
         filter_map = {}
@@ -163,14 +272,10 @@ class ConfigDB(object):
         :param instrument_type:
         :return: returns the available set of binnings for an instrument_type
         '''
-        available_binnings = set()
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                for mode in instrument['science_camera']['camera_type']['mode_set']:
-                    available_binnings.add(mode['binning'])
-                # Once the instrument type is found, we  have the binnings and are done
-                break
-        return available_binnings
+        camera_type = self.get_snapshot().get_camera_type(instrument_type)
+        if camera_type is None:
+            return set()
+        return {mode['binning'] for mode in camera_type['mode_set']}
 
     def get_default_binning(self, instrument_type):
         '''
@@ -178,16 +283,16 @@ class ConfigDB(object):
         :param instrument_type:
         :return: binning default
         '''
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                return instrument['science_camera']['camera_type']['default_mode']['binning']
-        return None
+        camera_type = self.get_snapshot().get_camera_type(instrument_type)
+        if camera_type is None:
+            return None
+        return camera_type['default_mode']['binning']
 
     def get_instrument_name(self, instrument_type):
-        for instrument in self.get_instruments():
-            if instrument_type.upper() == instrument['science_camera']['camera_type']['code'].upper():
-                return instrument['science_camera']['camera_type']['name']
-        return instrument_type
+        camera_type = self.get_snapshot().get_camera_type(instrument_type)
+        if camera_type is None:
+            return instrument_type
+        return camera_type['name']
 
     def get_active_instrument_types(self, location):
         '''
@@ -195,41 +300,31 @@ class ConfigDB(object):
             Location should be a dictionary of the location, with class, site, observatory, and telescope fields
         :return: Set of available instrument_types (i.e. 1M0-SCICAM-SBIG, etc.)
         '''
-        instrument_types = set()
-        for instrument in self.get_instruments(only_schedulable=True):
-            split_string = instrument['__str__'].lower().split('.')
-            if (location.get('site', '').lower() in split_string[0]
-                    and location.get('observatory', '').lower() in split_string[1]
-                    and location.get('telescope_class', '').lower() in split_string[2]
-                    and location.get('telescope', '').lower() in split_string[2]):
-                instrument_types.add(instrument['science_camera']['camera_type']['code'].upper())
-        return instrument_types
+        return self.get_snapshot().get_active_instrument_types(location)
 
     def get_exposure_overhead(self, instrument_type, binning):
         # using the instrument type, build an instrument with the correct configdb parameters
-        for instrument in self.get_instruments():
-            camera_type = instrument['science_camera']['camera_type']
-            if camera_type['code'].upper() == instrument_type.upper():
-                # get the binnings and put them into a dictionary
-                for mode in camera_type['mode_set']:
-                    if mode['binning'] == binning:
-                        return mode['readout'] + camera_type['fixed_overhead_per_exposure']
-                # if the binning is not found, return the default binning (Added to support legacy 2x2 Sinistro obs)
-                return camera_type['default_mode']['readout'] + camera_type['fixed_overhead_per_exposure']
-
-        raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+        camera_type = self.get_snapshot().get_camera_type(instrument_type)
+        if camera_type is None:
+            raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+
+        # get the binnings and put them into a dictionary
+        for mode in camera_type['mode_set']:
+            if mode['binning'] == binning:
+                return mode['readout'] + camera_type['fixed_overhead_per_exposure']
+        # if the binning is not found, return the default binning (Added to support legacy 2x2 Sinistro obs)
+        return camera_type['default_mode']['readout'] + camera_type['fixed_overhead_per_exposure']
 
     def get_request_overheads(self, instrument_type):
-        for instrument in self.get_instruments():
-            camera_type = instrument['science_camera']['camera_type']
-            if camera_type['code'].upper() == instrument_type.upper():
-                return {'config_change_time': camera_type['config_change_time'],
-                        'acquire_processing_time': camera_type['acquire_processing_time'],
-                        'acquire_exposure_time': camera_type['acquire_exposure_time'],
-                        'front_padding': camera_type['front_padding'],
-                        'filter_change_time': camera_type['filter_change_time']}
-
-        raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+        camera_type = self.get_snapshot().get_camera_type(instrument_type)
+        if camera_type is None:
+            raise ConfigDBException("Instrument type {} not found in configdb.".format(instrument_type))
+
+        return {'config_change_time': camera_type['config_change_time'],
+                'acquire_processing_time': camera_type['acquire_processing_time'],
+                'acquire_exposure_time': camera_type['acquire_exposure_time'],
+                'front_padding': camera_type['front_padding'],
+                'filter_change_time': camera_type['filter_change_time']}
 
     @staticmethod
     def is_spectrograph(instrument_type):
@@ -1,23 +1,60 @@
 import requests
-from django.core.cache import caches
 from django.utils.translation import ugettext as _
 from django.conf import settings
-from django.utils import timezone
+import numpy as np
+import threading
+import hashlib
 import logging
-from time_intervals.intervals import Intervals
-from datetime import datetime
+import json
+import time
+
+from valhalla.common.intervals import IntervalSet
+from valhalla.common.tiered_cache import TieredCache
 
 logger = logging.getLogger(__name__)
 
 DOWNTIMEDB_ERROR_MSG = _(("DowntimeDB connection is currently down, cannot update downtime information. "
                           "Using the last known value."))
 DOWNTIME_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# seconds a process goes between checking whether the stored downtime has changed
+DOWNTIME_VERSION_CHECK_INTERVAL = 60
+
+downtime_cache = TieredCache('downtime', DOWNTIME_VERSION_CHECK_INTERVAL)
+# the thread this process last started to fetch the downtime when none was stored, and when it started
+_missing_index_fetch = {'thread': None, 'started': None}
+_missing_index_fetch_lock = threading.Lock()
 
 
 class DowntimeDBException(Exception):
     pass
 
 
+def _parse_downtime_times(times):
+    ''' Parses a list of times in the DOWNTIME_DATE_FORMAT into an array of their epoch seconds all at once '''
+    return np.array([time.rstrip('Z') for time in times], dtype='datetime64[s]').astype(np.int64).astype(np.float64)
+
+
+class DowntimeIndex(object):
+    '''
+    The downtime of each telescope resource as an IntervalSet, whose intervals are sorted by start time so the downtime
+    overlapping a time range is found by binary search. The generation goes up each time the downtime changes, so
+    anything derived from the downtime can be cached against it.
+    '''
+    def __init__(self, downtime_intervals=None, generation=0, digest=None):
+        self.downtime_intervals = downtime_intervals or {}
+        self.generation = generation
+        self.digest = digest
+
+    def __contains__(self, resource):
+        return resource in self.downtime_intervals
+
+    def get_overlapping(self, resource, intervalset):
+        ''' Returns the downtime of a resource that overlaps the span of an IntervalSet '''
+        if resource not in self.downtime_intervals:
+            return IntervalSet()
+        return self.downtime_intervals[resource].overlapping(intervalset)
+
+
 class DowntimeDB(object):
     @staticmethod
     def _get_downtime_data():
@@ -25,7 +62,7 @@ class DowntimeDB(object):
         :return: list of dictionaries of downtime periods in time order (default)
         '''
         try:
-            r = requests.get(settings.DOWNTIMEDB_URL)
+            r = requests.get(settings.DOWNTIMEDB_URL, timeout=settings.DOWNTIMEDB_REQUEST_TIMEOUT)
             r.raise_for_status()
         except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
             msg = "{}: {}".format(e.__class__.__name__, DOWNTIMEDB_ERROR_MSG)
@@ -37,36 +74,82 @@ class DowntimeDB(object):
     def _order_downtime_by_resource(raw_downtime_intervals):
         ''' Puts the raw downtime interval sets into a dictionary by resource
         '''
-        downtime_intervals = {}
+        times_by_resource = {}
         for interval in raw_downtime_intervals:
             resource = '.'.join([interval['telescope'], interval['observatory'], interval['site']])
-            if resource not in downtime_intervals:
-                downtime_intervals[resource] = []
-            start = datetime.strptime(interval['start'], DOWNTIME_DATE_FORMAT).replace(tzinfo=timezone.utc)
-            end = datetime.strptime(interval['end'], DOWNTIME_DATE_FORMAT).replace(tzinfo=timezone.utc)
-            downtime_intervals[resource].append({'type': 'start', 'time': start})
-            downtime_intervals[resource].append({'type': 'end', 'time': end})
+            starts, ends = times_by_resource.setdefault(resource, ([], []))
+            starts.append(interval['start'])
+            ends.append(interval['end'])
 
-        for resource in downtime_intervals:
-            downtime_intervals[resource] = Intervals(downtime_intervals[resource])
+        return {resource: IntervalSet(_parse_downtime_times(starts), _parse_downtime_times(ends))
+                for resource, (starts, ends) in times_by_resource.items()}
 
-        return downtime_intervals
+    @staticmethod
+    def _build_downtime_index(raw_downtime_intervals, previous_index):
+        ''' Returns a DowntimeIndex of the raw downtime intervals, or the previous index if they haven't changed '''
+        digest = hashlib.sha1(json.dumps(raw_downtime_intervals, sort_keys=True).encode('utf-8')).hexdigest()
+        if digest == previous_index.digest:
+            return previous_index
+        return DowntimeIndex(DowntimeDB._order_downtime_by_resource(raw_downtime_intervals),
+                             previous_index.generation + 1, digest)
+
+    @staticmethod
+    def update_downtime_index():
+        ''' Fetches the downtime from downtimedb and stores its DowntimeIndex in the downtime cache whenever it has
+            changed or is no longer stored. This is run by the update_downtime task, and the last index stored is
+            kept if downtimedb can't be reached.
+        :return: the DowntimeIndex stored
+        '''
+        data = DowntimeDB._get_downtime_data()
+        stored_index = downtime_cache.get('index')
+        # the generation carries on from the last index this process knew, so it never repeats for other downtime
+        previous_index = stored_index or downtime_cache.get_last_known('index') or DowntimeIndex()
+        downtime_index = DowntimeDB._build_downtime_index(data, previous_index)
+        if downtime_index is not stored_index:
+            downtime_cache.set('index', downtime_index)
+        return downtime_index
+
+    @staticmethod
+    def _fetch_missing_downtime_index():
+        try:
+            DowntimeDB.update_downtime_index()
+        except DowntimeDBException as e:
+            logger.warning(repr(e))
+
+    @staticmethod
+    def _start_missing_downtime_index_fetch():
+        ''' Starts fetching the downtime in a background thread, unless this process is already fetching it or
+            started to within the last DOWNTIME_VERSION_CHECK_INTERVAL seconds
+        '''
+        with _missing_index_fetch_lock:
+            thread, started = _missing_index_fetch['thread'], _missing_index_fetch['started']
+            if thread is not None and thread.is_alive():
+                return
+            if started is not None and time.monotonic() - started < DOWNTIME_VERSION_CHECK_INTERVAL:
+                return
+            thread = threading.Thread(target=DowntimeDB._fetch_missing_downtime_index, daemon=True)
+            _missing_index_fetch.update(thread=thread, started=time.monotonic())
+            thread.start()
+
+    @staticmethod
+    def get_downtime_index():
+        ''' Returns the DowntimeIndex of the downtime per telescope resource last stored by the update_downtime task.
+            Each process keeps the index it last read, and only reads it from the shared cache again when its version
+            has changed. Requests never wait on downtimedb: when no index is stored, as before the first run of the
+            task, after the cache is flushed or without a shared cache, the last index this process knew is used
+            while the downtime is fetched in the background.
+        '''
+        downtime_index = downtime_cache.get('index')
+        if downtime_index is None:
+            DowntimeDB._start_missing_downtime_index_fetch()
+            downtime_index = downtime_cache.get_last_known('index')
+            if downtime_index is None:
+                logger.warning('No downtime is stored yet, none is left out until it has been fetched')
+                downtime_index = DowntimeIndex()
+        return downtime_index
 
     @staticmethod
     def get_downtime_intervals():
-        ''' Returns dictionary of IntervalSets of downtime intervals per telescope resource. Caches the data and will
-            attempt to update the cache every 15 minutes, but fallback on using previous downtime list otherwise.
+        ''' Returns dictionary of IntervalSets of downtime intervals per telescope resource
         '''
-        downtime_intervals = caches['locmem'].get('downtime_intervals', [])
-        if not downtime_intervals:
-            # If the cache has expired, attempt to update the downtime intervals
-            try:
-                data = DowntimeDB._get_downtime_data()
-                downtime_intervals = DowntimeDB._order_downtime_by_resource(data)
-                caches['locmem'].set('downtime_intervals', downtime_intervals, 900)
-                caches['locmem'].set('downtime_intervals.no_expire', downtime_intervals)
-            except DowntimeDBException as e:
-                downtime_intervals = caches['locmem'].get('downtime_intervals.no_expire', [])
-                logger.warning(repr(e))
-
-        return downtime_intervals
+        return DowntimeDB.get_downtime_index().downtime_intervals
@@ -0,0 +1,156 @@
+import numpy as np
+from datetime import datetime, timedelta
+from django.utils import timezone
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = EPOCH.replace(tzinfo=timezone.utc)
+
+
+def _to_epoch(time):
+    return (time - (EPOCH if time.tzinfo is None else EPOCH_UTC)).total_seconds()
+
+
+def _to_datetimes(epochs, aware):
+    # whole microseconds, so the datetimes that went in come back out unchanged
+    times = np.round(epochs * 1e6).astype(np.int64).astype('datetime64[us]').tolist()
+    if aware:
+        return [time.replace(tzinfo=timezone.utc) for time in times]
+    return times
+
+
+def _normalize(starts, ends):
+    ''' Sorts the intervals and merges the ones that overlap or touch, dropping the empty ones '''
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if not starts.size:
+        return starts, ends
+    order = np.argsort(starts, kind='mergesort')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    breaks = np.flatnonzero(starts[1:] > reach[:-1]) + 1
+    return starts[np.concatenate(([0], breaks))], reach[np.concatenate((breaks - 1, [len(starts) - 1]))]
+
+
+class IntervalSet(object):
+    '''
+    A set of time intervals, kept as sorted numpy arrays of the float epoch seconds of their starts and ends. As with
+    time_intervals.Intervals, overlapping and touching intervals are merged and empty ones are dropped, but the set
+    operations work on whole arrays at a time rather than on a dict per start and end time. Sets are not changed by
+    their operations, which return new sets.
+    '''
+    __slots__ = ('starts', 'ends', 'aware')
+
+    def __init__(self, starts=(), ends=(), aware=True):
+        self.starts, self.ends = _normalize(np.asarray(starts, dtype=np.float64), np.asarray(ends, dtype=np.float64))
+        self.aware = aware
+
+    @classmethod
+    def _from_normalized(cls, starts, ends, aware):
+        interval_set = cls.__new__(cls)
+        interval_set.starts, interval_set.ends, interval_set.aware = starts, ends, aware
+        return interval_set
+
+    @classmethod
+    def from_tuple_list(cls, intervals):
+        ''' Makes a set from a list of (start, end) datetime tuples, which are returned the same way by to_tuple_list,
+            timezone aware in UTC or naive like the first of them
+        '''
+        epochs = np.array([_to_epoch(time) for interval in intervals for time in interval], dtype=np.float64)
+        aware = not intervals or intervals[0][0].tzinfo is not None
+        return cls(epochs[0::2], epochs[1::2], aware)
+
+    def to_tuple_list(self):
+        return list(zip(_to_datetimes(self.starts, self.aware), _to_datetimes(self.ends, self.aware)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __eq__(self, other):
+        return (isinstance(other, IntervalSet) and np.array_equal(self.starts, other.starts) and
+                np.array_equal(self.ends, other.ends))
+
+    def __repr__(self):
+        return 'IntervalSet({})'.format(self.to_tuple_list())
+
+    def _combine(self, other, keep):
+        ''' Sweeps through the starts and ends of both sets, keeping the times where keep is true of whether they are
+            in each set
+        '''
+        times = np.concatenate((self.starts, self.ends, other.starts, other.ends))
+        ones, zeros = np.ones(len(self)), np.zeros(len(self))
+        other_ones, other_zeros = np.ones(len(other)), np.zeros(len(other))
+        in_self = np.concatenate((ones, -ones, other_zeros, other_zeros))
+        in_other = np.concatenate((zeros, zeros, other_ones, -other_ones))
+        order = np.argsort(times, kind='mergesort')
+        inside = keep(np.cumsum(in_self[order]) > 0, np.cumsum(in_other[order]) > 0)
+        changes = np.diff(np.concatenate(([False], inside)).astype(np.int8))
+        times = times[order]
+        return IntervalSet(times[changes == 1], times[changes == -1], self.aware)
+
+    def union(self, *others):
+        others = [other for other in others if len(other)]
+        if not others:
+            return self
+        return IntervalSet(np.concatenate([self.starts] + [other.starts for other in others]),
+                           np.concatenate([self.ends] + [other.ends for other in others]), self.aware)
+
+    def intersection(self, *others):
+        result = self
+        for other in others:
+            result = result._combine(other, lambda in_self, in_other: in_self & in_other)
+        return result
+
+    def subtract(self, other):
+        if not len(self) or not len(other):
+            return self
+        return self._combine(other, lambda in_self, in_other: in_self & ~in_other)
+
+    def clip(self, start, end):
+        ''' Returns the parts of the intervals between the start and end datetimes '''
+        start, end = _to_epoch(start), _to_epoch(end)
+        return IntervalSet(np.clip(self.starts, start, end), np.clip(self.ends, start, end), self.aware)
+
+    def overlapping(self, other):
+        ''' Returns the intervals that overlap the span from the start of another set to its end. The intervals of a
+            set are disjoint, so their ends are as sorted as their starts and both edges of the span are binary searched
+        '''
+        if not len(other):
+            return IntervalSet(aware=self.aware)
+        first = np.searchsorted(self.ends, other.starts[0], side='right')
+        last = np.searchsorted(self.starts, other.ends[-1], side='left')
+        return IntervalSet._from_normalized(self.starts[first:last], self.ends[first:last], self.aware)
+
+    def largest_interval(self):
+        return timedelta(seconds=float((self.ends - self.starts).max())) if len(self) else timedelta(seconds=0)
+
+    def largest_gap(self):
+        ''' Returns the longest time between the end of an interval and the start of the next '''
+        if len(self) < 2:
+            return timedelta(seconds=0)
+        return timedelta(seconds=float((self.starts[1:] - self.ends[:-1]).max()))
+
+
+def intersect_sorted_intervals(spans, intervals):
+    '''
+    Sweeps through spans and intervals that are both sorted by their start times together, generating a
+    (item, start, end) tuple for each part of a span that falls within an interval. Spans are (start, end, item)
+    tuples, and intervals are (start, end) tuples. Each span is only compared with the intervals around it, so the
+    sweep takes time linear in the number of spans, intervals and parts generated. Spans that fall within an interval
+    are kept even when they are instantaneous, and spans that end before they start are dropped.
+    '''
+    intervals = intervals if isinstance(intervals, (list, tuple)) else list(intervals)
+    first_interval = 0
+    for span_start, span_end, item in spans:
+        if span_end < span_start:
+            continue
+        # intervals that end before this span starts also end before every later span starts
+        while first_interval < len(intervals) and intervals[first_interval][1] < span_start:
+            first_interval += 1
+        for index in range(first_interval, len(intervals)):
+            interval_start, interval_end = intervals[index]
+            if interval_start > span_end:
+                break
+            clipped_start = max(span_start, interval_start)
+            clipped_end = min(span_end, interval_end)
+            if clipped_start < clipped_end or (span_start >= interval_start and span_end <= interval_end):
+                yield item, clipped_start, clipped_end
@@ -1,6 +1,5 @@
 from math import cos, radians
-from datetime import timedelta
-from time_intervals.intervals import Intervals
+from datetime import timedelta, datetime
 from rise_set.astrometry import make_ra_dec_target, make_satellite_target, make_minor_planet_target
 from rise_set.astrometry import make_comet_target, make_major_planet_target
 from rise_set.angle import Angle
@@ -8,11 +7,21 @@ from rise_set.rates import ProperMotion
 from rise_set.visibility import Visibility
 from rise_set.moving_objects import MovingViolation
 from django.core.cache import cache
+from django.utils import timezone
+import hashlib
+import json
 
 from valhalla.common.configdb import configdb
 from valhalla.common.downtimedb import DowntimeDB
+from valhalla.common.intervals import IntervalSet
+from valhalla.common.tiered_cache import TieredCache
 
 HOURS_PER_DEGREES = 15.0
+DARK_INTERVALS_CACHE_TIMEOUT = 86400 * 30
+RISE_SET_INTERVALS_CACHE_TIMEOUT = 86400 * 30
+
+# the half year tables of dark intervals never change, so each process keeps the ones it has read for a day
+dark_intervals_cache = TieredCache('dark_intervals', 86400)
 
 
 def get_largest_interval(intervals):
@@ -23,16 +32,29 @@ def get_largest_interval(intervals):
     return largest_interval
 
 
+def get_rise_set_intervals_cache_key(request_dict, site, site_detail):
+    ''' Returns a cache key made from a hash of everything the rise_set intervals of a request at a site depend on,
+        so identical targets, constraints and windows share their intervals whether or not the request is saved. The
+        site parameters are part of the hash, so a change to them in ConfigDB leaves the old intervals unused.
+    '''
+    key_data = {
+        'target': {k: v for k, v in request_dict['target'].items() if k != 'name'},
+        'constraints': [request_dict['constraints']['max_airmass'], request_dict['constraints']['min_lunar_distance']],
+        'windows': [[window['start'], window['end']] for window in request_dict['windows']],
+        'site': [site] + [site_detail[k] for k in ('latitude', 'longitude', 'horizon', 'ha_limit_neg', 'ha_limit_pos')]
+    }
+    key_hash = hashlib.sha1(json.dumps(key_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return 'rsi.{}'.format(key_hash)
+
+
 def get_rise_set_intervals_by_site(request_dict):
     ''' Computes or Retrieves from cache a dictionary of rise_set intervals by site for the request
     '''
     site_details = configdb.get_sites_with_instrument_type_and_location()
     intervals_by_site = {}
     for site in site_details:
-        intervals_by_site[site] = None
-        if request_dict.get('id'):
-            cache_key = '{}.{}.rsi'.format(request_dict['id'], site)
-            intervals_by_site[site] = cache.get(cache_key, None)
+        cache_key = get_rise_set_intervals_cache_key(request_dict, site, site_details[site])
+        intervals_by_site[site] = cache.get(cache_key, None)
 
         if intervals_by_site[site] is None:
             # There is no cached rise_set intervals for this request and site, so recalculate it now
@@ -41,6 +63,9 @@ def get_rise_set_intervals_by_site(request_dict):
             rise_set_target = get_rise_set_target(request_dict['target'])
             for window in request_dict['windows']:
                 visibility = get_rise_set_visibility(rise_set_site, window['start'], window['end'], site_details[site])
+                # seed the visibility with the shared site dark intervals so it does not recompute twilight
+                visibility.dark_intervals = get_site_dark_intervals(site, site_details[site], window['start'],
+                                                                    window['end'])
                 try:
                     intervals_by_site[site].extend(
                         visibility.get_observable_intervals(
@@ -51,8 +76,7 @@ def get_rise_set_intervals_by_site(request_dict):
                     )
                 except MovingViolation:
                     pass
-            if request_dict.get('id'):
-                cache.set(cache_key, intervals_by_site[site], 86400 * 30) # cache for 30 days
+            cache.set(cache_key, intervals_by_site[site], RISE_SET_INTERVALS_CACHE_TIMEOUT)
 
     return intervals_by_site
 
@@ -72,8 +96,8 @@ def get_rise_set_intervals(request_dict, site=''):
     intervals_by_site = get_rise_set_intervals_by_site(request_dict)
     intervalsets_by_telescope = intervals_by_site_to_intervalsets_by_telescope(intervals_by_site, telescope_details.keys())
     filtered_intervalsets_by_telescope = filter_out_downtime_from_intervalsets(intervalsets_by_telescope)
-    filtered_intervalset = Intervals().union(filtered_intervalsets_by_telescope.values())
-    filtered_intervals = filtered_intervalset.toTupleList()
+    filtered_intervalset = IntervalSet().union(*filtered_intervalsets_by_telescope.values())
+    filtered_intervals = filtered_intervalset.to_tuple_list()
 
     return filtered_intervals
 
@@ -82,15 +106,14 @@ def intervals_by_site_to_intervalsets_by_telescope(intervals_by_site, telescopes
     ''' Takes in a dictionary of rise_set intervals by sites and a dictionary of telescope details for the request.
         Returns a dictionary by telescopes of rise_set intervals for the request
     '''
+    intervalsets_by_site = {}
     intervalsets_by_telescope = {}
     for telescope in telescopes:
-        if telescope not in intervalsets_by_telescope:
-            site = telescope.split('.')[2]
-            datetime_intervals = []
-            for start, end in intervals_by_site[site]:
-                datetime_intervals.append({'type': 'start', 'time': start})
-                datetime_intervals.append({'type': 'end', 'time': end})
-            intervalsets_by_telescope[telescope] = Intervals(datetime_intervals)
+        site = telescope.split('.')[2]
+        if site not in intervalsets_by_site:
+            intervalsets_by_site[site] = IntervalSet.from_tuple_list(intervals_by_site[site])
+        # interval sets are never changed in place, so the telescopes at a site can share one
+        intervalsets_by_telescope[telescope] = intervalsets_by_site[site]
 
     return intervalsets_by_telescope
 
@@ -98,13 +121,12 @@ def intervals_by_site_to_intervalsets_by_telescope(intervals_by_site, telescopes
 def filter_out_downtime_from_intervalsets(intervalsets_by_telescope):
     ''' Takes a dictionary of rise_set intervalsets by telescopes and returns the same with downtime intervals removed
     '''
-    downtime_intervals = DowntimeDB.get_downtime_intervals()
+    downtime_index = DowntimeDB.get_downtime_index()
     filtered_intervalsets_by_telescope = {}
-    for telescope in intervalsets_by_telescope.keys():
-        if telescope not in downtime_intervals:
-            filtered_intervalsets_by_telescope[telescope] = intervalsets_by_telescope[telescope]
-        else:
-            filtered_intervalsets_by_telescope[telescope] = intervalsets_by_telescope[telescope].subtract(downtime_intervals[telescope])
+    for telescope, intervalset in intervalsets_by_telescope.items():
+        # only the downtime within the span of the intervals needs subtracting
+        downtime = downtime_index.get_overlapping(telescope, intervalset)
+        filtered_intervalsets_by_telescope[telescope] = intervalset.subtract(downtime)
 
     return filtered_intervalsets_by_telescope
 
@@ -190,10 +212,60 @@ def get_rise_set_visibility(rise_set_site, start, end, site_detail):
 def get_site_rise_set_intervals(start, end, site_code):
     site_details = configdb.get_sites_with_instrument_type_and_location(site_code=site_code)
     if site_code in site_details:
-        site_detail = site_details[site_code]
-        rise_set_site = get_rise_set_site(site_detail)
-        v = get_rise_set_visibility(rise_set_site, start, end, site_detail)
-
-        return v.get_dark_intervals()
+        return get_site_dark_intervals(site_code, site_details[site_code], start, end)
 
     return []
+
+
+def _half_year_start(dt):
+    return datetime(dt.year, 1 if dt.month <= 6 else 7, 1, tzinfo=timezone.utc)
+
+
+def _next_half_year_start(block_start):
+    if block_start.month == 1:
+        return block_start.replace(month=7)
+    return block_start.replace(year=block_start.year + 1, month=1)
+
+
+def _get_site_dark_intervals_for_half_year(site_code, site_detail, block_start):
+    ''' Returns the dark intervals which start within the half year beginning at block_start for a site. These are
+        computed once and kept in the dark intervals cache, whose copy in each process is kept even without a shared
+        cache.
+    '''
+    cache_key = '{}.{}.{}.{}'.format(
+        site_code, site_detail['latitude'], site_detail['longitude'], block_start.strftime('%Y%m')
+    )
+    dark_intervals = dark_intervals_cache.get(cache_key)
+    if dark_intervals is None:
+        block_end = _next_half_year_start(block_start)
+        # pad the calculation by a day so the nights crossing the block edges are complete
+        visibility = get_rise_set_visibility(get_rise_set_site(site_detail), block_start - timedelta(days=1),
+                                             block_end + timedelta(days=1), site_detail)
+        dark_intervals = [(start, end) for start, end in visibility.get_dark_intervals()
+                          if block_start <= start < block_end]
+        dark_intervals_cache.set(cache_key, dark_intervals, DARK_INTERVALS_CACHE_TIMEOUT)
+
+    return dark_intervals
+
+
+def get_site_dark_intervals(site_code, site_detail, start, end):
+    ''' Returns the nautical twilight dark intervals for a site between start and end, truncated to start and end.
+        The nights are looked up from the per site half year tables rather than recalculated for each call.
+    '''
+    naive = timezone.is_naive(start)
+    if naive:
+        start = start.replace(tzinfo=timezone.utc)
+        end = end.replace(tzinfo=timezone.utc)
+    dark_intervals = []
+    # a night starting up to a day before start could still be in progress
+    block_start = _half_year_start(start - timedelta(days=1))
+    while block_start < end:
+        for dark_start, dark_end in _get_site_dark_intervals_for_half_year(site_code, site_detail, block_start):
+            if dark_end > start and dark_start < end:
+                dark_intervals.append((max(dark_start, start), min(dark_end, end)))
+        block_start = _next_half_year_start(block_start)
+
+    if naive:
+        dark_intervals = [(dark_start.replace(tzinfo=None), dark_end.replace(tzinfo=None))
+                          for dark_start, dark_end in dark_intervals]
+    return dark_intervals
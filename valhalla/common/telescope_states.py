@@ -1,46 +1,99 @@
 from django.conf import settings
+from django.core.cache import cache
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionError
 from datetime import datetime, timedelta
 from django.utils import timezone
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from itertools import groupby
 from urllib3.exceptions import LocationValueError
 from django.core.exceptions import ImproperlyConfigured
+import threading
 import logging
+import time
 
 from valhalla.common.configdb import configdb, TelescopeKey
+from valhalla.common.intervals import intersect_sorted_intervals
 from valhalla.common.rise_set_utils import get_site_rise_set_intervals
 
 logger = logging.getLogger(__name__)
 
 ES_STRING_FORMATTER = "%Y-%m-%d %H:%M:%S"
+# telescope events fetched per scroll page
+ES_QUERY_SIZE = 5000
+# sites whose telescope events are scrolled through at the same time
+ES_PARALLEL_SCROLLS = 4
+# connections the elasticsearch client of a process keeps open to each node
+ES_MAX_CONNECTIONS = 16
+
+# telescope events are cached per telescope in buckets of an hour, once the hour is this long over
+TELESCOPE_EVENTS_BUCKET = timedelta(hours=1)
+TELESCOPE_EVENTS_CACHE_DELAY = timedelta(minutes=10)
+TELESCOPE_EVENTS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# buckets of fetched telescope events written to the cache at a time
+TELESCOPE_EVENTS_CACHE_BATCH = 24
+# seconds a request waits on another one fetching the same telescope events before fetching them itself
+TELESCOPE_EVENTS_LOCK_TIMEOUT = 30
+TELESCOPE_EVENTS_LOCK_POLL = 0.5
+
+
+# the seconds a telescope was available out of the total seconds tallied on the observing night starting on a date
+NightAvailability = namedtuple('NightAvailability', ['night', 'start', 'end', 'available', 'total'])
 
 
 class ElasticSearchException(Exception):
     pass
 
+
 def string_to_datetime(timestamp, time_format=ES_STRING_FORMATTER):
     return datetime.strptime(timestamp, time_format).replace(tzinfo=timezone.utc)
 
 
+_es_client = None
+_es_client_lock = threading.Lock()
+
+
+def get_es_client():
+    ''' Returns the elasticsearch client of this process, whose pooled connections are shared by every request '''
+    global _es_client
+    with _es_client_lock:
+        if _es_client is None:
+            try:
+                _es_client = Elasticsearch([settings.ELASTICSEARCH_URL], maxsize=ES_MAX_CONNECTIONS)
+            except LocationValueError:
+                logger.error('Could not find host. Make sure ELASTICSEARCH_URL is set.')
+                raise ImproperlyConfigured('ELASTICSEARCH_URL')
+        return _es_client
+
+
+def _bucket_id(timestamp):
+    ''' The hour bucket of a datetime, which is also the start of the timestamp strings of the events in it '''
+    return timestamp.strftime(ES_STRING_FORMATTER)[:13]
+
+
+def _bucket_key(telescope, bucket_id):
+    return 'telescope_events.{}.{}'.format(telescope, bucket_id.replace(' ', 'T'))
+
+
 class TelescopeStates(object):
+    '''
+    Lumps the telescope_events documents in elasticsearch into the periods each telescope spent in a state. The
+    documents of each site are scrolled through in parallel and lumped as they arrive, so only a page of them per site
+    is in memory at a time. The events of each telescope are cached by the hour once the hour is over, so only the
+    hours missing from the cache and the current hour are scrolled through.
+    '''
     def __init__(self, start, end, telescopes=None, sites=None, instrument_types=None):
-        try:
-            self.es = Elasticsearch([settings.ELASTICSEARCH_URL])
-        except LocationValueError:
-            logger.error('Could not find host. Make sure ELASTICSEARCH_URL is set.')
-            raise ImproperlyConfigured('ELASTICSEARCH_URL')
-
+        self.es = get_es_client()
         self.instrument_types = instrument_types
-        self.available_telescopes = self._get_available_telescopes()
+        self.available_telescopes = set(self._get_available_telescopes())
 
-        sites = list({tk.site for tk in self.available_telescopes}) if not sites else sites
-        telescopes = list({tk.telescope for tk in self.available_telescopes if tk.site in sites}) \
+        self.sites = sorted({tk.site for tk in self.available_telescopes}) if not sites else sites
+        self.telescopes = sorted({tk.telescope for tk in self.available_telescopes if tk.site in self.sites}) \
             if not telescopes else telescopes
 
         self.start = start.replace(tzinfo=timezone.utc).replace(microsecond=0)
         self.end = end.replace(tzinfo=timezone.utc).replace(microsecond=0)
-        self.event_data = self._get_es_data(sites, telescopes)
 
     def _get_available_telescopes(self):
         telescope_to_instruments = configdb.get_instrument_types_per_telescope(only_schedulable=True)
@@ -51,17 +104,16 @@ class TelescopeStates(object):
                                     any(inst in insts for inst in self.instrument_types)]
         return available_telescopes
 
-    def _get_es_data(self, sites, telescopes):
-        date_range_query = {
+    def _get_es_query(self, sites, telescopes, start, end):
+        return {
             "query": {
                 "bool": {
                     "filter": [
                         {
                             "range": {
                                 "timestamp": {
-                                    # Retrieve documents 1 hour back to capture the telescope state at the start.
-                                    "gte": (self.start - timedelta(hours=1)).strftime(ES_STRING_FORMATTER),
-                                    "lte": self.end.strftime(ES_STRING_FORMATTER),
+                                    "gte": start.strftime(ES_STRING_FORMATTER),
+                                    "lte": end.strftime(ES_STRING_FORMATTER),
                                     "format": "yyyy-MM-dd HH:mm:ss"
                                 }
                             }
@@ -80,34 +132,45 @@ class TelescopeStates(object):
                 }
             }
         }
-        event_data = []
-        query_size = 10000
 
+    def _get_es_data(self, sites, telescopes, start, end):
+        ''' Generates the telescope events of the sites and telescopes between the start and end times in the order
+            they are lumped in, fetching them a scroll page at a time
+        '''
         try:
             data = self.es.search(
-                index="telescope_events", body=date_range_query, size=query_size, scroll='1m',  # noqa
-                _source=['timestamp', 'telescope', 'enclosure', 'site', 'type', 'reason'],
+                index="telescope_events", body=self._get_es_query(sites, telescopes, start, end), size=ES_QUERY_SIZE,
+                scroll='1m', _source=['timestamp', 'telescope', 'enclosure', 'site', 'type', 'reason'],
                 sort=['site', 'enclosure', 'telescope', 'timestamp']
             )
         except ConnectionError:
             raise ElasticSearchException
 
-        event_data.extend(data['hits']['hits'])
-        total_events = data['hits']['total']
-        events_read = min(query_size, total_events)
-        scroll_id = data.get('_scroll_id', 0)
-        while events_read < total_events:
-            data = self.es.scroll(scroll_id=scroll_id, scroll='1m') # noqa
-            scroll_id = data.get('_scroll_id', 0)
-            event_data.extend(data['hits']['hits'])
-            events_read += len(data['hits']['hits'])
-        return event_data
-
-    def _belongs_in_lump(self, event_source, lump_data, dt=60):
-        if str(lump_data['telescope']) != str(self._telescope(event_source)):
+        scroll_id = data.get('_scroll_id')
+        try:
+            total_events = data['hits']['total']
+            events_read = len(data['hits']['hits'])
+            yield from data['hits']['hits']
+            while data['hits']['hits'] and events_read < total_events:
+                data = self.es.scroll(scroll_id=scroll_id, scroll='1m')
+                scroll_id = data.get('_scroll_id', scroll_id)
+                events_read += len(data['hits']['hits'])
+                yield from data['hits']['hits']
+        except ConnectionError:
+            raise ElasticSearchException
+        finally:
+            if scroll_id:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    # the scroll will still expire on its own
+                    pass
+
+    def _belongs_in_lump(self, event_source, telescope, timestamp, lump_data, dt=60):
+        if telescope != lump_data['telescope']:
             return False
 
-        time_diff = (string_to_datetime(event_source['timestamp']) - lump_data['latest_timestamp']).total_seconds()
+        time_diff = (timestamp - lump_data['latest_timestamp']).total_seconds()
 
         # If the event is close enough to the latest timestamp in the lump, it belongs in that lump.
         if time_diff < dt:
@@ -136,49 +199,171 @@ class TelescopeStates(object):
                 break
         return event_type, event_reason
 
-    def _lump_end(self, lump, next_event=None):
-        if not next_event or str(lump['telescope']) != str(self._telescope(next_event)):
+    def _lump_end(self, lump, next_telescope=None, next_timestamp=None):
+        if next_telescope is None or lump['telescope'] != next_telescope:
             return self.end
-        return string_to_datetime(next_event['timestamp'])
+        return next_timestamp
 
-    def _set_lump(self, event):
+    @staticmethod
+    def _set_lump(event_source, telescope, timestamp):
         return {
-            'reasons': [event['_source']['reason']],
-            'types': [event['_source']['type']],
-            'start': string_to_datetime(event['_source']['timestamp']),
-            'telescope': self._telescope(event['_source']),
-            'latest_timestamp': string_to_datetime(event['_source']['timestamp'])
+            'reasons': [event_source['reason']],
+            'types': [event_source['type']],
+            'start': timestamp,
+            'telescope': telescope,
+            'latest_timestamp': timestamp
         }
 
     @staticmethod
-    def _update_lump(lump, event):
-        if event['_source']['type'] not in lump['types'] or event['_source']['reason'] not in lump['reasons']:
-            lump['reasons'].append(event['_source']['reason'])
-            lump['types'].append(event['_source']['type'])
-        lump['latest_timestamp'] = string_to_datetime(event['_source']['timestamp'])
+    def _update_lump(lump, event_source, timestamp):
+        if event_source['type'] not in lump['types'] or event_source['reason'] not in lump['reasons']:
+            lump['reasons'].append(event_source['reason'])
+            lump['types'].append(event_source['type'])
+        lump['latest_timestamp'] = timestamp
         return lump
 
     def get(self):
         telescope_states = {}
-        current_lump = dict(reasons=None, types=None, start=None)
+        if len(self.sites) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(self.sites), ES_PARALLEL_SCROLLS)) as executor:
+                for site_states in executor.map(self._get_site_states, self.sites):
+                    telescope_states.update(site_states)
+        elif self.sites:
+            telescope_states = self._get_site_states(self.sites[0])
+        return telescope_states
+
+    def _get_site_states(self, site):
+        return self.lump_events(self._get_site_events(site))
+
+    def _get_site_events(self, site):
+        ''' Generates the telescope events of a site in the order they are lumped in, reading the hours that are over
+            from the cache and scrolling through the rest of them from the first hour missing from the cache on
+        '''
+        telescopes = sorted(tk for tk in self.available_telescopes
+                            if tk.site == site and tk.telescope in self.telescopes)
+        if not telescopes:
+            return
+        # Retrieve events 1 hour back to capture the telescope state at the start.
+        query_start = self.start - timedelta(hours=1)
+        buckets = []
+        bucket = query_start.replace(minute=0, second=0)
+        while bucket <= self.end and bucket + TELESCOPE_EVENTS_BUCKET <= timezone.now() - TELESCOPE_EVENTS_CACHE_DELAY:
+            buckets.append(_bucket_id(bucket))
+            bucket += TELESCOPE_EVENTS_BUCKET
+        bucket_keys = {(tk, bucket_id): _bucket_key(tk, bucket_id) for tk in telescopes for bucket_id in buckets}
+        cached = cache.get_many(list(bucket_keys.values()))
+        missing = [bucket_id for bucket_id in buckets if any(bucket_keys[(tk, bucket_id)] not in cached
+                                                             for tk in telescopes)]
+
+        lock_key = None
+        if missing:
+            lock_key = 'telescope_events_lock.{}.{}.{}'.format(site, missing[0], missing[-1]).replace(' ', 'T')
+            if not cache.add(lock_key, True, TELESCOPE_EVENTS_LOCK_TIMEOUT):
+                # another request is scrolling through these events, so wait for it to cache them
+                cached = self._wait_for_buckets(lock_key, bucket_keys)
+                missing = [bucket_id for bucket_id in missing if any(bucket_keys[(tk, bucket_id)] not in cached
+                                                                     for tk in telescopes)]
+                lock_key = None
+        fetch_end = self.end
+        if missing:
+            # whole buckets are fetched so they can be cached
+            fetch_start = string_to_datetime(missing[0], '%Y-%m-%d %H')
+            fetch_end = max(self.end, string_to_datetime(missing[-1], '%Y-%m-%d %H') + TELESCOPE_EVENTS_BUCKET)
+        elif buckets:
+            fetch_start = string_to_datetime(buckets[-1], '%Y-%m-%d %H') + TELESCOPE_EVENTS_BUCKET
+        else:
+            fetch_start = query_start
+        fetch_buckets = [bucket_id for bucket_id in buckets if bucket_id >= _bucket_id(fetch_start)]
+        start_timestamp = query_start.strftime(ES_STRING_FORMATTER)
+        fetch_timestamp = fetch_start.strftime(ES_STRING_FORMATTER)
+        end_timestamp = self.end.strftime(ES_STRING_FORMATTER)
+
+        try:
+            fetched = groupby(self._get_es_data([site], self.telescopes, fetch_start, fetch_end)
+                              if fetch_start <= self.end else [],
+                              key=lambda event: self._telescope(event['_source']))
+            fetched_telescope, fetched_events = next(fetched, (None, None))
+            for telescope in telescopes:
+                for bucket_id in buckets:
+                    if bucket_id >= _bucket_id(fetch_start):
+                        break
+                    for timestamp, event_type, reason in cached[bucket_keys[(telescope, bucket_id)]]:
+                        if start_timestamp <= timestamp <= end_timestamp:
+                            yield self._event(telescope, timestamp, event_type, reason)
+                while fetched_telescope is not None and fetched_telescope < telescope:
+                    fetched_telescope, fetched_events = next(fetched, (None, None))
+                # a telescope with no events fetched leaves the group of the next one in place for it
+                telescope_events = fetched_events if fetched_telescope == telescope else []
+                yield from self._cache_fetched_events(telescope, telescope_events, fetch_buckets,
+                                                      max(start_timestamp, fetch_timestamp), end_timestamp)
+        finally:
+            if lock_key:
+                cache.delete(lock_key)
+
+    @staticmethod
+    def _wait_for_buckets(lock_key, bucket_keys):
+        deadline = time.time() + TELESCOPE_EVENTS_LOCK_TIMEOUT
+        while time.time() < deadline and cache.get(lock_key):
+            time.sleep(TELESCOPE_EVENTS_LOCK_POLL)
+        return cache.get_many(list(bucket_keys.values()))
+
+    def _cache_fetched_events(self, telescope, events, bucket_ids, start_timestamp, end_timestamp):
+        ''' Generates the fetched events of a telescope between the timestamps, caching those in the buckets given,
+            whether or not there were any events in them
+        '''
+        bucket_ids = set(bucket_ids)
+        to_cache = {}
+        for event in events:
+            event_source = event['_source']
+            timestamp = event_source['timestamp']
+            bucket_id = timestamp[:13]
+            if bucket_id in bucket_ids:
+                if bucket_id not in to_cache and len(to_cache) >= TELESCOPE_EVENTS_CACHE_BATCH:
+                    # the events are in time order, so the buckets already seen are complete
+                    self._cache_buckets(telescope, to_cache)
+                    bucket_ids.difference_update(to_cache)
+                    to_cache = {}
+                to_cache.setdefault(bucket_id, []).append((timestamp, event_source['type'], event_source['reason']))
+            if start_timestamp <= timestamp <= end_timestamp:
+                yield event
+        to_cache.update({bucket_id: [] for bucket_id in bucket_ids if bucket_id not in to_cache})
+        self._cache_buckets(telescope, to_cache)
+
+    @staticmethod
+    def _cache_buckets(telescope, buckets):
+        cache.set_many({_bucket_key(telescope, bucket_id): events for bucket_id, events in buckets.items()},
+                       TELESCOPE_EVENTS_CACHE_TIMEOUT)
 
-        for event in self.event_data:
-            if self._telescope(event['_source']) not in self.available_telescopes:
+    @staticmethod
+    def _event(telescope, timestamp, event_type, reason):
+        return {'_source': {'timestamp': timestamp, 'site': telescope.site, 'enclosure': telescope.observatory,
+                            'telescope': telescope.telescope, 'type': event_type, 'reason': reason}}
+
+    def lump_events(self, events):
+        ''' Lumps an iterable of telescope events, ordered by telescope then timestamp, into telescope states '''
+        telescope_states = {}
+        current_lump = None
+
+        for event in events:
+            event_source = event['_source']
+            telescope = self._telescope(event_source)
+            if telescope not in self.available_telescopes:
                 continue
+            timestamp = string_to_datetime(event_source['timestamp'])
 
-            if current_lump['start'] is None:
-                current_lump = self._set_lump(event)
+            if current_lump is None:
+                current_lump = self._set_lump(event_source, telescope, timestamp)
                 continue
 
-            if self._belongs_in_lump(event['_source'], current_lump):
-                current_lump = self._update_lump(current_lump, event)
+            if self._belongs_in_lump(event_source, telescope, timestamp, current_lump):
+                current_lump = self._update_lump(current_lump, event_source, timestamp)
             else:
-                lump_end = self._lump_end(current_lump, event['_source'])
+                lump_end = self._lump_end(current_lump, telescope, timestamp)
                 if lump_end >= self.start:
                     telescope_states = self._update_states(telescope_states, current_lump, lump_end)
-                    current_lump = self._set_lump(event)
+                    current_lump = self._set_lump(event_source, telescope, timestamp)
 
-        if current_lump['start']:
+        if current_lump is not None:
             lump_end = self._lump_end(current_lump)
             telescope_states = self._update_states(telescope_states, current_lump, lump_end)
 
@@ -210,48 +395,27 @@ class TelescopeStates(object):
 
 
 def filter_telescope_states_by_intervals(telescope_states, sites_intervals, start, end):
+    '''
+    Clips the telescope states to the parts of them that fall within the site intervals and the start and end times.
+    The states of each telescope and the intervals of each site are swept through together, so each state is only
+    compared with the intervals around it.
+    '''
     filtered_states = {}
     for telescope_key, events in telescope_states.items():
         # now loop through the events for the telescope, and tally the time the telescope is available for each 'day'
         if telescope_key.site in sites_intervals:
-            site_intervals = sites_intervals[telescope_key.site]
-            filtered_events = []
-
-            for event in events:
-                event_start = max(event['start'], start)
-                event_end = min(event['end'], end)
-                for interval in site_intervals:
-                    if event_start >= interval[0] and event_end <= interval[1]:
-                        # the event is fully contained to add it and break out
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = event_start
-                        extra_event['end'] = event_end
-                        filtered_events.append(deepcopy(event))
-                    elif event_start < interval[0] and event_end > interval[1]:
-                        # start is before interval and end is after, so it spans the interval
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = interval[0]
-                        extra_event['end'] = interval[1]
-                        filtered_events.append(deepcopy(extra_event))
-                    elif event_start < interval[0] and event_end > interval[0] and event_end <= interval[1]:
-                        # start is before interval and end is in interval, so truncate start
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = interval[0]
-                        extra_event['end'] = event_end
-                        filtered_events.append(deepcopy(extra_event))
-                    elif event_start >= interval[0] and event_start < interval[1] and event_end > interval[1]:
-                        # start is within interval and end is after, so truncate end
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = event_start
-                        extra_event['end'] = interval[1]
-                        filtered_events.append(deepcopy(extra_event))
-
-            filtered_states[telescope_key] = filtered_events
+            spans = ((max(event['start'], start), min(event['end'], end), event)
+                     for event in sorted(events, key=lambda e: e['start']))
+            filtered_states[telescope_key] = [
+                dict(event, start=clipped_start, end=clipped_end) for event, clipped_start, clipped_end in
+                intersect_sorted_intervals(spans, sorted(sites_intervals[telescope_key.site]))
+            ]
 
     return filtered_states
 
 
-def get_telescope_availability_per_day(start, end, telescopes=None, sites=None, instrument_types=None):
+def get_telescope_availability_per_night(start, end, telescopes=None, sites=None, instrument_types=None):
+    ''' Returns the NightAvailability of each telescope for each observing night between the start and end times '''
     telescope_states = TelescopeStates(start, end, telescopes, sites, instrument_types).get()
     # go through each telescopes list of states, grouping it up by observing night at the site
     rise_set_intervals = {}
@@ -262,24 +426,27 @@ def get_telescope_availability_per_day(start, end, telescopes=None, sites=None,
                                                                                  end + timedelta(days=1),
                                                                                  telescope_key.site)[1:]
     telescope_states = filter_telescope_states_by_intervals(telescope_states, rise_set_intervals, start, end)
-    # now just compute a % available each day from the rise_set filtered set of events
-    telescope_availability = {}
+    # now just tally the time available each night from the rise_set filtered set of events
+    telescope_nights = {}
     for telescope_key, events in telescope_states.items():
-        telescope_availability[telescope_key] = []
+        telescope_nights[telescope_key] = []
         time_available = timedelta(seconds=0)
         time_total = timedelta(seconds=0)
         if events:
             current_day = list(events)[0]['start'].date()
-            current_end = list(events)[0]['start']
+            current_start = current_end = list(events)[0]['start']
         for event in events:
             if (event['start'] - current_end) > timedelta(hours=4):
                 if (event['start'].date() != current_day):
                     # we must be in a new observing day, so tally time in previous day and increment day counter
-                    telescope_availability[telescope_key].append([current_day, (
-                        time_available.total_seconds() / time_total.total_seconds())])
+                    telescope_nights[telescope_key].append(NightAvailability(
+                        current_day, current_start, current_end, time_available.total_seconds(),
+                        time_total.total_seconds()
+                    ))
                 time_available = timedelta(seconds=0)
                 time_total = timedelta(seconds=0)
                 current_day = event['start'].date()
+                current_start = event['start']
 
             if 'AVAILABLE' == event['event_type'].upper():
                 time_available += event['end'] - event['start']
@@ -287,10 +454,20 @@ def get_telescope_availability_per_day(start, end, telescopes=None, sites=None,
             current_end = event['end']
 
         if time_total > timedelta():
-            telescope_availability[telescope_key].append([current_day, (
-                time_available.total_seconds() / time_total.total_seconds())])
+            telescope_nights[telescope_key].append(NightAvailability(
+                current_day, current_start, current_end, time_available.total_seconds(), time_total.total_seconds()
+            ))
+
+    return telescope_nights
 
-    return telescope_availability
+
+def get_telescope_availability_per_day(start, end, telescopes=None, sites=None, instrument_types=None):
+    telescope_nights = get_telescope_availability_per_night(start, end, telescopes, sites, instrument_types)
+    # now just compute a % available each day from the nightly tallies
+    return {
+        telescope_key: [[night.night, night.available / night.total] for night in nights]
+        for telescope_key, nights in telescope_nights.items()
+    }
 
 
 def combine_telescope_availabilities_by_site_and_class(telescope_availabilities):
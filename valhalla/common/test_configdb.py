@@ -0,0 +1,125 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.conf import settings
+from unittest.mock import patch
+import responses
+import time
+
+from valhalla.common.configdb import configdb, ConfigDBSnapshot, ConfigDBException, TelescopeKey
+from valhalla.common.test_helpers import ConfigDBTestMixin
+from valhalla.common.tiered_cache import clear_local_caches
+
+
+class TestConfigDBSnapshot(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.snapshot = configdb.get_snapshot()
+        self.tk1 = TelescopeKey('tst', 'doma', '1m0a')
+        self.tk2 = TelescopeKey('tst', 'domb', '1m0a')
+
+    def test_site_data_is_walked_once(self):
+        with patch.object(ConfigDBSnapshot, '_add_instrument') as mock_add:
+            ConfigDBSnapshot(configdb.get_site_data())
+        self.assertEqual(mock_add.call_count, 5)
+
+    def test_instrument_types_per_telescope(self):
+        instrument_types = self.snapshot.instrument_types_per_telescope[True]
+        self.assertEqual(instrument_types[self.tk1], ['1M0-SCICAM-SBIG', '2M0-FLOYDS-SCICAM'])
+        self.assertEqual(instrument_types[self.tk2], ['1M0-SCICAM-SBIG', '1M0-NRES-SCICAM', '2M0-FLOYDS-SCICAM'])
+
+    def test_camera_type_lookup_is_case_insensitive(self):
+        self.assertEqual(self.snapshot.get_camera_type('1m0-scicam-sbig')['code'], '1M0-SCICAM-SBIG')
+        self.assertIsNone(self.snapshot.get_camera_type('1M0-FAKE-SCICAM'))
+
+    def test_telescope_details_filtered_by_location(self):
+        details = self.snapshot.get_telescope_details(instrument_type='1M0-NRES-SCICAM')
+        self.assertEqual(list(details.keys()), ['1m0a.domb.tst'])
+        details = self.snapshot.get_telescope_details(observatory_code='doma')
+        self.assertEqual(list(details.keys()), ['1m0a.doma.tst'])
+        self.assertEqual(details['1m0a.doma.tst']['altitude'], 100)
+
+    def test_active_instrument_types_by_location(self):
+        self.assertEqual(self.snapshot.get_active_instrument_types({'observatory': 'doma'}),
+                         {'1M0-SCICAM-SBIG', '2M0-FLOYDS-SCICAM'})
+        self.assertEqual(self.snapshot.get_active_instrument_types({}),
+                         {'1M0-SCICAM-SBIG', '1M0-NRES-SCICAM', '2M0-FLOYDS-SCICAM'})
+
+    def test_configdb_lookups_use_snapshot(self):
+        self.assertEqual(configdb.get_filters('2M0-FLOYDS-SCICAM'),
+                         {'slit_6.0as', 'slit_1.6as', 'slit_2.0as', 'slit_1.2as'})
+        self.assertEqual(configdb.get_binnings('1M0-SCICAM-SBIG'), {1, 2, 3})
+        self.assertEqual(configdb.get_default_binning('1M0-SCICAM-SBIG'), 2)
+        self.assertEqual(configdb.get_exposure_overhead('1M0-SCICAM-SBIG', 1), 36.0)
+        self.assertEqual(configdb.get_telescopes_per_instrument_type('1M0-NRES-SCICAM'), {self.tk2})
+
+    def test_unknown_instrument_type_raises(self):
+        with self.assertRaises(ConfigDBException):
+            configdb.get_request_overheads('1M0-FAKE-SCICAM')
+
+
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default-test'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'locmem-test'}
+    },
+    CONFIGDB_BACKGROUND_REFRESH=False
+)
+class TestConfigDBCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        clear_local_caches()
+        self.url = settings.CONFIGDB_URL + '/sites/'
+        self.stale_entry = {'data': [{'code': 'old'}], 'etag': '"abc"', 'last_modified': '', 'fetched': 0}
+
+    @responses.activate
+    def test_fetches_when_nothing_cached(self):
+        responses.add(responses.GET, self.url, json={'results': [{'code': 'new'}]}, status=200)
+        self.assertEqual(configdb.get_site_data(), [{'code': 'new'}])
+        self.assertEqual(cache.get('configdb.sites')['data'], [{'code': 'new'}])
+
+    @responses.activate
+    def test_fresh_data_does_not_refetch(self):
+        cache.set('configdb.sites', dict(self.stale_entry, fetched=time.time()), None)
+        self.assertEqual(configdb.get_site_data(), [{'code': 'old'}])
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_stale_data_refreshed_with_validators(self):
+        cache.set('configdb.sites', self.stale_entry, None)
+        responses.add(responses.GET, self.url, status=304, headers={'ETag': '"abc"'})
+        self.assertEqual(configdb.get_site_data(), [{'code': 'old'}])
+        self.assertEqual(responses.calls[0].request.headers['If-None-Match'], '"abc"')
+        self.assertGreater(cache.get('configdb.sites')['fetched'], 0)
+        self.assertIsNone(cache.get('configdb.sites.lock'))
+
+    @responses.activate
+    def test_stale_data_served_while_refresh_locked(self):
+        cache.set('configdb.sites', self.stale_entry, None)
+        cache.set('configdb.sites.lock', True)
+        self.assertEqual(configdb.get_site_data(), [{'code': 'old'}])
+        self.assertEqual(len(responses.calls), 0)
+
+    @responses.activate
+    def test_last_known_good_kept_when_configdb_down(self):
+        cache.set('configdb.sites', self.stale_entry, None)
+        responses.add(responses.GET, self.url, status=500)
+        self.assertEqual(configdb.get_site_data(), [{'code': 'old'}])
+        self.assertEqual(cache.get('configdb.sites')['fetched'], 0)
+
+    @responses.activate
+    def test_failed_refresh_is_not_retried_straight_away(self):
+        cache.set('configdb.sites', self.stale_entry, None)
+        responses.add(responses.GET, self.url, status=500)
+        configdb.get_site_data()
+        self.assertTrue(cache.get('configdb.sites.lock'))
+
+        clear_local_caches()
+        configdb.get_site_data()
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_configdb_down_with_nothing_cached_raises(self):
+        responses.add(responses.GET, self.url, status=500)
+        with self.assertRaises(ConfigDBException):
+            configdb.get_site_data()
@@ -0,0 +1,117 @@
+from valhalla.common.downtimedb import DowntimeDB, DowntimeDBException, DowntimeIndex
+from valhalla.common.downtimedb import downtime_cache, _missing_index_fetch
+from valhalla.common.tiered_cache import clear_local_caches
+from valhalla.common.intervals import IntervalSet
+
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import datetime
+from unittest.mock import patch
+
+# the downtime is stored in the shared cache, and each process checks its version
+DOWNTIME_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'downtime'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+}
+
+
+def downtime(start, end, telescope='1m0a', observatory='doma', site='tst'):
+    return {'start': start, 'end': end, 'site': site, 'observatory': observatory, 'telescope': telescope,
+            'reason': 'Whatever'}
+
+
+class TestDowntimeIndex(TestCase):
+    def setUp(self):
+        self.data = [downtime('2016-09-01T22:00:00Z', '2016-09-03T00:00:00Z'),
+                     downtime('2016-10-01T22:00:00Z', '2016-10-02T00:00:00Z'),
+                     downtime('2016-10-05T22:00:00Z', '2016-10-06T00:00:00Z'),
+                     downtime('2016-10-01T22:00:00Z', '2016-10-03T00:00:00Z', observatory='domb')]
+
+    def test_only_downtime_overlapping_the_intervals_is_looked_up(self):
+        downtime_index = DowntimeDB._build_downtime_index(self.data, DowntimeIndex())
+        intervalset = IntervalSet.from_tuple_list([(datetime(2016, 10, 1, tzinfo=timezone.utc),
+                                                    datetime(2016, 10, 4, tzinfo=timezone.utc))])
+
+        self.assertEqual(downtime_index.get_overlapping('1m0a.doma.tst', intervalset).to_tuple_list(),
+                         [(datetime(2016, 10, 1, 22, tzinfo=timezone.utc), datetime(2016, 10, 2, tzinfo=timezone.utc))])
+        self.assertEqual(len(downtime_index.get_overlapping('1m0a.doma.non', intervalset)), 0)
+
+    def test_generation_only_changes_with_the_downtime(self):
+        downtime_index = DowntimeDB._build_downtime_index(self.data, DowntimeIndex())
+        unchanged_index = DowntimeDB._build_downtime_index(list(self.data), downtime_index)
+        changed_index = DowntimeDB._build_downtime_index(self.data[1:], downtime_index)
+
+        self.assertIs(unchanged_index, downtime_index)
+        self.assertEqual(changed_index.generation, downtime_index.generation + 1)
+        self.assertNotIn('1m0a.domb.tst', DowntimeDB._build_downtime_index(self.data[:3], changed_index))
+
+
+@override_settings(CACHES=DOWNTIME_CACHES)
+@patch('valhalla.common.downtimedb.DowntimeDB._get_downtime_data')
+class TestStoredDowntime(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_caches()
+        _missing_index_fetch.update(thread=None, started=None)
+        self.addCleanup(setattr, downtime_cache, 'timeout', downtime_cache.timeout)
+        self.data = [downtime('2016-10-01T22:00:00Z', '2016-10-02T00:00:00Z'),
+                     downtime('2016-10-01T22:00:00Z', '2016-10-03T00:00:00Z', observatory='domb')]
+
+    def test_requests_read_the_stored_downtime_without_fetching_it(self, downtime_data):
+        downtime_data.return_value = self.data
+        stored_index = DowntimeDB.update_downtime_index()
+        downtime_data.reset_mock()
+
+        downtime_index = DowntimeDB.get_downtime_index()
+        self.assertEqual(downtime_index.digest, stored_index.digest)
+        self.assertIn('1m0a.domb.tst', downtime_index)
+        downtime_data.assert_not_called()
+
+    def test_requests_see_changed_downtime(self, downtime_data):
+        downtime_data.return_value = self.data
+        DowntimeDB.update_downtime_index()
+        generation = DowntimeDB.get_downtime_index().generation
+
+        downtime_data.return_value = self.data[:1]
+        DowntimeDB.update_downtime_index()
+        downtime_index = DowntimeDB.get_downtime_index()
+        self.assertEqual(downtime_index.generation, generation + 1)
+        self.assertNotIn('1m0a.domb.tst', downtime_index)
+
+    def test_last_stored_downtime_is_kept_when_downtimedb_is_down(self, downtime_data):
+        downtime_data.return_value = self.data
+        stored_index = DowntimeDB.update_downtime_index()
+
+        downtime_data.side_effect = DowntimeDBException('down')
+        with self.assertRaises(DowntimeDBException):
+            DowntimeDB.update_downtime_index()
+        self.assertEqual(DowntimeDB.get_downtime_index().digest, stored_index.digest)
+
+    def test_downtime_is_fetched_in_the_background_when_none_is_stored(self, downtime_data):
+        downtime_data.return_value = self.data
+        self.assertNotIn('1m0a.domb.tst', DowntimeDB.get_downtime_index())
+        _missing_index_fetch['thread'].join()
+
+        self.assertIn('1m0a.domb.tst', DowntimeDB.get_downtime_index())
+        downtime_data.assert_called_once_with()
+
+    def test_last_known_downtime_is_used_when_none_is_stored_and_downtimedb_is_down(self, downtime_data):
+        downtime_data.return_value = self.data
+        downtime_cache.timeout = 0
+        stored_index = DowntimeDB.update_downtime_index()
+        cache.clear()
+
+        downtime_data.side_effect = DowntimeDBException('down')
+        self.assertIs(DowntimeDB.get_downtime_index(), stored_index)
+        _missing_index_fetch['thread'].join()
+        self.assertIs(DowntimeDB.get_downtime_index(), stored_index)
+
+    def test_generation_carries_on_when_the_stored_downtime_is_lost(self, downtime_data):
+        downtime_data.return_value = self.data
+        downtime_cache.timeout = 0
+        generation = DowntimeDB.update_downtime_index().generation
+        cache.clear()
+
+        downtime_data.return_value = self.data[:1]
+        self.assertEqual(DowntimeDB.update_downtime_index().generation, generation + 1)
@@ -7,6 +7,7 @@ import responses
 import json
 import os
 
+from valhalla.common.tiered_cache import clear_local_caches
 from valhalla.userrequests.models import UserRequest, Request, Window, Molecule, Constraints, Target, Location
 
 CONFIGDB_TEST_FILE = os.path.join(settings.BASE_DIR, 'valhalla/common/test_data/configdb.json')
@@ -16,6 +17,8 @@ FILTERWHEELS_FILE = os.path.join(settings.BASE_DIR, 'valhalla/common/test_data/f
 class ConfigDBTestMixin(object):
     '''Mixin class to mock configdb calls'''
     def setUp(self):
+        # configdb data kept in process by an earlier test would hide these responses
+        clear_local_caches()
         responses._default_mock.__enter__()
         responses.add(
             responses.GET, settings.CONFIGDB_URL + '/sites/',
@@ -25,6 +28,7 @@ class ConfigDBTestMixin(object):
             responses.GET, settings.CONFIGDB_URL + '/filterwheels/',
             json=json.loads(open(FILTERWHEELS_FILE).read()), status=200
         )
+        responses.add(responses.GET, settings.DOWNTIMEDB_URL, json=[], status=200)
         super().setUp()
 
     def tearDown(self):
@@ -0,0 +1,97 @@
+from valhalla.common.intervals import IntervalSet, intersect_sorted_intervals
+
+from django.test import TestCase
+from django.utils import timezone
+from datetime import datetime, timedelta
+from time_intervals.intervals import Intervals
+import random
+
+
+class TestIntersectSortedIntervals(TestCase):
+    def test_spans_are_clipped_to_each_interval_they_overlap(self):
+        spans = [(0, 10, 'a'), (12, 30, 'b')]
+        intervals = [(2, 4), (6, 14), (20, 25), (40, 50)]
+
+        self.assertEqual(list(intersect_sorted_intervals(spans, intervals)),
+                         [('a', 2, 4), ('a', 6, 10), ('b', 12, 14), ('b', 20, 25)])
+
+    def test_instantaneous_spans_are_kept_only_within_an_interval(self):
+        spans = [(1, 1, 'before'), (3, 3, 'within'), (4, 4, 'edge'), (6, 6, 'between')]
+        intervals = [(2, 4), (8, 9)]
+
+        self.assertEqual(list(intersect_sorted_intervals(spans, intervals)),
+                         [('within', 3, 3), ('edge', 4, 4)])
+
+    def test_spans_that_end_before_they_start_are_dropped(self):
+        self.assertEqual(list(intersect_sorted_intervals([(5, 3, 'a'), (6, 8, 'b')], [(0, 10)])), [('b', 6, 8)])
+
+    def test_intervals_can_be_any_iterable(self):
+        spans = [(0, 5, 'a'), (5, 10, 'b')]
+
+        self.assertEqual(list(intersect_sorted_intervals(spans, iter([(3, 7)]))), [('a', 3, 5), ('b', 5, 7)])
+
+
+class TestIntervalSet(TestCase):
+    def setUp(self):
+        self.start = datetime(2016, 10, 1, tzinfo=timezone.utc)
+
+    def hours(self, *intervals):
+        return [(self.start + timedelta(hours=start), self.start + timedelta(hours=end)) for start, end in intervals]
+
+    def test_overlapping_and_touching_intervals_are_merged(self):
+        interval_set = IntervalSet.from_tuple_list(self.hours((5, 6), (0, 2), (1, 3), (3, 4), (7, 7)))
+
+        self.assertEqual(interval_set.to_tuple_list(), self.hours((0, 4), (5, 6)))
+
+    def test_datetimes_come_back_unchanged(self):
+        intervals = [(datetime(2016, 10, 1, 19, 13, 14, 944205, tzinfo=timezone.utc),
+                      datetime(2016, 10, 2, 3, 19, 9, 181040, tzinfo=timezone.utc))]
+        naive_intervals = [(start.replace(tzinfo=None), end.replace(tzinfo=None)) for start, end in intervals]
+
+        self.assertEqual(IntervalSet.from_tuple_list(intervals).to_tuple_list(), intervals)
+        self.assertEqual(IntervalSet.from_tuple_list(naive_intervals).to_tuple_list(), naive_intervals)
+
+    def test_set_operations(self):
+        interval_set = IntervalSet.from_tuple_list(self.hours((0, 4), (6, 10)))
+        other = IntervalSet.from_tuple_list(self.hours((2, 7), (9, 12)))
+
+        self.assertEqual(interval_set.union(other).to_tuple_list(), self.hours((0, 12)))
+        self.assertEqual(interval_set.intersection(other).to_tuple_list(), self.hours((2, 4), (6, 7), (9, 10)))
+        self.assertEqual(interval_set.subtract(other).to_tuple_list(), self.hours((0, 2), (7, 9)))
+        self.assertEqual(interval_set.clip(*self.hours((1, 8))[0]).to_tuple_list(), self.hours((1, 4), (6, 8)))
+        self.assertEqual(interval_set.largest_interval(), timedelta(hours=4))
+        self.assertEqual(interval_set.largest_gap(), timedelta(hours=2))
+
+    def test_overlapping_intervals_are_sliced_out(self):
+        interval_set = IntervalSet.from_tuple_list(self.hours((0, 1), (2, 3), (4, 5), (6, 7)))
+        other = IntervalSet.from_tuple_list(self.hours((3, 3.5), (4.5, 6)))
+
+        self.assertEqual(interval_set.overlapping(other).to_tuple_list(), self.hours((4, 5)))
+        self.assertEqual(len(interval_set.overlapping(IntervalSet())), 0)
+
+    def test_empty_sets(self):
+        interval_set = IntervalSet.from_tuple_list(self.hours((0, 4)))
+
+        self.assertEqual(IntervalSet().union(interval_set), interval_set)
+        self.assertEqual(interval_set.subtract(IntervalSet()), interval_set)
+        self.assertEqual(len(interval_set.intersection(IntervalSet())), 0)
+        self.assertEqual(IntervalSet().to_tuple_list(), [])
+        self.assertEqual(IntervalSet().largest_interval(), timedelta(seconds=0))
+
+    def test_matches_time_intervals(self):
+        random.seed(0)
+        for _ in range(50):
+            first, second = [
+                [(self.start + timedelta(minutes=start), self.start + timedelta(minutes=start + length))
+                 for start, length in ((random.randint(0, 1000), random.randint(0, 120)) for _ in range(20))]
+                for _ in range(2)
+            ]
+            first_set, second_set = IntervalSet.from_tuple_list(first), IntervalSet.from_tuple_list(second)
+            first_intervals, second_intervals = Intervals(first), Intervals(second)
+
+            self.assertEqual(first_set.union(second_set).to_tuple_list(),
+                             first_intervals.union([second_intervals]).toTupleList())
+            self.assertEqual(first_set.intersection(second_set).to_tuple_list(),
+                             first_intervals.intersect([second_intervals]).toTupleList())
+            self.assertEqual(first_set.subtract(second_set).to_tuple_list(),
+                             first_intervals.subtract(second_intervals).toTupleList())
@@ -0,0 +1,106 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache, caches
+from django.utils import timezone
+from unittest.mock import patch
+from datetime import datetime
+import copy
+
+from valhalla.common import rise_set_utils
+from valhalla.common.test_helpers import ConfigDBTestMixin
+from valhalla.common.tiered_cache import clear_local_caches
+
+SITE_DETAIL = {'latitude': -30.0, 'longitude': -70.0, 'horizon': 15.0, 'ha_limit_neg': -4.6, 'ha_limit_pos': 4.6}
+
+
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default-test'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'locmem-test'}
+    }
+)
+class TestSiteDarkIntervals(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        clear_local_caches()
+
+    def get_rise_set_dark_intervals(self, start, end):
+        rise_set_site = rise_set_utils.get_rise_set_site(SITE_DETAIL)
+        return rise_set_utils.get_rise_set_visibility(rise_set_site, start, end, SITE_DETAIL).get_dark_intervals()
+
+    def test_dark_intervals_match_rise_set_across_half_years(self):
+        start = datetime(2017, 6, 28, 3, tzinfo=timezone.utc)
+        end = datetime(2017, 7, 3, tzinfo=timezone.utc)
+        self.assertEqual(rise_set_utils.get_site_dark_intervals('tst', SITE_DETAIL, start, end),
+                         self.get_rise_set_dark_intervals(start, end))
+
+    def test_naive_datetimes_give_naive_intervals(self):
+        start = datetime(2017, 1, 5, 2)
+        end = datetime(2017, 1, 7)
+        self.assertEqual(rise_set_utils.get_site_dark_intervals('tst', SITE_DETAIL, start, end),
+                         self.get_rise_set_dark_intervals(start, end))
+
+    def test_dark_intervals_computed_once_per_half_year(self):
+        with patch.object(rise_set_utils, 'get_rise_set_visibility',
+                          wraps=rise_set_utils.get_rise_set_visibility) as mock_visibility:
+            rise_set_utils.get_site_dark_intervals('tst', SITE_DETAIL, datetime(2017, 2, 1, tzinfo=timezone.utc),
+                                                   datetime(2017, 2, 2, tzinfo=timezone.utc))
+            clear_local_caches()
+            rise_set_utils.get_site_dark_intervals('tst', SITE_DETAIL, datetime(2017, 3, 1, tzinfo=timezone.utc),
+                                                   datetime(2017, 3, 10, tzinfo=timezone.utc))
+        self.assertEqual(mock_visibility.call_count, 1)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    })
+    def test_dark_intervals_computed_once_per_half_year_without_a_shared_cache(self):
+        with patch.object(rise_set_utils, 'get_rise_set_visibility',
+                          wraps=rise_set_utils.get_rise_set_visibility) as mock_visibility:
+            for day in (1, 2, 3):
+                rise_set_utils.get_site_dark_intervals('tst', SITE_DETAIL, datetime(2017, 2, day, tzinfo=timezone.utc),
+                                                       datetime(2017, 2, day + 1, tzinfo=timezone.utc))
+        self.assertEqual(mock_visibility.call_count, 1)
+
+
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default-test'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'locmem-test'}
+    }
+)
+class TestRiseSetIntervalsCache(ConfigDBTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        caches['locmem'].clear()
+        self.request_dict = {
+            'target': {'name': 'fake target', 'type': 'SIDEREAL', 'ra': 83.6, 'dec': 22.0, 'proper_motion_ra': 0.0,
+                       'proper_motion_dec': 0.0, 'parallax': 0.0, 'epoch': 2000},
+            'constraints': {'max_airmass': 2.0, 'min_lunar_distance': 30.0},
+            'windows': [{'start': datetime(2016, 9, 3, tzinfo=timezone.utc),
+                         'end': datetime(2016, 9, 6, tzinfo=timezone.utc)}]
+        }
+
+    def test_cache_key_ignores_request_id_and_target_name(self):
+        other_dict = copy.deepcopy(self.request_dict)
+        other_dict['id'] = 5
+        other_dict['target']['name'] = 'another name'
+        self.assertEqual(rise_set_utils.get_rise_set_intervals_cache_key(self.request_dict, 'tst', SITE_DETAIL),
+                         rise_set_utils.get_rise_set_intervals_cache_key(other_dict, 'tst', SITE_DETAIL))
+
+    def test_cache_key_changes_with_window_or_site_parameters(self):
+        key = rise_set_utils.get_rise_set_intervals_cache_key(self.request_dict, 'tst', SITE_DETAIL)
+        other_dict = copy.deepcopy(self.request_dict)
+        other_dict['windows'][0]['end'] = datetime(2016, 9, 7, tzinfo=timezone.utc)
+        self.assertNotEqual(key, rise_set_utils.get_rise_set_intervals_cache_key(other_dict, 'tst', SITE_DETAIL))
+        self.assertNotEqual(key, rise_set_utils.get_rise_set_intervals_cache_key(
+            self.request_dict, 'tst', dict(SITE_DETAIL, horizon=20.0)
+        ))
+
+    def test_unsaved_requests_share_cached_intervals(self):
+        intervals = rise_set_utils.get_rise_set_intervals_by_site(self.request_dict)
+        with patch.object(rise_set_utils, 'get_rise_set_visibility') as mock_visibility:
+            self.assertEqual(rise_set_utils.get_rise_set_intervals_by_site(copy.deepcopy(self.request_dict)),
+                             intervals)
+        self.assertFalse(mock_visibility.called)
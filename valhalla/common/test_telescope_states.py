@@ -1,15 +1,22 @@
 from valhalla.common.telescope_states import (TelescopeStates, get_telescope_availability_per_day,
-                                              combine_telescope_availabilities_by_site_and_class)
+                                              combine_telescope_availabilities_by_site_and_class,
+                                              filter_telescope_states_by_intervals)
 from valhalla.common.configdb import TelescopeKey
 from valhalla.common.test_helpers import ConfigDBTestMixin
 from valhalla.common import rise_set_utils
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
 from datetime import datetime
 from django.utils import timezone
 from unittest.mock import patch
 import json
 
+TELESCOPE_EVENTS_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'telescope-events'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+}
+
 
 class TelescopeStatesFakeInput(ConfigDBTestMixin, TestCase):
     def setUp(self):
@@ -154,6 +161,70 @@ class TestTelescopeStates(TelescopeStatesFakeInput):
                                           }
         self.assertIn(domb_expected_available_state2, telescope_states[self.tk2])
 
+    def test_events_are_fetched_per_site(self):
+        self.mock_es.side_effect = lambda sites, telescopes, start, end: iter(
+            [event for event in self.es_output if event['_source']['site'] in sites]
+        )
+        start = datetime(2016, 10, 1)
+        end = datetime(2016, 10, 2)
+        telescope_states = TelescopeStates(start, end, sites=['tst', 'non']).get()
+
+        # there are no telescopes at the non site to fetch the events of
+        self.assertEqual([call[0][0] for call in self.mock_es.call_args_list], [['tst']])
+        self.assertEqual(telescope_states, TelescopeStates(start, end, sites=['tst']).get())
+
+    @override_settings(CACHES=TELESCOPE_EVENTS_CACHES)
+    def test_cached_hours_are_not_fetched_again(self):
+        cache.clear()
+        start = datetime(2016, 10, 1)
+        end = datetime(2016, 10, 2)
+        telescope_states = TelescopeStates(start, end).get()
+        self.assertEqual(self.mock_es.call_count, 1)
+
+        self.assertEqual(TelescopeStates(start, end).get(), telescope_states)
+        self.assertEqual(self.mock_es.call_count, 1)
+        self.assertEqual(TelescopeStates(datetime(2016, 10, 1, 19), end).get(),
+                         TelescopeStates(datetime(2016, 10, 1, 19), end).lump_events(self.es_output))
+        self.assertEqual(self.mock_es.call_count, 1)
+
+    @override_settings(CACHES=TELESCOPE_EVENTS_CACHES)
+    def test_only_hours_missing_from_the_cache_are_fetched(self):
+        cache.clear()
+        TelescopeStates(datetime(2016, 10, 1), datetime(2016, 10, 1, 19, 30)).get()
+        telescope_states = TelescopeStates(datetime(2016, 10, 1), datetime(2016, 10, 2)).get()
+
+        self.assertEqual(self.mock_es.call_args[0][2], datetime(2016, 10, 1, 20, tzinfo=timezone.utc))
+        self.assertEqual(telescope_states,
+                         TelescopeStates(datetime(2016, 10, 1), datetime(2016, 10, 2)).lump_events(self.es_output))
+
+    @override_settings(CACHES=TELESCOPE_EVENTS_CACHES)
+    def test_telescope_after_one_without_events_keeps_its_events(self):
+        cache.clear()
+        self.es_output = [event for event in self.es_output if event['_source']['enclosure'] == 'domb']
+        self.mock_es.return_value = self.es_output
+        start = datetime(2016, 10, 1)
+        end = datetime(2016, 10, 2)
+        expected_states = TelescopeStates(start, end).lump_events(self.es_output)
+
+        self.assertIn(self.tk2, expected_states)
+        self.assertEqual(TelescopeStates(start, end).get(), expected_states)
+        # and the hours of its events were not cached as empty
+        self.assertEqual(TelescopeStates(start, end).get(), expected_states)
+
+    def test_filter_clips_events_to_intervals_and_range(self):
+        start = datetime(2016, 10, 1, 19, tzinfo=timezone.utc)
+        end = datetime(2016, 10, 1, 20, 30, tzinfo=timezone.utc)
+        telescope_states = TelescopeStates(start, end).get()
+        intervals = {'tst': [(datetime(2016, 10, 1, 18, tzinfo=timezone.utc),
+                              datetime(2016, 10, 1, 20, tzinfo=timezone.utc))]}
+        filtered_states = filter_telescope_states_by_intervals(telescope_states, intervals, start, end)
+
+        self.assertEqual(filtered_states[self.tk1], [{'telescope': 'tst.doma.1m0a',
+                                                      'event_type': 'AVAILABLE',
+                                                      'event_reason': 'Available for scheduling',
+                                                      'start': datetime(2016, 10, 1, 19, tzinfo=timezone.utc),
+                                                      'end': datetime(2016, 10, 1, 20, tzinfo=timezone.utc)}])
+
     @patch('valhalla.common.telescope_states.get_site_rise_set_intervals')
     def test_telescope_availability_limits_interval(self, mock_intervals):
         mock_intervals.return_value = [(datetime(2016, 9, 30, 18, 30, 0, tzinfo=timezone.utc),
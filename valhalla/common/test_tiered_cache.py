@@ -0,0 +1,76 @@
+from valhalla.common.tiered_cache import TieredCache, clear_local_caches, _handle_invalidation, _invalidation
+
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+import json
+
+TIERED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered'},
+    'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+}
+
+
+@override_settings(CACHES=TIERED_CACHES)
+class TestTieredCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_caches()
+        self.tiered_cache = TieredCache('test', 60)
+        self.value = {'sites': ['tst']}
+
+    def test_values_are_kept_live_in_process(self):
+        self.tiered_cache.set('key', self.value)
+        cache.set('test.key', {'sites': ['other']})
+
+        self.assertIs(self.tiered_cache.get('key'), self.value)
+        self.assertEqual(cache.get('test.key.version'), self.tiered_cache._entries['key'][1])
+
+    def test_values_are_only_read_again_when_their_version_changes(self):
+        self.tiered_cache.timeout = 0
+        self.tiered_cache.set('key', self.value)
+
+        self.assertEqual(self.tiered_cache.lookup('key'), (self.value, True))
+        self.assertIs(self.tiered_cache.get('key'), self.value)
+        cache.set('test.key', {'sites': ['other']})
+        cache.set('test.key.version', 'changed')
+        self.assertEqual(self.tiered_cache.get('key'), {'sites': ['other']})
+
+    def test_invalidated_values_are_removed_from_both_tiers(self):
+        self.tiered_cache.set('key', self.value)
+        self.tiered_cache.invalidate('key')
+
+        self.assertIsNone(self.tiered_cache.get('key'))
+        self.assertIsNone(cache.get('test.key'))
+        self.assertIsNone(cache.get('test.key.version'))
+
+    def test_invalidations_from_other_processes_drop_the_local_value(self):
+        self.tiered_cache.set('key', self.value)
+        _handle_invalidation(json.dumps({'origin': _invalidation['origin'], 'cache': 'test', 'key': 'key'}).encode())
+        self.assertIn('key', self.tiered_cache._entries)
+
+        _handle_invalidation(json.dumps({'origin': 'other', 'cache': 'test', 'key': 'key'}).encode())
+        self.assertNotIn('key', self.tiered_cache._entries)
+        self.assertEqual(self.tiered_cache.get('key'), self.value)
+
+
+class TestTieredCacheWithoutSharedCache(TestCase):
+    def test_values_are_kept_in_process_for_the_timeout(self):
+        tiered_cache = TieredCache('test', 60)
+        tiered_cache.set('key', 'value')
+        self.assertEqual(tiered_cache.get('key'), 'value')
+
+        tiered_cache.timeout = 0
+        tiered_cache.set('key', 'value')
+        self.assertIsNone(tiered_cache.get('key'))
+
+    def test_invalidated_values_are_dropped(self):
+        tiered_cache = TieredCache('test', 60)
+        tiered_cache.set('key', 'value')
+        tiered_cache.invalidate('key')
+        self.assertIsNone(tiered_cache.get('key'))
+
+    def test_last_known_value_is_kept_after_the_timeout(self):
+        tiered_cache = TieredCache('test', 0)
+        tiered_cache.set('key', 'value')
+        self.assertIsNone(tiered_cache.get('key'))
+        self.assertEqual(tiered_cache.get_last_known('key'), 'value')
@@ -0,0 +1,170 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+import threading
+import logging
+import redis
+import json
+import time
+import uuid
+import os
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'valhalla.tiered_cache'
+# seconds the invalidation listener waits before reconnecting to redis
+INVALIDATION_RETRY_DELAY = 5
+
+_tiered_caches = {}
+_invalidation = {'pid': None, 'origin': None, 'client': None}
+_invalidation_lock = threading.Lock()
+
+
+class TieredCache(object):
+    '''
+    A cache of values that are read far more often than they change, in two tiers. The shared cache holds each value
+    under '<name>.<key>', next to a '<name>.<key>.version' key that changes whenever the value is set. Each process
+    keeps the live objects it has read in a dictionary, so a get within the timeout of the last one is a dictionary
+    access with no unpickling. After the timeout only the version is read from the shared cache, and the value is
+    read again only if the version has changed.
+
+    When TIERED_CACHE_INVALIDATION_URL is set, sets and invalidations are also published over redis, and every other
+    process drops its copy straight away rather than at the end of the timeout. Without a shared cache (the
+    DummyCache) each process caches values on its own for the timeout, and only the process that sets or invalidates
+    a value sees the change before then.
+    '''
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+        self._entries = {}
+        _tiered_caches[name] = self
+
+    def _key(self, key):
+        return '{}.{}'.format(self.name, key)
+
+    def _version_key(self, key):
+        return '{}.{}.version'.format(self.name, key)
+
+    def lookup(self, key, default=None):
+        ''' Returns the value of a key and whether it was checked against the shared cache in this call, which
+            happens at most once per timeout while the value is kept in process
+        '''
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and now < entry[2]:
+            return entry[0], False
+
+        shared_cache = caches['default']
+        if isinstance(shared_cache, DummyCache):
+            return default, True
+        _get_invalidation_client()
+        version = shared_cache.get(self._version_key(key))
+        if entry is not None and version is not None and version == entry[1]:
+            value = entry[0]
+        else:
+            value = shared_cache.get(self._key(key))
+            if value is None:
+                return default, True
+        self._entries[key] = (value, version, now + self.timeout)
+        return value, True
+
+    def get(self, key, default=None):
+        return self.lookup(key, default)[0]
+
+    def get_last_known(self, key, default=None):
+        ''' Returns the value this process last kept for a key however old it is, for when the shared cache has lost
+            it or, without a shared cache, the timeout has passed
+        '''
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else default
+
+    def set(self, key, value, timeout=None):
+        ''' Sets the value of a key in the shared cache, with no expiry by default, and keeps it in this process '''
+        shared_cache = caches['default']
+        version = uuid.uuid4().hex
+        # the value goes in before its version, so processes that see the new version read the new value
+        shared_cache.set(self._key(key), value, timeout)
+        shared_cache.set(self._version_key(key), version, timeout)
+        self._entries[key] = (value, version, time.monotonic() + self.timeout)
+        _publish_invalidation(self.name, key)
+
+    def invalidate(self, key):
+        ''' Removes a key from the shared cache and from every process '''
+        caches['default'].delete_many([self._key(key), self._version_key(key)])
+        self._entries.pop(key, None)
+        _publish_invalidation(self.name, key)
+
+    def clear_local(self, key=None):
+        ''' Drops the values kept in this process, or only the value of one key '''
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+def clear_local_caches():
+    ''' Drops the values every TieredCache keeps in this process '''
+    for tiered_cache in list(_tiered_caches.values()):
+        tiered_cache.clear_local()
+
+
+@receiver(setting_changed)
+def _clear_local_caches_on_caches_changed(setting, **kwargs):
+    if setting == 'CACHES':
+        clear_local_caches()
+
+
+def _get_invalidation_client():
+    ''' Returns the redis client this process publishes invalidations with, starting the thread that listens for the
+        invalidations of other processes the first time it is called in a process. Returns None when invalidations
+        are not enabled.
+    '''
+    url = settings.TIERED_CACHE_INVALIDATION_URL
+    if not url:
+        return None
+    if _invalidation['pid'] != os.getpid():
+        with _invalidation_lock:
+            if _invalidation['pid'] != os.getpid():
+                # worker processes forked from a parent that already listened need a connection and thread of their own
+                client = redis.StrictRedis.from_url(url)
+                _invalidation.update(origin=uuid.uuid4().hex, client=client)
+                threading.Thread(target=_listen_for_invalidations, args=(client,), daemon=True).start()
+                _invalidation['pid'] = os.getpid()
+    return _invalidation['client']
+
+
+def _publish_invalidation(name, key):
+    client = _get_invalidation_client()
+    if client is None:
+        return
+    message = json.dumps({'origin': _invalidation['origin'], 'cache': name, 'key': key})
+    try:
+        client.publish(INVALIDATION_CHANNEL, message)
+    except redis.RedisError as e:
+        logger.warning('Could not publish the invalidation of {}.{}: {}'.format(name, key, repr(e)))
+
+
+def _handle_invalidation(data):
+    # redis delivers the bytes that were published, which json only reads as of python 3.6
+    message = json.loads(data.decode('utf-8'))
+    if message['origin'] == _invalidation['origin']:
+        return
+    tiered_cache = _tiered_caches.get(message['cache'])
+    if tiered_cache is not None:
+        tiered_cache.clear_local(message['key'])
+
+
+def _listen_for_invalidations(client):
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # invalidations published while not subscribed were missed, so nothing kept can be trusted
+            clear_local_caches()
+            for message in pubsub.listen():
+                _handle_invalidation(message['data'])
+        except redis.RedisError as e:
+            logger.warning('Lost the tiered cache invalidation channel, reconnecting: {}'.format(repr(e)))
+            time.sleep(INVALIDATION_RETRY_DELAY)
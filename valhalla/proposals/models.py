@@ -9,9 +9,15 @@ from collections import namedtuple
 import logging
 
 from valhalla.celery import send_mail
+from valhalla.common.tiered_cache import TieredCache
 
 logger = logging.getLogger(__name__)
 
+# the semesters rarely change, and saving or deleting one invalidates them. Other processes only see the change
+# straight away with TIERED_CACHE_INVALIDATION_URL set, and otherwise within a minute if there is a shared cache.
+# Without one, each process keeps its own semesters for a minute.
+semester_cache = TieredCache('semesters', 60)
+
 
 class Semester(models.Model):
     id = models.CharField(primary_key=True, max_length=20)
@@ -149,6 +155,51 @@ class TimeAllocation(models.Model):
     def __str__(self):
         return 'Timeallocation for {0}-{1}'.format(self.proposal, self.semester)
 
+    @property
+    def key(self):
+        return TimeAllocationKey(self.semester_id, self.telescope_class, self.instrument_name)
+
+
+class TimeAllocationResolver(object):
+    '''
+    Looks up time allocations by proposal and TimeAllocationKey. All the time allocations of a proposal are loaded
+    together the first time the proposal is seen, from its prefetched timeallocation_set if it has one, so resolving
+    any number of keys takes at most one query per proposal. The instances are shared, so modifications made to them
+    through one lookup are seen by the next.
+    '''
+    def __init__(self):
+        self._time_allocations = {}
+        self._by_proposal = {}
+
+    def _add(self, proposal_id, time_allocations):
+        self._by_proposal[proposal_id] = list(time_allocations)
+        for time_allocation in self._by_proposal[proposal_id]:
+            self._time_allocations[(proposal_id, time_allocation.key)] = time_allocation
+
+    def add_proposal(self, proposal):
+        if proposal.id not in self._by_proposal:
+            self._add(proposal.id, proposal.timeallocation_set.all())
+
+    def load(self, proposal_ids):
+        missing = set(proposal_ids) - set(self._by_proposal)
+        time_allocations = {proposal_id: [] for proposal_id in missing}
+        if missing:
+            for time_allocation in TimeAllocation.objects.filter(proposal__in=missing).select_related('semester'):
+                time_allocations[time_allocation.proposal_id].append(time_allocation)
+        for proposal_id, proposal_time_allocations in time_allocations.items():
+            self._add(proposal_id, proposal_time_allocations)
+
+    def get_all(self, proposal_id):
+        self.load([proposal_id])
+        return self._by_proposal[proposal_id]
+
+    def get(self, proposal_id, tak):
+        self.load([proposal_id])
+        try:
+            return self._time_allocations[(proposal_id, tak)]
+        except KeyError:
+            raise TimeAllocation.DoesNotExist('No time allocation for {} on proposal {}'.format(tak, proposal_id))
+
 
 class Membership(models.Model):
     PI = 'PI'
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
 from valhalla.proposals.models import Proposal, TimeAllocation, Semester
+from valhalla.accounts.models import ProposalTimeUsage
 
 
 class TimeAllocationSerializer(serializers.ModelSerializer):
@@ -15,13 +16,18 @@ class ProposalSerializer(serializers.ModelSerializer):
     pi = serializers.StringRelatedField()
 
     def get_users(self, obj):
+        time_used = {
+            usage.user_id: usage.time_used
+            for usage in ProposalTimeUsage.objects.filter(proposal=obj, semester=obj.current_semester)
+        }
         return {
             mem.user.username: {
                 'first_name': mem.user.first_name,
                 'last_name': mem.user.last_name,
                 'time_limit': mem.time_limit,
-                'time_requested': mem.user.profile.time_used_in_proposal(obj)
-            } for mem in obj.membership_set.all()
+                'time_requested': time_used[mem.user_id] if mem.user_id in time_used
+                else mem.user.profile.time_used_in_proposal(obj)
+            } for mem in obj.membership_set.select_related('user__profile')
         }
 
     class Meta:
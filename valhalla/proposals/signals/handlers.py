@@ -1,6 +1,6 @@
 from django.dispatch import receiver
-from django.db.models.signals import pre_save
-from valhalla.proposals.models import TimeAllocation
+from django.db.models.signals import pre_save, post_save, post_delete
+from valhalla.proposals.models import TimeAllocation, Semester, semester_cache
 
 
 @receiver(pre_save, sender=TimeAllocation)
@@ -14,3 +14,8 @@ def set_default_ipp_time(sender, instance, *args, **kwargs):
             instance.ipp_limit = instance.std_allocation * STARTING_IPP_LIMIT
         if not instance.ipp_time_available:
             instance.ipp_time_available = instance.std_allocation * STARTING_IPP_AVAILABLE
+
+
+@receiver([post_save, post_delete], sender=Semester)
+def invalidate_cached_semesters(sender, instance, *args, **kwargs):
+    semester_cache.invalidate('all')
@@ -1,4 +1,5 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
 from django.core import mail
 from django.contrib.auth.models import User
 from django.db.utils import IntegrityError
@@ -11,11 +12,15 @@ import responses
 import datetime
 
 from valhalla.proposals.models import ProposalInvite, Proposal, Membership, ProposalNotification, TimeAllocation, Semester
+from valhalla.proposals.models import TimeAllocationKey, TimeAllocationResolver
 from valhalla.userrequests.models import UserRequest, Molecule
-from valhalla.accounts.models import Profile
+from valhalla.accounts.models import Profile, ProposalTimeUsage, add_time_used_in_proposal
 from valhalla.proposals.accounting import split_time, get_time_totals_from_pond, query_pond
 from valhalla.proposals.tasks import run_accounting
 from valhalla.common.test_helpers import create_simple_userrequest, ConfigDBTestMixin
+from valhalla.common.test_tiered_cache import TIERED_CACHES
+from valhalla.common.tiered_cache import clear_local_caches
+from valhalla.userrequests.duration_utils import get_semesters
 
 
 class TestProposal(TestCase):
@@ -144,6 +149,24 @@ class TestProposalUserLimits(ConfigDBTestMixin, TestCase):
         create_simple_userrequest(self.user, self.proposal, molecule=molecule)
         self.assertGreater(self.user.profile.time_used_in_proposal(self.proposal), 0)
 
+    def test_time_used_is_added_to(self):
+        molecule = mixer.blend(Molecule, instrument_name='1M0-SCICAM-SBIG', exposure_time=30)
+        create_simple_userrequest(self.user, self.proposal, molecule=molecule)
+        time_used = self.user.profile.time_used_in_proposal(self.proposal)
+        # the first submission stores everything submitted so far, which already includes the new requests
+        add_time_used_in_proposal(self.user, self.proposal, time_used)
+        self.assertEqual(ProposalTimeUsage.objects.get(user=self.user, proposal=self.proposal).time_used, time_used)
+        add_time_used_in_proposal(self.user, self.proposal, 100)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.profile.time_used_in_proposal(self.proposal), time_used + 100)
+
+    def test_time_used_is_not_stored_when_read(self):
+        molecule = mixer.blend(Molecule, instrument_name='1M0-SCICAM-SBIG', exposure_time=30)
+        create_simple_userrequest(self.user, self.proposal, molecule=molecule)
+        ProposalTimeUsage.objects.all().delete()
+        self.assertGreater(self.user.profile.time_used_in_proposal(self.proposal), 0)
+        self.assertFalse(ProposalTimeUsage.objects.filter(user=self.user, proposal=self.proposal).exists())
+
 
 class TestAccounting(TestCase):
     def test_split_time(self):
@@ -218,3 +241,59 @@ class TestDefaultIPP(TestCase):
         ta.ipp_time_available = 0
         ta.save()
         self.assertEqual(ta.ipp_time_available, 0)
+
+
+@override_settings(CACHES=TIERED_CACHES)
+class TestSemesterCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_caches()
+        self.semester = mixer.blend(Semester, id='2016B', start=datetime.datetime(2016, 8, 1, tzinfo=timezone.utc),
+                                    end=datetime.datetime(2017, 2, 1, tzinfo=timezone.utc))
+
+    def test_cached_semesters_change_with_the_semesters(self):
+        self.assertEqual(get_semesters(), [self.semester])
+        semester = mixer.blend(Semester, id='2017A', start=self.semester.end,
+                               end=datetime.datetime(2017, 8, 1, tzinfo=timezone.utc))
+        self.assertEqual(get_semesters(), [semester, self.semester])
+        self.semester.delete()
+        self.assertEqual(get_semesters(), [semester])
+
+
+class TestTimeAllocationResolver(TestCase):
+    def setUp(self):
+        self.semester = mixer.blend(Semester, id='2016B', start=datetime.datetime(2016, 8, 1, tzinfo=timezone.utc),
+                                    end=datetime.datetime(2017, 2, 1, tzinfo=timezone.utc))
+        self.proposals = mixer.cycle(3).blend(Proposal)
+        for proposal in self.proposals:
+            for instrument_name in ('1M0-SCICAM-SBIG', '1M0-SCICAM-SINISTRO'):
+                mixer.blend(TimeAllocation, proposal=proposal, semester=self.semester, telescope_class='1m0',
+                            instrument_name=instrument_name)
+        self.tak = TimeAllocationKey('2016B', '1m0', '1M0-SCICAM-SINISTRO')
+
+    def test_loads_each_proposal_once(self):
+        resolver = TimeAllocationResolver()
+        with self.assertNumQueries(1):
+            resolver.load(proposal.id for proposal in self.proposals)
+            for proposal in self.proposals:
+                time_allocation = resolver.get(proposal.id, self.tak)
+                self.assertEqual(time_allocation.proposal_id, proposal.id)
+                self.assertEqual(time_allocation.instrument_name, '1M0-SCICAM-SINISTRO')
+                self.assertEqual(len(resolver.get_all(proposal.id)), 2)
+
+    def test_uses_prefetched_time_allocations(self):
+        proposal = Proposal.objects.prefetch_related('timeallocation_set').get(pk=self.proposals[0].id)
+        resolver = TimeAllocationResolver()
+        with self.assertNumQueries(0):
+            resolver.add_proposal(proposal)
+            resolver.get(proposal.id, self.tak)
+
+    def test_lookups_share_instances(self):
+        resolver = TimeAllocationResolver()
+        resolver.get(self.proposals[0].id, self.tak).ipp_time_available = 42
+        self.assertEqual(resolver.get(self.proposals[0].id, self.tak).ipp_time_available, 42)
+
+    def test_missing_time_allocation(self):
+        resolver = TimeAllocationResolver()
+        with self.assertRaises(TimeAllocation.DoesNotExist):
+            resolver.get(self.proposals[0].id, TimeAllocationKey('2016B', '2m0', '2M0-FLOYDS-SCICAM'))
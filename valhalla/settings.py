@@ -115,6 +115,12 @@ CACHES = {
     }
 }
 
+# Redis url that tiered caches publish invalidations on, so every process drops its copy of a value as soon as it is
+# set. When empty, processes pick up changed values by checking their version in the shared cache once a minute, and
+# without a shared cache (the DummyCache default) each process caches them on its own, so changes such as saved
+# semesters only reach the other processes as their copies expire.
+TIERED_CACHE_INVALIDATION_URL = os.getenv('TIERED_CACHE_INVALIDATION_URL', '')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -214,6 +220,16 @@ ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost')
 POND_URL = os.getenv('POND_URL', 'http://localhost')
 CONFIGDB_URL = os.getenv('CONFIGDB_URL', 'http://localhost')
 DOWNTIMEDB_URL = os.getenv('DOWNTIMEDB_URL', 'http://localhost')
+DOWNTIMEDB_REQUEST_TIMEOUT = int(os.getenv('DOWNTIMEDB_REQUEST_TIMEOUT', 10))
+
+# Seconds before cached configdb data is considered stale and refreshed. Stale data keeps being served while a single
+# worker refreshes it, in a background thread unless CONFIGDB_BACKGROUND_REFRESH is disabled.
+CONFIGDB_CACHE_TIMEOUT = int(os.getenv('CONFIGDB_CACHE_TIMEOUT', 900))
+CONFIGDB_LOCAL_CACHE_TIMEOUT = int(os.getenv('CONFIGDB_LOCAL_CACHE_TIMEOUT', 60))
+CONFIGDB_BACKGROUND_REFRESH = os.getenv('CONFIGDB_BACKGROUND_REFRESH', 'true').lower() == 'true'
+# Seconds to wait for configdb to respond, and before a refresh that failed is tried again
+CONFIGDB_REQUEST_TIMEOUT = int(os.getenv('CONFIGDB_REQUEST_TIMEOUT', 10))
+CONFIGDB_RETRY_DELAY = int(os.getenv('CONFIGDB_RETRY_DELAY', 60))
 
 REST_FRAMEWORK = {
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
@@ -242,6 +258,10 @@ CELERY_TASK_ALWAYS_EAGER = not os.getenv('CELERY_ENABLED', False)
 CELERY_BROKER_URL = os.getenv('BROKER_URL', 'memory://localhost')
 CELERY_WORKER_HIJACK_ROOT_LOGGER = False
 
+# Seconds that the results of asynchronous api jobs are kept for polling. Identical submissions share a job until it
+# has finished.
+ASYNC_JOB_TIMEOUT = int(os.getenv('ASYNC_JOB_TIMEOUT', 3600))
+
 CELERY_BEAT_SCHEDULE = {
     'time-accounting-every-hour': {
         'task': 'valhalla.proposals.tasks.run_accounting',
@@ -254,6 +274,14 @@ CELERY_BEAT_SCHEDULE = {
     'expire-access-tokens-every-day': {
         'task': 'valhalla.accounts.tasks.expire_access_tokens',
         'schedule': 86400.0
+    },
+    'update-telescope-availability-every-hour': {
+        'task': 'valhalla.userrequests.tasks.update_telescope_availability',
+        'schedule': 3600.0
+    },
+    'update-downtime-every-5-minutes': {
+        'task': 'valhalla.userrequests.tasks.update_downtime',
+        'schedule': 300.0
     }
 }
 try:
@@ -9,7 +9,7 @@ from django.conf.urls.static import static
 from valhalla.userrequests.viewsets import RequestViewSet, UserRequestViewSet, DraftUserRequestViewSet
 from valhalla.userrequests.views import TelescopeStatesView, TelescopeAvailabilityView, AirmassView
 from valhalla.userrequests.views import InstrumentsInformationView, UserRequestStatusIsDirty
-from valhalla.userrequests.views import ContentionView, PressureView, UserRequestListView
+from valhalla.userrequests.views import ContentionView, PressureView, UserRequestListView, JobView
 from valhalla.proposals.viewsets import ProposalViewSet, SemesterViewSet
 from valhalla.accounts.views import ProfileApiView
 import valhalla.accounts.urls as accounts_urls
@@ -35,6 +35,7 @@ api_urlpatterns = ([
     url(r'isDirty/', UserRequestStatusIsDirty.as_view(), name='isDirty'),
     url(r'contention/(?P<instrument_name>.+)/', ContentionView.as_view(), name='contention'),
     url(r'pressure/', PressureView.as_view(), name='pressure'),
+    url(r'jobs/(?P<job_id>[0-9a-f]+)/', JobView.as_view(), name='job'),
 ], 'api')
 
 urlpatterns = [
@@ -0,0 +1,116 @@
+'''
+Telescope availability per observing night, read from the nights the update_telescope_availability task has stored
+where it can, so only the nights around and between the ones stored for each telescope are computed from the telescope
+states in elasticsearch.
+'''
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+
+from valhalla.common.configdb import configdb, TelescopeKey
+from valhalla.common.telescope_states import get_telescope_availability_per_night, NightAvailability
+from valhalla.userrequests.models import TelescopeAvailability
+
+# nights before now the update_telescope_availability task recomputes on each run, to pick up late telescope events
+AVAILABILITY_ROLLUP_DAYS = 3
+
+
+def update_telescope_availability(end=None, days=AVAILABILITY_ROLLUP_DAYS):
+    '''
+    Stores the availability of every telescope on each of the nights that finished within a number of days before the
+    end time. Nights cut off by the start or end of that range are left out.
+    :return: number of nights stored
+    '''
+    end = (end or timezone.now()).replace(microsecond=0)
+    start = end - timedelta(days=days)
+    telescope_nights = get_telescope_availability_per_night(start, end)
+    stored = 0
+    with transaction.atomic():
+        for telescope_key, nights in telescope_nights.items():
+            for night in nights:
+                if night.start > start and night.end < end:
+                    TelescopeAvailability.objects.update_or_create(
+                        site=telescope_key.site, observatory=telescope_key.observatory,
+                        telescope=telescope_key.telescope, night=night.night,
+                        defaults={'start': night.start, 'end': night.end, 'available': night.available,
+                                  'total': night.total}
+                    )
+                    stored += 1
+    return stored
+
+
+def _uncovered_spans(start, end, covered_nights):
+    ''' Returns the (start, end) spans between the start and end times that are not covered by a stored night, given
+        the span stored for each night. Consecutive nights cover the time between them.
+    '''
+    spans = []
+    span_start = start
+    previous_night = None
+    for night, (night_start, night_end) in sorted(covered_nights.items()):
+        if (previous_night is None or night - previous_night > timedelta(days=1)) and span_start < night_start:
+            spans.append((span_start, night_start))
+        span_start = max(span_start, night_end)
+        previous_night = night
+    if span_start < end:
+        spans.append((span_start, end))
+    return spans
+
+
+def _merge_spans(spans):
+    ''' Returns the (start, end) spans merged where they overlap or touch, in time order '''
+    merged = []
+    for span_start, span_end in sorted(spans):
+        if merged and span_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], span_end))
+        else:
+            merged.append((span_start, span_end))
+    return merged
+
+
+def get_telescope_availability_per_day(start, end, telescopes=None, sites=None):
+    '''
+    Returns the fraction of each night each telescope was available between the start and end times, in the format
+    of telescope_states.get_telescope_availability_per_day. Stored nights that fall within the times are read from
+    the database, and the time before, between and after them that no stored night of a telescope covers is computed
+    from the telescope states.
+    '''
+    available_telescopes = [
+        telescope_key for telescope_key in configdb.get_instrument_types_per_telescope(only_schedulable=True).keys()
+        if (not sites or telescope_key.site in sites) and (not telescopes or telescope_key.telescope in telescopes)
+    ]
+    # the night of a telescope is the date it starts on, so nights within the times are within a day of their dates
+    stored_nights = TelescopeAvailability.objects.filter(
+        night__range=((start - timedelta(days=1)).date(), (end + timedelta(days=1)).date())
+    )
+    if sites:
+        stored_nights = stored_nights.filter(site__in=sites)
+    if telescopes:
+        stored_nights = stored_nights.filter(telescope__in=telescopes)
+
+    telescope_nights = {}
+    # the task skips the nights cut off by its range for each telescope on its own, so each has its own coverage
+    covered_nights = {telescope_key: {} for telescope_key in available_telescopes}
+    for row in stored_nights:
+        telescope_key = TelescopeKey(row.site, row.observatory, row.telescope)
+        if telescope_key in covered_nights and row.start >= start and row.end <= end:
+            covered_nights[telescope_key][row.night] = (row.start, row.end)
+            telescope_nights.setdefault(telescope_key, {})[row.night] = NightAvailability(
+                row.night, row.start, row.end, row.available, row.total
+            )
+
+    live_spans = _merge_spans(
+        span for nights in covered_nights.values() for span in _uncovered_spans(start, end, nights)
+    )
+    for live_start, live_end in live_spans:
+        live_nights = get_telescope_availability_per_night(live_start, live_end, telescopes=telescopes, sites=sites)
+        for telescope_key, nights in live_nights.items():
+            nights_by_date = telescope_nights.setdefault(telescope_key, {})
+            for night in nights:
+                if night.night not in nights_by_date:
+                    nights_by_date[night.night] = night
+
+    return {
+        telescope_key: [[night.night, night.available / night.total]
+                        for _, night in sorted(nights_by_date.items())]
+        for telescope_key, nights_by_date in telescope_nights.items()
+    }
@@ -1,8 +1,24 @@
 from valhalla.userrequests.duration_utils import get_request_duration
-from valhalla.common.rise_set_utils import get_rise_set_intervals, get_largest_interval
+from valhalla.common.rise_set_utils import get_rise_set_intervals
 
 from django.utils import timezone
 from datetime import timedelta
+import bisect
+
+
+def get_largest_interval_within(intervals, interval_ends, start, end):
+    '''
+    Finds the largest part of a sorted, non overlapping list of intervals that falls between start and end.
+    :param intervals: sorted list of (start, end) tuples
+    :param interval_ends: list of the end times of intervals, used to index into them
+    :return: timedelta of the largest interval truncated to start and end
+    '''
+    largest_interval = timedelta(seconds=0)
+    index = bisect.bisect_right(interval_ends, start)
+    while index < len(intervals) and intervals[index][0] < end:
+        largest_interval = max(min(intervals[index][1], end) - max(intervals[index][0], start), largest_interval)
+        index += 1
+    return largest_interval
 
 
 def expand_cadence_request(request_dict):
@@ -13,26 +29,38 @@ def expand_cadence_request(request_dict):
     :param request_dict: a valid request dictionary with cadence information.
     :return: Expanded list of requests with valid windows within the cadence.
     '''
+    return list(iter_cadence_requests(request_dict))
+
+
+def iter_cadence_requests(request_dict):
+    '''
+    Generator version of expand_cadence_request, which yields each request of the cadence as soon as its window has
+    been checked against rise-set.
+    :param request_dict: a valid request dictionary with cadence information.
+    :return: Generator of requests with valid windows within the cadence.
+    '''
     cadence = request_dict['cadence']
-    # now expand the request into a list of requests with the proper windows from the cadence block
-    cadence_requests = []
+    # now expand the request into requests with the proper windows from the cadence block
     half_jitter = timedelta(hours=cadence['jitter'] / 2.0)
     request_duration = get_request_duration(request_dict)
     request_window_start = cadence['start']
 
+    # compute the rise_set intervals (with downtime removed) once over the whole cadence, then slice them per window
+    request_dict['windows'] = [{'start': cadence['start'], 'end': cadence['end']}]
+    intervals = get_rise_set_intervals(request_dict)
+    interval_ends = [interval[1] for interval in intervals]
+
     while request_window_start < cadence['end']:
         window_start = max(request_window_start - half_jitter, cadence['start'])
         window_end = min(request_window_start + half_jitter, cadence['end'])
 
         # test the rise_set of this window
-        request_dict['windows'] = [{'start': window_start, 'end': window_end}]
-        intervals = get_rise_set_intervals(request_dict)
-        largest_interval = get_largest_interval(intervals)
+        largest_interval = get_largest_interval_within(intervals, interval_ends, window_start, window_end)
         if largest_interval.total_seconds() >= request_duration and window_end > timezone.now():
             # this cadence window passes rise_set and is in the future so add it to the list
             request_copy = request_dict.copy()
+            request_copy['windows'] = [{'start': window_start, 'end': window_end}]
             del request_copy['cadence']
-            cadence_requests.append(request_copy)
+            yield request_copy
 
         request_window_start += timedelta(hours=cadence['period'])
-    return cadence_requests
@@ -3,7 +3,7 @@ from django.utils.translation import ugettext as _
 from math import ceil
 import logging
 
-from valhalla.proposals.models import TimeAllocationKey, Proposal, Semester
+from valhalla.proposals.models import TimeAllocationKey, TimeAllocationResolver, Proposal, Semester, semester_cache
 from valhalla.common.configdb import configdb
 from valhalla.common.rise_set_utils import get_rise_set_intervals, get_largest_interval
 
@@ -15,13 +15,13 @@ PER_MOLECULE_STARTUP_TIME = 11.0   # per-molecule startup time, which encompasse
 OVERHEAD_ALLOWANCE = 1.1           # amount of leeway in a proposals timeallocation before rejecting that request
 MAX_IPP_LIMIT = 2.0                # the maximum allowed value of ipp
 MIN_IPP_LIMIT = 0.5                # the minimum allowed value of ipp
-semesters = None
 
 
 def get_semesters():
-    global semesters
-    if not semesters:
+    semesters = semester_cache.get('all')
+    if semesters is None:
         semesters = list(Semester.objects.all().order_by('-start'))
+        semester_cache.set('all', semesters)
     return semesters
 
 
@@ -73,11 +73,11 @@ def get_request_duration_dict(request_dict):
 def get_max_ipp_for_userrequest(userrequest_dict):
     proposal = Proposal.objects.get(pk=userrequest_dict['proposal'])
     request_durations = get_request_duration_sum(userrequest_dict)
+    time_allocations = TimeAllocationResolver()
+    time_allocations.add_proposal(proposal)
     ipp_dict = {}
     for tak, duration in request_durations.items():
-        time_allocation = proposal.timeallocation_set.get(
-            semester=tak.semester, telescope_class=tak.telescope_class, instrument_name=tak.instrument_name
-        )
+        time_allocation = time_allocations.get(proposal.id, tak)
         duration_hours = duration / 3600.0
         ipp_available = time_allocation.ipp_time_available
         max_ipp_allowable = min((ipp_available / duration_hours) + 1.0, MAX_IPP_LIMIT)
@@ -159,6 +159,21 @@ def get_time_allocation_key(telescope_class, instrument_name, min_window_time, m
     return TimeAllocationKey(semester.id, telescope_class, instrument_name)
 
 
+def get_denormalized_request_fields(request_dict):
+    ''' Returns the values of the persisted window bounds, duration and time allocation columns of a request '''
+    min_window_time = min([window['start'] for window in request_dict['windows']])
+    max_window_time = max([window['end'] for window in request_dict['windows']])
+    semester = get_semester_in(min_window_time, max_window_time)
+    return {
+        'window_start': min_window_time,
+        'window_end': max_window_time,
+        'duration_seconds': get_request_duration(request_dict),
+        'semester_code': semester.id if semester else '',
+        'instrument_name': request_dict['molecules'][0]['instrument_name'],
+        'telescope_class': request_dict['location']['telescope_class'],
+    }
+
+
 def get_total_duration_dict(userrequest_dict):
     durations = []
     for request in userrequest_dict['requests']:
@@ -169,7 +184,8 @@ def get_total_duration_dict(userrequest_dict):
                                       min_window_time,
                                       max_window_time
                                       )
-        duration = get_request_duration(request)
+        # request dicts built from saved requests already carry their duration
+        duration = request['duration'] if 'duration' in request else get_request_duration(request)
         durations.append((tak, duration))
     # check the proposal has a time allocation with enough time for all requests depending on operator
     total_duration = {}
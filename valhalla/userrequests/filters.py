@@ -22,10 +22,10 @@ class UserRequestFilter(django_filters.FilterSet):
             ('group_id', 'title'),
             ('modified', 'modified'),
             ('created', 'created'),
-            ('requests__windows__end', 'end')
+            ('window_end', 'end')
         ),
         field_labels={
-            'requests__windows__end': 'End of window',
+            'window_end': 'End of window',
             'modified': 'Last Update'
         }
     )
@@ -0,0 +1,206 @@
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+from rest_framework.response import Response
+from itertools import islice
+import hashlib
+import json
+import uuid
+
+from valhalla.userrequests.cadence import iter_cadence_requests
+from valhalla.userrequests.duration_utils import (get_request_duration_dict, get_request_duration_sum,
+                                                 get_total_duration_dict)
+from valhalla.userrequests.models import Request
+from valhalla.userrequests.request_utils import (get_airmasses_for_request_at_sites,
+                                                 get_telescope_states_for_request)
+from valhalla.userrequests.serializers import RequestSerializer, UserRequestSerializer, CadenceRequestSerializer
+
+JOB_STATES = ('PENDING', 'RUNNING', 'COMPLETED', 'FAILED')
+# number of expanded cadence requests validated together when a cadence is streamed
+CADENCE_CHUNK_SIZE = 100
+JOB_ERROR_MSG = _('The job failed to run. Please try again, and contact support if the problem persists.')
+
+
+class JobRequest(object):
+    ''' Stands in for the http request in serializer contexts when a job runs outside of a view '''
+    def __init__(self, user):
+        self.user = user
+
+
+def jobs_can_be_stored():
+    ''' Jobs are polled for from the shared cache, so without one (the DummyCache) they are run synchronously '''
+    return not isinstance(caches['default'], DummyCache)
+
+
+def is_async_request(request):
+    return request.query_params.get('async', '').lower() in ('true', '1') and jobs_can_be_stored()
+
+
+def validate_userrequest(data, request):
+    serializer = UserRequestSerializer(data=data, context={'request': request})
+    req_durations = {}
+    if serializer.is_valid():
+        req_durations = get_request_duration_dict(serializer.validated_data['requests'])
+        errors = {}
+    else:
+        errors = serializer.errors
+
+    return {'request_durations': req_durations, 'errors': errors}, 200
+
+
+def validate_cadence_requests(data):
+    ''' Validates the cadence requests of a userrequest.
+    :return: tuple of the list of (is_cadence, request) pairs and the errors of the first invalid cadence request
+    '''
+    requests = []
+    for req in data.get('requests', []):
+        if isinstance(req, dict) and req.get('cadence'):
+            cadence_request_serializer = CadenceRequestSerializer(data=req)
+            if cadence_request_serializer.is_valid():
+                requests.append((True, cadence_request_serializer.validated_data))
+            else:
+                return [], cadence_request_serializer.errors
+        else:
+            requests.append((False, req))
+    return requests, {}
+
+
+def expand_cadence_requests(requests):
+    for is_cadence, req in requests:
+        if is_cadence:
+            yield from iter_cadence_requests(req)
+        else:
+            yield req
+
+
+def iter_validated_cadence_chunks(data, requests, request):
+    ''' Expands the cadence requests of a userrequest a chunk at a time, validating each chunk as part of the
+        userrequest before it is yielded, so the expanded requests are never all held at once. The chunks already
+        yielded count towards the membership time limit, time allocation and ipp checks of the next.
+    :return: generator of (chunk, operator, errors) tuples that ends after the first chunk with errors, where the
+        operator is the one the chunk was validated with
+    '''
+    expanded = expand_cadence_requests(requests)
+    chunk = list(islice(expanded, CADENCE_CHUNK_SIZE))
+    first = True
+    preceding_duration = 0
+    preceding_total_durations = {}
+    while True:
+        next_chunk = list(islice(expanded, CADENCE_CHUNK_SIZE))
+        chunk_data = data.copy()
+        chunk_data['requests'] = chunk
+        if len(chunk) > 1:
+            chunk_data['operator'] = 'MANY'
+        elif not first or next_chunk:
+            chunk_data['operator'] = 'SINGLE'
+        ur_serializer = UserRequestSerializer(data=chunk_data, context={
+            'request': request,
+            'preceding_duration': preceding_duration,
+            'preceding_total_durations': preceding_total_durations
+        })
+        if not ur_serializer.is_valid():
+            yield chunk, chunk_data.get('operator'), ur_serializer.errors
+            return
+        yield chunk, ur_serializer.validated_data['operator'], {}
+        if not next_chunk:
+            return
+        preceding_duration += sum(get_request_duration_sum(ur_serializer.validated_data).values())
+        # every chunk is part of one many userrequest, whose total per time allocation is its longest request
+        for tak, duration in get_total_duration_dict(ur_serializer.validated_data).items():
+            preceding_total_durations[tak] = max(preceding_total_durations.get(tak, 0.0), duration)
+        chunk = next_chunk
+        first = False
+
+
+def expand_cadence_userrequest(data, request):
+    requests, errors = validate_cadence_requests(data)
+    if errors:
+        return errors, 400
+
+    # now replace the originally sent requests with the cadence requests and send it back
+    ret_data = data.copy()
+    ret_data['requests'] = list(expand_cadence_requests(requests))
+
+    if(len(ret_data['requests']) > 1):
+        ret_data['operator'] = 'MANY'
+    ur_serializer = UserRequestSerializer(data=ret_data, context={'request': request})
+    if not ur_serializer.is_valid():
+        return ur_serializer.errors, 400
+    return ret_data, 200
+
+
+def get_airmasses(data, request):
+    serializer = RequestSerializer(data=data)
+    if serializer.is_valid():
+        return get_airmasses_for_request_at_sites(serializer.validated_data), 200
+    else:
+        return serializer.errors, 200
+
+
+def get_telescope_states(data, request):
+    telescope_states = get_telescope_states_for_request(Request.objects.get(pk=data['request_id']))
+    return {str(k): v for k, v in telescope_states.items()}, 200
+
+
+JOB_FUNCTIONS = {
+    'validate': validate_userrequest,
+    'cadence': expand_cadence_userrequest,
+    'airmass': get_airmasses,
+    'telescope_states': get_telescope_states,
+}
+
+
+def _job_cache_key(job_id):
+    return 'job.{}'.format(job_id)
+
+
+def get_job(job_id):
+    return cache.get(_job_cache_key(job_id))
+
+
+def set_job(job):
+    cache.set(_job_cache_key(job['id']), job, settings.ASYNC_JOB_TIMEOUT)
+
+
+def create_job(job_type, data, user_id):
+    ''' Creates a pending job, unless an identical job from the same user is still pending or running, in which case
+        that job is returned instead. Finished jobs are never reused, as their results depend on the time used,
+        allocations and the time when they ran.
+    :return: tuple of the job and whether it was newly created
+    '''
+    content_hash = hashlib.sha1(
+        json.dumps([job_type, data, user_id], sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    lookup_key = 'job.lookup.{}'.format(content_hash)
+    job = {
+        'id': uuid.uuid4().hex,
+        'type': job_type,
+        'state': 'PENDING',
+        'user': user_id,
+        'created': timezone.now(),
+        'completed': None,
+        'status_code': None,
+        'result': None
+    }
+    set_job(job)
+    if not cache.add(lookup_key, job['id'], settings.ASYNC_JOB_TIMEOUT):
+        existing_job = get_job(cache.get(lookup_key, ''))
+        if existing_job and existing_job['state'] in ('PENDING', 'RUNNING'):
+            cache.delete(_job_cache_key(job['id']))
+            return existing_job, False
+        # the identical job has finished or expired, so this one takes its place
+        cache.set(lookup_key, job['id'], settings.ASYNC_JOB_TIMEOUT)
+    return job, True
+
+
+def job_data(job):
+    ret_data = {k: v for k, v in job.items() if k != 'user'}
+    ret_data['url'] = reverse('api:job', kwargs={'job_id': job['id']})
+    return ret_data
+
+
+def async_job_response(job):
+    return Response(job_data(job), status=202)
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Max, Q
+
+from valhalla.common.configdb import ConfigDBException
+from valhalla.userrequests.duration_utils import get_denormalized_request_fields, get_semester_in
+from valhalla.userrequests.models import Request, UserRequest
+
+
+class Command(BaseCommand):
+    help = ('Fills in the persisted window bounds, duration and time allocation columns of requests and user requests. '
+            'Migrating fills in all but the durations, which need configdb and are calculated when needed until '
+            'this is run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of requests updated per transaction')
+        parser.add_argument('--all', action='store_true', help='Recompute the columns of every request, not only '
+                                                               'the ones missing them')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        requests = Request.objects.all()
+        if not options['all']:
+            requests = requests.filter(Q(window_end__isnull=True) | Q(duration_seconds__isnull=True))
+        request_ids = list(requests.order_by('id').values_list('id', flat=True))
+        user_request_ids = set()
+
+        for i in range(0, len(request_ids), batch_size):
+            with transaction.atomic():
+                for request in Request.objects.filter(pk__in=request_ids[i:i + batch_size]).prefetch_related(
+                        'windows', 'molecules', 'location'):
+                    user_request_ids.add(request.user_request_id)
+                    Request.objects.filter(pk=request.id).update(**self.get_fields(request))
+            self.stdout.write('Updated {} of {} requests'.format(min(i + batch_size, len(request_ids)),
+                                                                 len(request_ids)))
+
+        user_request_ids = sorted(user_request_ids)
+        for i in range(0, len(user_request_ids), batch_size):
+            with transaction.atomic():
+                for bounds in Request.objects.filter(user_request__in=user_request_ids[i:i + batch_size]).order_by(
+                        ).values('user_request').annotate(start=Min('window_start'), end=Max('window_end')):
+                    UserRequest.objects.filter(pk=bounds['user_request']).update(
+                        window_start=bounds['start'], window_end=bounds['end']
+                    )
+        self.stdout.write('Updated {} user requests'.format(len(user_request_ids)))
+
+    def get_fields(self, request):
+        request_dict = {
+            'windows': [window.as_dict for window in request.windows.all()],
+            'molecules': [molecule.as_dict for molecule in request.molecules.all()],
+            'location': request.location.as_dict
+        }
+        try:
+            return get_denormalized_request_fields(request_dict)
+        except ConfigDBException as e:
+            # instruments no longer in configdb have no overheads to calculate a duration from, but the window bounds
+            # are still needed for the expiry and scheduler queries
+            self.stderr.write('Could not calculate the duration of request {}: {}'.format(request.id, e))
+            semester = get_semester_in(request.min_window_time, request.max_window_time)
+            return {
+                'window_start': request.min_window_time,
+                'window_end': request.max_window_time,
+                'semester_code': semester.id if semester else '',
+                'instrument_name': request_dict['molecules'][0]['instrument_name'],
+                'telescope_class': request_dict['location']['telescope_class'],
+            }
@@ -0,0 +1,36 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userrequests', '0020_auto_20261018_0359'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelescopeAvailability',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.CharField(max_length=20)),
+                ('observatory', models.CharField(max_length=20)),
+                ('telescope', models.CharField(max_length=20)),
+                ('night', models.DateField(db_index=True)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('available', models.FloatField(help_text='Seconds the telescope was available')),
+                ('total', models.FloatField(help_text='Seconds of the night tallied')),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Telescope availabilities',
+                'ordering': ('site', 'observatory', 'telescope', 'night'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='telescopeavailability',
+            unique_together={('site', 'observatory', 'telescope', 'night')},
+        ),
+    ]
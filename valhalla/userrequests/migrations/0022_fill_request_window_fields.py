@@ -0,0 +1,51 @@
+from django.db import migrations
+from django.db.models import Min, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_request_window_fields(apps, schema_editor):
+    ''' Fills in the window bounds and time allocation columns of existing requests and user requests from their
+        windows, molecules and locations, so the expiry and scheduler queries see them straight after migrating.
+        Durations need configdb, so they are left for the backfill_request_fields command, and calculated when
+        needed until then.
+    '''
+    UserRequest = apps.get_model('userrequests', 'UserRequest')
+    Request = apps.get_model('userrequests', 'Request')
+    Window = apps.get_model('userrequests', 'Window')
+    Molecule = apps.get_model('userrequests', 'Molecule')
+    Location = apps.get_model('userrequests', 'Location')
+    Semester = apps.get_model('proposals', 'Semester')
+
+    windows = Window.objects.filter(request=OuterRef('pk')).order_by().values('request')
+    Request.objects.filter(window_end__isnull=True).update(
+        window_start=Subquery(windows.annotate(start=Min('start')).values('start')),
+        window_end=Subquery(windows.annotate(end=Max('end')).values('end'))
+    )
+    Request.objects.filter(instrument_name='').update(instrument_name=Coalesce(Subquery(
+        Molecule.objects.filter(request=OuterRef('pk')).order_by('id').values('instrument_name')[:1]
+    ), Value('')))
+    Request.objects.filter(telescope_class='').update(telescope_class=Coalesce(Subquery(
+        Location.objects.filter(request=OuterRef('pk')).values('telescope_class')[:1]
+    ), Value('')))
+    # the latest starting semester the windows fall in, as update_window_bounds picks
+    for semester in Semester.objects.order_by('-start'):
+        Request.objects.filter(semester_code='', window_start__gte=semester.start,
+                               window_end__lte=semester.end).update(semester_code=semester.id)
+
+    requests = Request.objects.filter(user_request=OuterRef('pk')).order_by().values('user_request')
+    UserRequest.objects.filter(window_end__isnull=True).update(
+        window_start=Subquery(requests.annotate(start=Min('window_start')).values('start')),
+        window_end=Subquery(requests.annotate(end=Max('window_end')).values('end'))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposals', '0012_proposal_non_science'),
+        ('userrequests', '0021_auto_20261018_0441'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_request_window_fields, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
+from django.db.models import Min, Max
 from django.contrib.auth.models import User
 from django.utils.functional import cached_property
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.cache import cache
 from django.urls import reverse
@@ -9,9 +11,9 @@ from django.forms.models import model_to_dict
 import requests
 import logging
 
-from valhalla.proposals.models import Proposal, TimeAllocationKey
+from valhalla.proposals.models import Proposal, Semester, TimeAllocationKey
 from valhalla.userrequests.external_serializers import BlockSerializer
-from valhalla.userrequests.target_helpers import TARGET_TYPE_HELPER_MAP
+from valhalla.userrequests.target_helpers import get_target_fields
 from valhalla.common.rise_set_utils import get_rise_set_target
 from valhalla.userrequests.duration_utils import (get_request_duration, get_molecule_duration, get_total_duration_dict,
                                                   get_semester_in)
@@ -19,7 +21,33 @@ from valhalla.userrequests.duration_utils import (get_request_duration, get_mole
 logger = logging.getLogger(__name__)
 
 
-class UserRequest(models.Model):
+class LoadedStateMixin(object):
+    ''' Remembers the state an instance was loaded from the database with, so state changes can be checked when it is
+        saved without querying for the row again.
+    '''
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_state = instance.__dict__.get('state')
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_state = self.__dict__.get('state')
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_state = self.state
+
+    @property
+    def loaded_state(self):
+        if getattr(self, '_loaded_state', None) is None and self.pk:
+            # this instance was not loaded from the database, so look up the state it has there
+            self._loaded_state = type(self).objects.values_list('state', flat=True).get(pk=self.pk)
+        return self._loaded_state
+
+
+class UserRequest(LoadedStateMixin, models.Model):
     NORMAL = 'NORMAL'
     TOO = 'TARGET_OF_OPPORTUNITY'
 
@@ -42,6 +70,8 @@ class UserRequest(models.Model):
         ('TARGET_OF_OPPORTUNITY', TOO),
     )
 
+    SERIALIZER_EXCLUDE = ('window_start', 'window_end')
+
     submitter = models.ForeignKey(User, on_delete=models.CASCADE)
     proposal = models.ForeignKey(Proposal, on_delete=models.CASCADE)
     group_id = models.CharField(max_length=50)
@@ -52,6 +82,10 @@ class UserRequest(models.Model):
     state = models.CharField(max_length=40, choices=STATE_CHOICES, default=STATE_CHOICES[0][0])
     modified = models.DateTimeField(auto_now=True, db_index=True)
 
+    # Persisted bounds of the windows of all child requests, so they can be filtered and ordered on in queries
+    window_start = models.DateTimeField(null=True, blank=True, db_index=True)
+    window_end = models.DateTimeField(null=True, blank=True, db_index=True)
+
     class Meta:
         ordering = ('-created',)
 
@@ -66,7 +100,7 @@ class UserRequest(models.Model):
 
     @property
     def as_dict(self):
-        ret_dict = model_to_dict(self)
+        ret_dict = model_to_dict(self, exclude=self.SERIALIZER_EXCLUDE)
         ret_dict['submitter'] = self.submitter.username
         ret_dict['proposal'] = self.proposal.id
         ret_dict['requests'] = [r.as_dict for r in self.requests.all()]
@@ -98,7 +132,7 @@ class UserRequest(models.Model):
             return cached_duration
 
 
-class Request(models.Model):
+class Request(LoadedStateMixin, models.Model):
     STATE_CHOICES = (
         ('PENDING', 'PENDING'),
         ('SCHEDULED', 'SCHEDULED'),
@@ -107,7 +141,8 @@ class Request(models.Model):
         ('CANCELED', 'CANCELED'),
     )
 
-    SERIALIZER_EXCLUDE = ('user_request',)
+    SERIALIZER_EXCLUDE = ('user_request', 'window_start', 'window_end', 'duration_seconds', 'semester_code',
+                          'instrument_name', 'telescope_class')
 
     user_request = models.ForeignKey(UserRequest, related_name='requests', on_delete=models.CASCADE)
     observation_note = models.CharField(max_length=255, default='', blank=True)
@@ -126,8 +161,19 @@ class Request(models.Model):
     # Minimum completable block threshold (percentage, 0-100)
     acceptability_threshold = models.FloatField(default=90.0, validators=[MinValueValidator(0.0), MaxValueValidator(100.0)])
 
+    # Persisted from the windows, molecules and location, so they can be filtered and ordered on in queries
+    window_start = models.DateTimeField(null=True, blank=True, db_index=True)
+    window_end = models.DateTimeField(null=True, blank=True, db_index=True)
+    duration_seconds = models.PositiveIntegerField(null=True, blank=True)
+    semester_code = models.CharField(max_length=20, default='', blank=True)
+    instrument_name = models.CharField(max_length=255, default='', blank=True)
+    telescope_class = models.CharField(max_length=20, default='', blank=True)
+
     class Meta:
         ordering = ('id',)
+        indexes = [
+            models.Index(fields=['semester_code', 'telescope_class', 'instrument_name']),
+        ]
 
     def __str__(self):
         return self.get_id_display()
@@ -148,6 +194,8 @@ class Request(models.Model):
 
     @cached_property
     def duration(self):
+        if self.duration_seconds is not None:
+            return self.duration_seconds
         cached_duration = cache.get('request_duration_{}'.format(self.id))
         if not cached_duration:
             duration = get_request_duration({'molecules': [m.as_dict for m in self.molecules.all()]})
@@ -325,8 +373,7 @@ class Target(models.Model):
     @property
     def as_dict(self):
         ret_dict = model_to_dict(self, exclude=self.SERIALIZER_EXCLUDE)
-        target_helper = TARGET_TYPE_HELPER_MAP[ret_dict['type'].upper()](ret_dict)
-        ret_dict = {k: ret_dict.get(k) for k in target_helper.fields}
+        ret_dict = {k: ret_dict.get(k) for k in get_target_fields(ret_dict['type'], ret_dict.get('scheme'))}
         return ret_dict
 
     @property
@@ -352,6 +399,50 @@ class Window(models.Model):
         return 'Window {}: {} to {}'.format(self.id, self.start, self.end)
 
 
+def update_window_bounds(request_id):
+    ''' Recomputes the persisted window bounds and semester of a request, and the window bounds of its user request,
+        after its windows have changed. Both are marked modified, so the change reaches the schedulable feed.
+    '''
+    now = timezone.now()
+    bounds = Window.objects.filter(request=request_id).aggregate(start=Min('start'), end=Max('end'))
+    semester = None
+    if bounds['start']:
+        semester = Semester.objects.filter(
+            start__lte=bounds['start'], end__gte=bounds['end']
+        ).order_by('-start').first()
+    Request.objects.filter(pk=request_id).update(
+        window_start=bounds['start'], window_end=bounds['end'], semester_code=semester.id if semester else '',
+        modified=now
+    )
+    user_request_id = Request.objects.filter(pk=request_id).values_list('user_request', flat=True).first()
+    if user_request_id:
+        bounds = Request.objects.filter(user_request=user_request_id).aggregate(
+            start=Min('window_start'), end=Max('window_end')
+        )
+        UserRequest.objects.filter(pk=user_request_id).update(
+            window_start=bounds['start'], window_end=bounds['end'], modified=now
+        )
+
+
+def update_molecule_fields(request_id):
+    ''' Updates the persisted instrument name and telescope class of a request after its molecules or location have
+        changed, and clears its persisted duration so it is calculated from the molecules when it is next needed.
+        The request and its user request are marked modified, so the change reaches the schedulable feed.
+    '''
+    now = timezone.now()
+    instrument_name = Molecule.objects.filter(request=request_id).order_by('id').values_list(
+        'instrument_name', flat=True
+    ).first()
+    telescope_class = Location.objects.filter(request=request_id).values_list('telescope_class', flat=True).first()
+    Request.objects.filter(pk=request_id).update(
+        duration_seconds=None, instrument_name=instrument_name or '', telescope_class=telescope_class or '',
+        modified=now
+    )
+    user_request_id = Request.objects.filter(pk=request_id).values_list('user_request', flat=True).first()
+    UserRequest.objects.filter(pk=user_request_id).update(modified=now)
+    cache.delete_many(['request_duration_{}'.format(request_id), 'userrequest_duration_{}'.format(user_request_id)])
+
+
 class Molecule(models.Model):
     # These are filled in from the molecule types possible in requestdb.
     # There are more molecule types that the pond will accept but scheduler will not.
@@ -488,3 +579,28 @@ class DraftUserRequest(models.Model):
 
     def __str__(self):
         return 'Draft request by: {} for proposal: {}'.format(self.author, self.proposal)
+
+
+class TelescopeAvailability(models.Model):
+    '''
+    The time a telescope was available on an observing night that has finished, tallied from its telescope states by
+    the update_telescope_availability task so past nights do not have to be recomputed from elasticsearch.
+    '''
+    site = models.CharField(max_length=20)
+    observatory = models.CharField(max_length=20)
+    telescope = models.CharField(max_length=20)
+    night = models.DateField(db_index=True)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    available = models.FloatField(help_text='Seconds the telescope was available')
+    total = models.FloatField(help_text='Seconds of the night tallied')
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('site', 'observatory', 'telescope', 'night')
+        unique_together = ('site', 'observatory', 'telescope', 'night')
+        verbose_name_plural = 'Telescope availabilities'
+
+    def __str__(self):
+        return '{}.{}.{} on {}: {:.3f} available'.format(self.site, self.observatory, self.telescope, self.night,
+                                                         self.available / self.total if self.total else 0)
@@ -0,0 +1,175 @@
+'''
+Compact serialization of the schedulable user requests pulled by the scheduler.
+
+The dictionaries are the same as UserRequest.as_dict builds, but each table is read with a single .values() query per
+batch of user requests and the rows are grouped in python, instead of instantiating every model and calling
+model_to_dict on it. The batches are generated lazily so the response can be streamed.
+
+The scheduler can also keep its own copy of the schedulable set up to date with get_schedulable_feed, which only
+returns the user requests that changed since a watermark.
+'''
+from django.core.cache import cache
+from django.db.models import Q
+from collections import defaultdict
+from datetime import timedelta
+from itertools import chain
+import json
+import logging
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from valhalla.proposals.models import TimeAllocationResolver
+from valhalla.userrequests.models import UserRequest, Request, Target, Molecule, Window, Location, Constraints
+from valhalla.userrequests.duration_utils import get_request_duration, get_total_duration_dict, OVERHEAD_ALLOWANCE
+from valhalla.userrequests.target_helpers import get_target_fields
+
+logger = logging.getLogger(__name__)
+
+SCHEDULABLE_BATCH_SIZE = 500
+TOTAL_DURATION_CACHE_TIMEOUT = 86400 * 30 * 6
+# changes are looked for this long before a watermark, so changes committed while the previous pull ran are not missed
+SCHEDULABLE_FEED_OVERLAP = timedelta(minutes=1)
+
+
+def get_dict_fields(model):
+    ''' Returns the fields model_to_dict includes for a model when excluding its SERIALIZER_EXCLUDE fields '''
+    opts = model._meta
+    exclude = getattr(model, 'SERIALIZER_EXCLUDE', ())
+    return tuple(f.name for f in chain(opts.concrete_fields, opts.private_fields, opts.many_to_many)
+                 if f.editable and f.name not in exclude)
+
+
+USERREQUEST_FIELDS = get_dict_fields(UserRequest)
+REQUEST_FIELDS = get_dict_fields(Request)
+REQUEST_CHILD_FIELDS = {model: get_dict_fields(model) for model in (Target, Molecule, Window, Location, Constraints)}
+
+
+def _rows_by_request(model, user_request_ids):
+    rows_by_request = defaultdict(list)
+    for row in model.objects.filter(request__user_request__in=user_request_ids).values(
+            'request', *REQUEST_CHILD_FIELDS[model]):
+        rows_by_request[row.pop('request')].append(row)
+    return rows_by_request
+
+
+def _target_dict(row):
+    return {k: row.get(k) for k in get_target_fields(row['type'], row.get('scheme'))}
+
+
+def _location_dict(row):
+    return {field: value for field, value in row.items() if value}
+
+
+def get_userrequest_dicts(user_request_rows):
+    ''' Builds the as_dict representation of a batch of user requests from their .values() rows '''
+    user_request_ids = [row['id'] for row in user_request_rows]
+    targets = _rows_by_request(Target, user_request_ids)
+    molecules = _rows_by_request(Molecule, user_request_ids)
+    windows = _rows_by_request(Window, user_request_ids)
+    locations = _rows_by_request(Location, user_request_ids)
+    constraints = _rows_by_request(Constraints, user_request_ids)
+
+    requests_by_ur = defaultdict(list)
+    for row in Request.objects.filter(user_request__in=user_request_ids).values(
+            'user_request', 'duration_seconds', *REQUEST_FIELDS):
+        user_request_id = row.pop('user_request')
+        duration = row.pop('duration_seconds')
+        request_molecules = molecules[row['id']]
+        row['duration'] = duration if duration is not None else get_request_duration({'molecules': request_molecules})
+        row['target'] = _target_dict(targets[row['id']][0])
+        row['molecules'] = request_molecules
+        row['location'] = _location_dict(locations[row['id']][0])
+        row['constraints'] = constraints[row['id']][0]
+        row['windows'] = windows[row['id']]
+        requests_by_ur[user_request_id].append(row)
+
+    ur_dicts = []
+    for row in user_request_rows:
+        ur_dict = {field: row[field] for field in USERREQUEST_FIELDS}
+        ur_dict['submitter'] = row['submitter__username']
+        ur_dict['requests'] = requests_by_ur[row['id']]
+        ur_dicts.append(ur_dict)
+    return ur_dicts
+
+
+def get_total_durations(ur_dicts):
+    ''' Returns the total duration dicts of a batch of user requests, from the cache UserRequest.total_duration uses
+        where they are there
+    '''
+    cache_keys = {'userrequest_duration_{}'.format(ur_dict['id']): ur_dict for ur_dict in ur_dicts}
+    total_durations = {}
+    missing = {}
+    for key, total_duration in cache.get_many(list(cache_keys.keys())).items():
+        total_durations[cache_keys[key]['id']] = total_duration
+    for key, ur_dict in cache_keys.items():
+        if ur_dict['id'] not in total_durations:
+            total_durations[ur_dict['id']] = missing[key] = get_total_duration_dict(ur_dict)
+    if missing:
+        cache.set_many(missing, TOTAL_DURATION_CACHE_TIMEOUT)
+    return total_durations
+
+
+def _has_time_left(ur_dict, total_duration_dict, time_allocations):
+    for tak, duration in total_duration_dict.items():
+        time_allocation = time_allocations.get(ur_dict['proposal'], tak)
+        if ur_dict['observation_type'] == UserRequest.NORMAL:
+            time_left = time_allocation.std_allocation - time_allocation.std_time_used
+        else:
+            time_left = time_allocation.too_allocation - time_allocation.too_time_used
+        if time_left * OVERHEAD_ALLOWANCE >= (duration / 3600.0):
+            return True
+        else:
+            logger.warning(
+                'not enough time left {0} in proposal {1} for ur {2} of duration {3}, skipping'.format(
+                    time_left, ur_dict['proposal'], ur_dict['id'], (duration / 3600.0)
+                )
+            )
+    return False
+
+
+def iter_schedulable_userrequests(queryset, batch_size=SCHEDULABLE_BATCH_SIZE):
+    '''
+    Generates the as_dict representations of the user requests in a queryset that still have time left in one of
+    their proposal's time allocations.
+    :param queryset: UserRequest queryset of the user requests to consider
+    :param batch_size: number of user requests whose related rows are fetched together
+    '''
+    user_request_rows = list(queryset.values('submitter__username', *USERREQUEST_FIELDS))
+    time_allocations = TimeAllocationResolver()
+    for i in range(0, len(user_request_rows), batch_size):
+        ur_dicts = get_userrequest_dicts(user_request_rows[i:i + batch_size])
+        time_allocations.load({ur_dict['proposal'] for ur_dict in ur_dicts})
+        total_durations = get_total_durations(ur_dicts)
+        for ur_dict in ur_dicts:
+            if _has_time_left(ur_dict, total_durations[ur_dict['id']], time_allocations):
+                yield ur_dict
+
+
+def get_schedulable_feed(queryset, since):
+    '''
+    Gets the changes to the schedulable set of user requests since a watermark. Changes to proposals and time
+    allocations are not tracked, so a full pull is still needed now and then to pick those up.
+    :param queryset: UserRequest queryset of the schedulable user requests
+    :param since: watermark datetime, usually the time the previous pull started
+    :return: tuple of the as_dicts of the user requests created, modified or with a request modified since the
+             watermark that are schedulable, and the sorted ids of the ones that changed and are not schedulable
+    '''
+    since = since - SCHEDULABLE_FEED_OVERLAP
+    changed_user_requests = UserRequest.objects.filter(modified__gte=since).order_by().values('id')
+    changed_requests = Request.objects.filter(modified__gte=since).order_by().values('user_request')
+    changed_ids = set(row['id'] for row in changed_user_requests)
+    changed_ids.update(row['user_request'] for row in changed_requests)
+
+    userrequests = list(iter_schedulable_userrequests(
+        queryset.filter(Q(pk__in=changed_user_requests) | Q(pk__in=changed_requests))
+    ))
+    removed = sorted(changed_ids - {ur_dict['id'] for ur_dict in userrequests})
+    return userrequests, removed
+
+
+def stream_json_list(items):
+    ''' Encodes an iterable as a json list one item at a time '''
+    yield '['
+    for i, item in enumerate(items):
+        yield (', ' if i else '') + json.dumps(item, cls=JSONEncoder)
+    yield ']'
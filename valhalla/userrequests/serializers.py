@@ -1,14 +1,15 @@
 from rest_framework import serializers
 from django.utils.translation import ugettext as _
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction
+from django.db import transaction, connection
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from json import JSONDecodeError
 import logging
 import json
 
-from valhalla.proposals.models import TimeAllocation, Membership
+from valhalla.proposals.models import Membership, TimeAllocationResolver
+from valhalla.accounts.models import add_time_used_in_proposal
 from valhalla.userrequests.models import Request, Target, Window, UserRequest, Location, Molecule, Constraints
 from valhalla.userrequests.models import DraftUserRequest
 from valhalla.userrequests.state_changes import debit_ipp_time, TimeAllocationError, validate_ipp
@@ -16,7 +17,8 @@ from valhalla.userrequests.target_helpers import TARGET_TYPE_HELPER_MAP
 from valhalla.common.configdb import configdb
 from valhalla.userrequests.request_utils import MOLECULE_TYPE_DISPLAY
 from valhalla.userrequests.duration_utils import (get_request_duration, get_request_duration_sum, get_total_duration_dict,
-                                                  OVERHEAD_ALLOWANCE, get_molecule_duration, get_num_exposures, get_semester_in)
+                                                  OVERHEAD_ALLOWANCE, get_molecule_duration, get_num_exposures,
+                                                  get_semester_in, get_denormalized_request_fields)
 from datetime import timedelta
 from valhalla.common.rise_set_utils import get_rise_set_intervals
 
@@ -358,7 +360,7 @@ class UserRequestSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UserRequest
-        fields = '__all__'
+        exclude = UserRequest.SERIALIZER_EXCLUDE
         read_only_fields = (
             'id', 'submitter', 'created', 'state', 'modified'
         )
@@ -369,28 +371,53 @@ class UserRequestSerializer(serializers.ModelSerializer):
 
     @transaction.atomic
     def create(self, validated_data):
+        total_duration_dict = get_total_duration_dict(validated_data)
         request_data = validated_data.pop('requests')
 
-        user_request = UserRequest.objects.create(**validated_data)
-
-        for r in request_data:
-            target_data = r.pop('target')
-            constraints_data = r.pop('constraints')
-            window_data = r.pop('windows')
-            molecule_data = r.pop('molecules')
-            location_data = r.pop('location')
-
-            request = Request.objects.create(user_request=user_request, **r)
-            Location.objects.create(request=request, **location_data)
-            Target.objects.create(request=request, **target_data)
-            Constraints.objects.create(request=request, **constraints_data)
-
-            for data in window_data:
-                Window.objects.create(request=request, **data)
-            for data in molecule_data:
-                Molecule.objects.create(request=request, **data)
+        request_fields = [get_denormalized_request_fields(r) for r in request_data]
+        user_request = UserRequest.objects.create(
+            window_start=min(fields['window_start'] for fields in request_fields),
+            window_end=max(fields['window_end'] for fields in request_fields),
+            **validated_data
+        )
 
-        debit_ipp_time(user_request)
+        child_data = []
+        requests = []
+        for r, fields in zip(request_data, request_fields):
+            child_data.append({
+                'target': r.pop('target'),
+                'constraints': r.pop('constraints'),
+                'windows': r.pop('windows'),
+                'molecules': r.pop('molecules'),
+                'location': r.pop('location')
+            })
+            requests.append(Request(user_request=user_request, **fields, **r))
+
+        # Insert each table in one go where the database returns the new ids. New rows have no state to change, so
+        # bypassing the state change signals is safe.
+        if connection.features.can_return_ids_from_bulk_insert:
+            Request.objects.bulk_create(requests)
+        else:
+            for request in requests:
+                request.save()
+
+        locations, targets, constraints, windows, molecules = [], [], [], [], []
+        for request, data in zip(requests, child_data):
+            locations.append(Location(request=request, **data['location']))
+            targets.append(Target(request=request, **data['target']))
+            constraints.append(Constraints(request=request, **data['constraints']))
+            windows.extend(Window(request=request, **window) for window in data['windows'])
+            molecules.extend(Molecule(request=request, **molecule) for molecule in data['molecules'])
+        Location.objects.bulk_create(locations)
+        Target.objects.bulk_create(targets)
+        Constraints.objects.bulk_create(constraints)
+        Window.objects.bulk_create(windows)
+        Molecule.objects.bulk_create(molecules)
+
+        debit_ipp_time(user_request, total_duration_dict)
+        add_time_used_in_proposal(
+            user_request.submitter, user_request.proposal, sum(fields['duration_seconds'] for fields in request_fields)
+        )
 
         logger.info('UserRequest created', extra={'tags': {'user': user_request.submitter.username,
                                                            'tracking_num': user_request.id,
@@ -420,6 +447,8 @@ class UserRequestSerializer(serializers.ModelSerializer):
         membership = Membership.objects.get(user=data['submitter'], proposal=data['proposal'])
         if membership.time_limit >= 0:
             duration = sum(d for _, d in get_request_duration_sum(data).items())
+            # requests of the same userrequest validated before these ones, as when a cadence is streamed
+            duration += self.context.get('preceding_duration', 0)
             time_to_be_used = data['submitter'].profile.time_used_in_proposal(data['proposal']) + duration
             if membership.time_limit < time_to_be_used:
                 raise serializers.ValidationError(
@@ -428,13 +457,13 @@ class UserRequestSerializer(serializers.ModelSerializer):
 
         try:
             total_duration_dict = get_total_duration_dict(data)
+            # the longest requests per time allocation of the same many userrequest validated before these ones
+            for tak, duration in self.context.get('preceding_total_durations', {}).items():
+                total_duration_dict[tak] = max(total_duration_dict.get(tak, 0.0), duration)
+            time_allocations = TimeAllocationResolver()
+            time_allocations.add_proposal(data['proposal'])
             for tak, duration in total_duration_dict.items():
-                time_allocation = TimeAllocation.objects.get(
-                    semester=tak.semester,
-                    telescope_class=tak.telescope_class,
-                    instrument_name=tak.instrument_name,
-                    proposal=data['proposal'],
-                )
+                time_allocation = time_allocations.get(data['proposal'].id, tak)
                 time_available = 0
                 if data['observation_type'] == UserRequest.NORMAL:
                     time_available = time_allocation.std_allocation - time_allocation.std_time_used
@@ -452,7 +481,7 @@ class UserRequestSerializer(serializers.ModelSerializer):
                             data['proposal'], tak.semester, tak.telescope_class)
                     )
             # validate the ipp debitting that will take place later
-            validate_ipp(data, total_duration_dict)
+            validate_ipp(data, total_duration_dict, time_allocations)
         except ObjectDoesNotExist:
             raise serializers.ValidationError(
                 _("You do not have sufficient time allocated on the instrument you're requesting for this proposal.")
@@ -1,31 +1,44 @@
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 
-from valhalla.userrequests.models import UserRequest, Request
+from valhalla.userrequests.models import (UserRequest, Request, Window, Molecule, Location, update_window_bounds,
+                                         update_molecule_fields)
 from valhalla.userrequests.state_changes import on_request_state_change, on_userrequest_state_change
 from valhalla.proposals.notifications import userrequest_notifications
 
 
 @receiver(pre_save, sender=UserRequest)
 def cb_userrequest_pre_save(sender, instance, *args, **kwargs):
-    # instance has the new data, query the model for the current data
-    # TODO refactor and make clear what is actually happening here
+    # instance has the new data, and remembers the state it was loaded from the database with
     if instance.id:
         # This is an update to the model
-        current_data = UserRequest.objects.get(pk=instance.pk)
-        on_userrequest_state_change(current_data, instance)
+        on_userrequest_state_change(instance.loaded_state, instance)
 
 
 @receiver(pre_save, sender=Request)
 def cb_request_pre_save(sender, instance, *args, **kwargs):
-    # instance has the new data, query the model for the current data
-    # TODO refactor and make clear what is actually happening here
+    # instance has the new data, and remembers the state it was loaded from the database with
     if instance.id:
         # This is an update to the model
-        current_data = Request.objects.get(pk=instance.pk)
-        on_request_state_change(current_data, instance)
+        on_request_state_change(instance.loaded_state, instance)
 
 
 @receiver(post_save, sender=UserRequest)
 def cb_userrequest_send_notifications(sender, instance, *args, **kwargs):
     userrequest_notifications(instance)
+
+
+@receiver(post_save, sender=Window)
+@receiver(post_delete, sender=Window)
+def cb_window_changed(sender, instance, *args, **kwargs):
+    # windows created in bulk by the userrequest serializer bypass this, and set the window bounds themselves
+    update_window_bounds(instance.request_id)
+
+
+@receiver(post_save, sender=Molecule)
+@receiver(post_delete, sender=Molecule)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def cb_molecules_changed(sender, instance, *args, **kwargs):
+    # molecules and locations created in bulk by the userrequest serializer bypass this, and set the fields themselves
+    update_molecule_fields(instance.request_id)
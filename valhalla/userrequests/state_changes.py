@@ -1,12 +1,13 @@
 from django.utils import timezone
 from django.db import transaction
+from django.db.models import F, prefetch_related_objects
 from django.utils.translation import ugettext as _
 
-from valhalla.proposals.models import TimeAllocation, TimeAllocationKey
+from valhalla.proposals.models import TimeAllocation, TimeAllocationKey, TimeAllocationResolver
 from valhalla.userrequests.request_utils import exposure_completion_percentage_from_pond_block
 from valhalla.userrequests.models import UserRequest, Request
 
-import itertools
+from collections import defaultdict
 import logging
 import dateutil.parser
 from math import isclose
@@ -24,6 +25,9 @@ REQUEST_STATE_MAP = {
 
 TERMINAL_STATES = ['COMPLETED', 'CANCELED', 'WINDOW_EXPIRED']
 
+# number of user requests whose pond block updates are loaded, locked and written together
+STATE_UPDATE_BATCH_SIZE = 500
+
 
 class InvalidStateChange(Exception):
     pass
@@ -36,36 +40,80 @@ def valid_state_change(old_state, new_state, obj):
         ))
 
 
+def get_ipp_modification(old_state, new_state, ipp_value):
+    ''' Returns whether a request's ipp time should be 'credit'ed or 'debit'ed for a valid state transition, or None
+    '''
+    if new_state == 'COMPLETED':
+        if ipp_value < 1.0:
+            return 'credit'
+        elif old_state == 'WINDOW_EXPIRED':
+            return 'debit'
+    elif new_state in ['CANCELED', 'WINDOW_EXPIRED'] and ipp_value >= 1.0:
+        return 'credit'
+    return None
+
+
 @transaction.atomic
-def on_request_state_change(old_request, new_request):
-    if old_request.state == new_request.state:
+def on_request_state_change(old_state, new_request):
+    if old_state == new_request.state:
         return
-    valid_state_change(old_request.state, new_request.state, old_request)
+    valid_state_change(old_state, new_request.state, new_request)
     # it must be a valid transition, so do time accounting here
     if new_request.state == 'COMPLETED':
         new_request.completed = timezone.now()
+    if new_request.state in ['COMPLETED', 'CANCELED', 'WINDOW_EXPIRED']:
         ipp_value = new_request.user_request.ipp_value
-        if ipp_value < 1.0:
-            modify_ipp_time_from_requests(ipp_value, [new_request], 'credit')
-        else:
-            if old_request.state == 'WINDOW_EXPIRED':
-                try:
-                    modify_ipp_time_from_requests(ipp_value, [new_request], 'debit')
-                except TimeAllocationError as tae:
-                    logger.warning(_('Request {} switched from WINDOW_EXPIRED to COMPLETED but did not have enough '
-                                     'ipp_time to debit: {}').format(new_request, repr(tae)))
-
-    if new_request.state == 'CANCELED' or new_request.state == 'WINDOW_EXPIRED':
-        ipp_value = new_request.user_request.ipp_value
-        if ipp_value >= 1.0:
-            modify_ipp_time_from_requests(ipp_value, [new_request], 'credit')
+        modification = get_ipp_modification(old_state, new_request.state, ipp_value)
+        if modification:
+            modify_ipp_time_from_requests(ipp_value, [new_request], modification)
 
 
 @transaction.atomic
-def on_userrequest_state_change(old_userrequest, new_userrequest):
-    if old_userrequest.state == new_userrequest.state:
+def bulk_request_state_change(requests, new_state):
+    '''
+    Transitions many requests to a new state at once. The requests are locked and their states re-read, requests for
+    which the transition is not valid are left alone, the ipp accounting for the rest is done in one batch and their
+    states are set with a single update.
+    :param requests: iterable of requests or request ids
+    :param new_state: the state to transition the requests to
+    :return: list of the requests that changed state
+    '''
+    request_ids = [getattr(request, 'id', request) for request in requests]
+    locked_requests = Request.objects.select_for_update().filter(pk__in=request_ids).select_related(
+        'user_request'
+    ).prefetch_related('windows', 'molecules', 'location')
+    changed_requests = []
+    ipp_modifications = {'credit': [], 'debit': []}
+    for request in locked_requests:
+        if request.state == new_state or new_state not in REQUEST_STATE_MAP[request.state]:
+            continue
+        ipp_value = request.user_request.ipp_value
+        modification = get_ipp_modification(request.state, new_state, ipp_value)
+        if modification:
+            ipp_modifications[modification].append((ipp_value, request))
+        changed_requests.append(request)
+
+    for modification, ipp_values_and_requests in ipp_modifications.items():
+        bulk_modify_ipp_time(ipp_values_and_requests, modification)
+
+    now = timezone.now()
+    updates = {'state': new_state, 'modified': now}
+    if new_state == 'COMPLETED':
+        updates['completed'] = now
+    Request.objects.filter(pk__in=[request.id for request in changed_requests]).update(**updates)
+    for request in changed_requests:
+        for field, value in updates.items():
+            setattr(request, field, value)
+        request._loaded_state = new_state
+
+    return changed_requests
+
+
+@transaction.atomic
+def on_userrequest_state_change(old_state, new_userrequest):
+    if old_state == new_userrequest.state:
         return
-    valid_state_change(old_userrequest.state, new_userrequest.state, old_userrequest)
+    valid_state_change(old_state, new_userrequest.state, new_userrequest)
     if new_userrequest.state == 'COMPLETED':
         if new_userrequest.ipp_value >= 1.0 and new_userrequest.operator == 'oneof':
             requests_to_credit = new_userrequest.requests_set.filter(state__in=['PENDING', 'SCHEDULED'])
@@ -76,15 +124,15 @@ def on_userrequest_state_change(old_userrequest, new_userrequest):
             r.save()
 
 
-def validate_ipp(ur_dict, total_duration_dict):
+def validate_ipp(ur_dict, total_duration_dict, time_allocations=None):
     ipp_value = ur_dict['ipp_value'] - 1
     if ipp_value <= 0:
         return
 
-    time_allocations_dict = {tak: TimeAllocation.objects.get(semester__id=tak.semester,
-                                                             telescope_class=tak.telescope_class,
-                                                             instrument_name=tak.instrument_name,
-                                                             proposal__id=ur_dict['proposal']).ipp_time_available
+    if time_allocations is None:
+        time_allocations = TimeAllocationResolver()
+    proposal_id = getattr(ur_dict['proposal'], 'id', ur_dict['proposal'])
+    time_allocations_dict = {tak: time_allocations.get(proposal_id, tak).ipp_time_available
                              for tak in total_duration_dict.keys()}
 
     for tak, duration in total_duration_dict.items():
@@ -103,32 +151,67 @@ def validate_ipp(ur_dict, total_duration_dict):
         time_allocations_dict[tak] -= (duration_hours * ipp_value)
 
 
-def debit_ipp_time(ur):
+def debit_ipp_time(ur, total_duration_dict=None, time_allocations=None):
     ipp_value = ur.ipp_value - 1
     if ipp_value <= 0:
         return
     try:
-        time_allocations = ur.timeallocations
-        time_allocations_dict = {TimeAllocationKey(ta.semester.id, ta.telescope_class, ta.instrument_name): ta
-                                 for ta in time_allocations.all()}
+        if total_duration_dict is None:
+            total_duration_dict = ur.total_duration
+        if time_allocations is None:
+            time_allocations = TimeAllocationResolver()
+            time_allocations.add_proposal(ur.proposal)
 
-        total_duration_dict = ur.total_duration
         for tak, duration in total_duration_dict.items():
             duration_hours = duration / 3600.0
-            time_allocations_dict[tak].ipp_time_available -= (ipp_value * duration_hours)
-            time_allocations_dict[tak].save()
+            time_allocation = time_allocations.get(ur.proposal_id, tak)
+            time_allocation.ipp_time_available -= (ipp_value * duration_hours)
+            time_allocation.save()
     except Exception as e:
         logger.warning(_("Problem debitting ipp on creation for ur {} on proposal {}: {}")
                        .format(ur.id, ur.proposal.id, repr(e)))
 
 
 def modify_ipp_time_from_requests(ipp_val, requests_list, modification='debit'):
-    ipp_value = ipp_val - 1
-    if ipp_value == 0:
-        return
-    try:
-        for request in requests_list:
-            time_allocation = request.timeallocation
+    bulk_modify_ipp_time([(ipp_val, request) for request in requests_list], modification)
+
+
+def _get_request_time_allocation(request, time_allocations):
+    proposal_id = request.user_request.proposal_id
+    if request.semester_code:
+        return time_allocations.get(proposal_id, TimeAllocationKey(request.semester_code, request.telescope_class,
+                                                                   request.instrument_name))
+    # requests whose time allocation columns have not been backfilled yet are matched on their windows
+    min_window_time = request.min_window_time
+    max_window_time = request.max_window_time
+    instrument_name = request.molecules.all()[0].instrument_name
+    matching = [ta for ta in time_allocations.get_all(proposal_id) if ta.semester.start <= min_window_time and
+                ta.semester.end >= max_window_time and ta.telescope_class == request.location.telescope_class and
+                ta.instrument_name == instrument_name]
+    if len(matching) != 1:
+        raise TimeAllocation.DoesNotExist(
+            _('Found {} time allocations for request {}').format(len(matching), request.id)
+        )
+    return matching[0]
+
+
+def bulk_modify_ipp_time(ipp_values_and_requests, modification='debit', time_allocations=None):
+    '''
+    Debits or credits the ipp time of many requests in one pass. The time allocations of each proposal are fetched once,
+    the modifications are applied to them in order, and each modified time allocation is saved once at the end.
+    :param ipp_values_and_requests: list of (ipp_value, request) tuples
+    :param modification: 'debit' or 'credit'
+    :param time_allocations: TimeAllocationResolver to look the time allocations up in
+    '''
+    if time_allocations is None:
+        time_allocations = TimeAllocationResolver()
+    modified_time_allocations = {}
+    for ipp_val, request in ipp_values_and_requests:
+        ipp_value = ipp_val - 1
+        if ipp_value == 0:
+            continue
+        try:
+            time_allocation = _get_request_time_allocation(request, time_allocations)
             duration_hours = request.duration / 3600.0
             modified_time = time_allocation.ipp_time_available
             if modification == 'debit':
@@ -144,9 +227,12 @@ def modify_ipp_time_from_requests(ipp_val, requests_list, modification='debit'):
                                  "Time available after crediting will be capped at ipp_limit"))
                 modified_time = time_allocation.ipp_limit
             time_allocation.ipp_time_available = modified_time
-            time_allocation.save()
-    except Exception as e:
-        logger.warning(_("Problem {}ing ipp time for request {}: {}").format(modification, request.id, repr(e)))
+            modified_time_allocations[time_allocation.id] = time_allocation
+        except Exception as e:
+            logger.warning(_("Problem {}ing ipp time for request {}: {}").format(modification, request.id, repr(e)))
+
+    for time_allocation in modified_time_allocations.values():
+        time_allocation.save()
 
 
 def get_request_state_from_pond_blocks(request_state, acceptability_threshold, request_blocks):
@@ -172,16 +258,16 @@ def get_request_state_from_pond_blocks(request_state, acceptability_threshold, r
     return request_state
 
 
-def update_request_state(request, request_blocks, ur_expired):
-    '''Update a request state given a set of pond blocks for that request'''
-    if request.state == 'COMPLETED':
-        return False
-
-    state_changed = False
+def get_new_request_state(request_state, acceptability_threshold, request_blocks, ur_expired):
+    '''
+    Computes the state a request should move to given a set of pond blocks for that request.
+    :return: tuple of the new state, the fail_count increment, and whether a failure was recorded
+    '''
+    failed = False
     fail_count = 0
 
     # Get the state from the pond blocks
-    new_r_state = get_request_state_from_pond_blocks(request.state, request.acceptability_threshold, request_blocks)
+    new_r_state = get_request_state_from_pond_blocks(request_state, acceptability_threshold, request_blocks)
     # update the fail_count if the pond state was failed, before overwriting pond state
     if new_r_state == 'FAILED':
         fail_count = 1
@@ -189,9 +275,20 @@ def update_request_state(request, request_blocks, ur_expired):
     if new_r_state not in TERMINAL_STATES and ur_expired:
         new_r_state = 'WINDOW_EXPIRED'
     # If the state was the 'FAILED' fake state, switch it to pending but record that the state has changed
-    elif new_r_state == 'FAILED' and request.state not in TERMINAL_STATES:
+    elif new_r_state == 'FAILED' and request_state not in TERMINAL_STATES:
         new_r_state = 'PENDING'
-        state_changed = True
+        failed = True
+    return new_r_state, fail_count, failed
+
+
+def update_request_state(request, request_blocks, ur_expired):
+    '''Update a request state given a set of pond blocks for that request'''
+    if request.state == 'COMPLETED':
+        return False
+
+    new_r_state, fail_count, state_changed = get_new_request_state(
+        request.state, request.acceptability_threshold, request_blocks, ur_expired
+    )
     with transaction.atomic():
         # Re-get the request and lock. If the new state is a valid state transition, set it on the request atomically.
         req = Request.objects.select_for_update().get(pk=request.id)
@@ -207,11 +304,16 @@ def update_request_state(request, request_blocks, ur_expired):
 def aggregate_request_states(user_request):
     '''Aggregate the state of the user request from all of its child request states'''
     request_states = [request.state for request in Request.objects.filter(user_request=user_request)]
+    return get_aggregate_state(user_request.operator, request_states)
+
+
+def get_aggregate_state(operator, request_states):
+    '''Aggregate a user request state from a list of its child request states'''
     # Set the priority ordering - assume AND by default
     state_priority = ['WINDOW_EXPIRED', 'PENDING', 'COMPLETED', 'CANCELED']
-    if user_request.operator == 'ONEOF':
+    if operator == 'ONEOF':
         state_priority = ['COMPLETED', 'PENDING', 'WINDOW_EXPIRED', 'CANCELED']
-    elif user_request.operator == 'MANY':
+    elif operator == 'MANY':
         state_priority = ['PENDING', 'COMPLETED', 'WINDOW_EXPIRED', 'CANCELED']
 
     for state in state_priority:
@@ -224,43 +326,111 @@ def aggregate_request_states(user_request):
 def update_request_states_for_window_expiration():
     '''Update the state of all requests and user_requests to WINDOW_EXPIRED if their last window has passed'''
     now = timezone.now()
+    expired_request_ids = list(Request.objects.filter(state='PENDING', window_end__lt=now).exclude(
+        user_request__state__in=TERMINAL_STATES
+    ).values_list('id', flat=True))
     states_changed = False
-    for user_request in UserRequest.objects.exclude(state__in=TERMINAL_STATES):
-        request_states_changed = False
-        for request in user_request.requests.filter(state='PENDING').prefetch_related('windows'):
-            if request.max_window_time < now:
+
+    for request_ids in _chunked(expired_request_ids):
+        with transaction.atomic():
+            expired_requests = bulk_request_state_change(request_ids, 'WINDOW_EXPIRED')
+            for request in expired_requests:
                 logger.info('Expiring request %s', request.id, extra={'tags': {'request_num': request.id}})
-                with transaction.atomic():
-                    req = Request.objects.select_for_update().get(pk=request.id)
-                    if req.state == 'PENDING':
-                        req.state = 'WINDOW_EXPIRED'
-                        states_changed = True
-                        request_states_changed = True
-                        req.save()
-        if request_states_changed:
-            update_user_request_state(user_request)
+                states_changed = True
+            update_user_request_states({request.user_request_id for request in expired_requests})
 
     return states_changed
 
 
 def update_request_states_from_pond_blocks(pond_blocks):
-    '''Update the states of requests and user_requests given a set of recently changed pond blocks.'''
-    blocks_with_tracking_nums = [pb for pb in pond_blocks if pb['molecules'][0]['tracking_num']]
-    sorted_blocks_with_tracking_nums = sorted(blocks_with_tracking_nums, key=lambda x: x['molecules'][0]['tracking_num'])
-    blocks_by_tracking_num = itertools.groupby(sorted_blocks_with_tracking_nums, lambda x: x['molecules'][0]['tracking_num'])
-    now = timezone.now()
+    '''
+    Update the states of requests and user_requests given a set of recently changed pond blocks. The affected user
+    requests are processed in batches: each batch is locked and loaded in a few queries, the new states are computed in
+    memory, and the requests are written with one update per distinct change.
+    '''
+    blocks_by_request_num = defaultdict(list)
+    for pb in pond_blocks:
+        tracking_num = pb['molecules'][0]['tracking_num']
+        if tracking_num:
+            blocks_by_request_num[(int(tracking_num), int(pb['molecules'][0]['request_num']))].append(pb)
+    tracking_nums = sorted({tracking_num for tracking_num, request_num in blocks_by_request_num})
     states_changed = False
 
-    for tracking_num, blocks in blocks_by_tracking_num:
-        sorted_blocks_by_request = sorted(blocks, key=lambda x: x['molecules'][0]['request_num'])
-        blocks_by_request_num = {int(k): list(v) for k, v in itertools.groupby(sorted_blocks_by_request, key=lambda x: x['molecules'][0]['request_num'])}
-        user_request = UserRequest.objects.prefetch_related('requests').get(pk=tracking_num)
-        ur_expired = user_request.max_window_time < now
-        requests = user_request.requests.all()
-        for request in requests:
-            if request.id in blocks_by_request_num:
-                states_changed |= update_request_state(request, blocks_by_request_num[request.id], ur_expired)
-        states_changed |= update_user_request_state(user_request)
+    for i in range(0, len(tracking_nums), STATE_UPDATE_BATCH_SIZE):
+        states_changed |= _update_request_states_for_user_requests(
+            tracking_nums[i:i + STATE_UPDATE_BATCH_SIZE], blocks_by_request_num
+        )
+
+    return states_changed
+
+
+def _chunked(items, size=STATE_UPDATE_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@transaction.atomic
+def _update_request_states_for_user_requests(tracking_nums, blocks_by_request_num):
+    now = timezone.now()
+    # lock the user requests and then their requests, in id order so concurrent updates can't deadlock
+    user_requests = list(UserRequest.objects.select_for_update().filter(pk__in=tracking_nums).order_by('id'))
+    requests_by_ur = defaultdict(list)
+    for request in Request.objects.select_for_update().filter(
+            user_request__in=tracking_nums).order_by('id').prefetch_related('windows'):
+        requests_by_ur[request.user_request_id].append(request)
+
+    states_changed = False
+    updates = defaultdict(list)
+    ipp_modifications = {'credit': [], 'debit': []}
+    new_request_states = {}
+    for user_request in user_requests:
+        ur_expired = max(request.max_window_time for request in requests_by_ur[user_request.id]) < now
+        for request in requests_by_ur[user_request.id]:
+            request_blocks = blocks_by_request_num.get((user_request.id, request.id))
+            if not request_blocks or request.state == 'COMPLETED':
+                continue
+            new_r_state, fail_count, failed = get_new_request_state(
+                request.state, request.acceptability_threshold, request_blocks, ur_expired
+            )
+            states_changed |= failed
+            if new_r_state in REQUEST_STATE_MAP[request.state]:
+                states_changed = True
+                request.user_request = user_request
+                modification = get_ipp_modification(request.state, new_r_state, user_request.ipp_value)
+                if modification:
+                    ipp_modifications[modification].append((user_request.ipp_value, request))
+                new_request_states[request.id] = new_r_state
+            else:
+                new_r_state = None
+            updates[(new_r_state, fail_count)].append(request.id)
+
+    requests_to_modify = [request for values_and_requests in ipp_modifications.values()
+                          for ipp_value, request in values_and_requests]
+    prefetch_related_objects(requests_to_modify, 'molecules', 'location')
+    for modification, ipp_values_and_requests in ipp_modifications.items():
+        bulk_modify_ipp_time(ipp_values_and_requests, modification)
+
+    # every request with blocks is written even if its state is unchanged, which marks it as modified
+    for (new_r_state, fail_count), request_ids in updates.items():
+        fields = {'modified': now}
+        if new_r_state:
+            fields['state'] = new_r_state
+            if new_r_state == 'COMPLETED':
+                fields['completed'] = now
+        if fail_count:
+            fields['fail_count'] = F('fail_count') + fail_count
+        for ids in _chunked(request_ids):
+            Request.objects.filter(pk__in=ids).update(**fields)
+
+    for user_request in user_requests:
+        request_states = [new_request_states.get(request.id, request.state)
+                          for request in requests_by_ur[user_request.id]]
+        new_ur_state = get_aggregate_state(user_request.operator, request_states)
+        if new_ur_state in REQUEST_STATE_MAP[user_request.state]:
+            # saved one at a time so the user request state change accounting and notifications still run
+            user_request.state = new_ur_state
+            user_request.save()
+            states_changed = True
 
     return states_changed
 
@@ -277,6 +447,23 @@ def update_user_request_state(user_request):
     return False
 
 
+def update_user_request_states(user_request_ids):
+    '''Update the states of many user requests from the current states of their requests'''
+    request_states = defaultdict(list)
+    for user_request_id, state in Request.objects.filter(user_request__in=user_request_ids).values_list(
+            'user_request', 'state'):
+        request_states[user_request_id].append(state)
+    states_changed = False
+    with transaction.atomic():
+        for user_request in UserRequest.objects.select_for_update().filter(pk__in=user_request_ids).order_by('id'):
+            new_ur_state = get_aggregate_state(user_request.operator, request_states[user_request.id])
+            if new_ur_state in REQUEST_STATE_MAP[user_request.state]:
+                user_request.state = new_ur_state
+                user_request.save()
+                states_changed = True
+    return states_changed
+
+
 class AggregateStateException(Exception):
     '''Raised when we fail to aggregate request states into a user request state'''
     pass
@@ -1,4 +1,5 @@
 from django.utils.translation import ugettext as _
+from functools import lru_cache
 from numbers import Number
 
 
@@ -115,3 +116,9 @@ TARGET_TYPE_HELPER_MAP = {
     'SATELLITE': SatelliteTargetHelper,
     'STATIC': SiderealTargetHelper,
 }
+
+
+@lru_cache(maxsize=None)
+def get_target_fields(target_type, scheme=None):
+    ''' Returns the fields the target helper of a target type (and non sidereal scheme) keeps, computed once '''
+    return TARGET_TYPE_HELPER_MAP[target_type.upper()]({'type': target_type, 'scheme': scheme}).fields
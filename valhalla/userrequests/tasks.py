@@ -1,7 +1,13 @@
 from celery import shared_task
+from django.contrib.auth.models import User, AnonymousUser
+from django.utils import timezone
 import logging
 
+from valhalla.common.telescope_states import ElasticSearchException
+from valhalla.common.downtimedb import DowntimeDB, DowntimeDBException
 from valhalla.userrequests.state_changes import update_request_states_for_window_expiration
+from valhalla.userrequests import availability
+from valhalla.userrequests.jobs import JOB_FUNCTIONS, JOB_ERROR_MSG, JobRequest, create_job, get_job, set_job
 
 logger = logging.getLogger(__name__)
 
@@ -10,3 +16,51 @@ logger = logging.getLogger(__name__)
 def expire_requests():
     logger.info('Expiring requests')
     update_request_states_for_window_expiration()
+
+
+@shared_task
+def update_telescope_availability(days=availability.AVAILABILITY_ROLLUP_DAYS):
+    logger.info('Updating telescope availability for the last {} days'.format(days))
+    try:
+        availability.update_telescope_availability(days=days)
+    except ElasticSearchException:
+        logger.warning('Error connecting to ElasticSearch, telescope availability was not updated')
+
+
+@shared_task
+def update_downtime():
+    logger.info('Updating downtime')
+    try:
+        downtime_index = DowntimeDB.update_downtime_index()
+        logger.info('Downtime is at generation {}'.format(downtime_index.generation))
+    except DowntimeDBException as e:
+        logger.warning('{}, the downtime was not updated'.format(repr(e)))
+
+
+@shared_task
+def run_job(job_id, job_type, data, user_id=None):
+    job = get_job(job_id)
+    if not job:
+        logger.warning('Job {} expired before it could run'.format(job_id))
+        return
+    job['state'] = 'RUNNING'
+    set_job(job)
+    user = User.objects.get(pk=user_id) if user_id else AnonymousUser()
+    try:
+        job['result'], job['status_code'] = JOB_FUNCTIONS[job_type](data, JobRequest(user))
+        job['state'] = 'COMPLETED'
+    except Exception:
+        logger.exception('Job {} of type {} failed'.format(job_id, job_type))
+        job['result'], job['status_code'] = {'errors': [JOB_ERROR_MSG]}, 500
+        job['state'] = 'FAILED'
+    job['completed'] = timezone.now()
+    set_job(job)
+
+
+def submit_job(job_type, data, user):
+    ''' Queues up a job to compute the result of an api call asynchronously, returning the job to poll for the result
+    '''
+    job, created = create_job(job_type, data, user.id if user.is_authenticated else None)
+    if created:
+        run_job.delay(job['id'], job_type, data, job['user'])
+    return get_job(job['id']) or job
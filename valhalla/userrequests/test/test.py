@@ -1,14 +1,16 @@
 from django.utils import timezone
 from django.test import TestCase
+from django.core.management import call_command
 from mixer.backend.django import mixer
 from datetime import datetime
+from io import StringIO
 import math
 
 from valhalla.userrequests.models import Request, Molecule, Target, UserRequest, Window, Location, Constraints
 from valhalla.proposals.models import Proposal, TimeAllocation, Semester
 from valhalla.common.configdb import ConfigDBException
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
-from valhalla.userrequests.duration_utils import PER_MOLECULE_STARTUP_TIME, PER_MOLECULE_GAP
+from valhalla.userrequests.duration_utils import PER_MOLECULE_STARTUP_TIME, PER_MOLECULE_GAP, get_request_duration
 
 
 class TestUserRequestTotalDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
@@ -345,3 +347,88 @@ class TestRequestDuration(ConfigDBTestMixin, SetTimeMixin, TestCase):
         with self.assertRaises(ConfigDBException) as context:
             bad_molecule.duration
             self.assertTrue('not found in configdb' in context.exception)
+
+
+class TestDenormalizedRequestFields(ConfigDBTestMixin, SetTimeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        mixer.blend(Semester, id='2016B', start=datetime(2016, 9, 1, tzinfo=timezone.utc),
+                    end=datetime(2016, 12, 31, tzinfo=timezone.utc))
+        self.user_request = mixer.blend(UserRequest, operator='MANY')
+        self.requests = mixer.cycle(2).blend(Request, user_request=self.user_request)
+        mixer.cycle(2).blend(
+            Molecule, request=(r for r in self.requests), bin_x=2, bin_y=2, instrument_name='1M0-SCICAM-SBIG',
+            exposure_time=600, exposure_count=2, type='EXPOSE', filter='blah'
+        )
+        mixer.cycle(2).blend(Location, request=(r for r in self.requests), telescope_class='1m0')
+        mixer.cycle(2).blend(
+            Window, request=(r for r in self.requests), start=datetime(2016, 9, 29, tzinfo=timezone.utc),
+            end=(e for e in [datetime(2016, 10, 29, tzinfo=timezone.utc), datetime(2016, 11, 5, tzinfo=timezone.utc)])
+        )
+
+    def test_window_changes_update_window_bounds(self):
+        window = mixer.blend(Window, request=self.requests[0], start=datetime(2016, 9, 10, tzinfo=timezone.utc),
+                             end=datetime(2016, 9, 20, tzinfo=timezone.utc))
+        self.requests[0].refresh_from_db()
+        self.user_request.refresh_from_db()
+        self.assertEqual(self.requests[0].window_start, datetime(2016, 9, 10, tzinfo=timezone.utc))
+        self.assertEqual(self.requests[0].window_end, datetime(2016, 10, 29, tzinfo=timezone.utc))
+        self.assertEqual(self.requests[0].semester_code, '2016B')
+        self.assertEqual(self.user_request.window_start, datetime(2016, 9, 10, tzinfo=timezone.utc))
+        self.assertEqual(self.user_request.window_end, datetime(2016, 11, 5, tzinfo=timezone.utc))
+
+        window.delete()
+        self.user_request.refresh_from_db()
+        self.assertEqual(self.user_request.window_start, datetime(2016, 9, 29, tzinfo=timezone.utc))
+
+    def test_molecule_and_location_changes_update_request_fields(self):
+        molecule = self.requests[0].molecules.first()
+        molecule.exposure_count = 4
+        molecule.save()
+        request = Request.objects.get(pk=self.requests[0].id)
+        self.assertIsNone(request.duration_seconds)
+        self.assertEqual(request.duration, get_request_duration({'molecules': [molecule.as_dict]}))
+
+        location = self.requests[0].location
+        location.telescope_class = '2m0'
+        location.save()
+        self.requests[0].refresh_from_db()
+        self.assertEqual(self.requests[0].telescope_class, '2m0')
+
+        molecule.delete()
+        self.requests[0].refresh_from_db()
+        self.assertEqual(self.requests[0].instrument_name, '')
+
+    def test_window_molecule_and_location_changes_mark_requests_modified(self):
+        long_ago = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        changes = [
+            lambda: mixer.blend(Window, request=self.requests[0], start=datetime(2016, 9, 10, tzinfo=timezone.utc),
+                                end=datetime(2016, 9, 20, tzinfo=timezone.utc)),
+            lambda: self.requests[0].molecules.first().save(),
+            lambda: self.requests[0].location.save()
+        ]
+        for change in changes:
+            Request.objects.update(modified=long_ago)
+            UserRequest.objects.update(modified=long_ago)
+            change()
+            self.assertGreater(Request.objects.get(pk=self.requests[0].id).modified, long_ago)
+            self.assertGreater(UserRequest.objects.get(pk=self.user_request.id).modified, long_ago)
+            self.assertEqual(Request.objects.get(pk=self.requests[1].id).modified, long_ago)
+
+    def test_backfill_fills_in_missing_fields(self):
+        Request.objects.update(window_start=None, window_end=None, semester_code='')
+        UserRequest.objects.update(window_start=None, window_end=None)
+
+        call_command('backfill_request_fields', stdout=StringIO())
+
+        for request in self.requests:
+            request.refresh_from_db()
+            self.assertEqual(request.window_start, datetime(2016, 9, 29, tzinfo=timezone.utc))
+            self.assertEqual(request.duration_seconds, get_request_duration(
+                {'molecules': [molecule.as_dict for molecule in request.molecules.all()]}
+            ))
+            self.assertEqual(request.semester_code, '2016B')
+            self.assertEqual(request.instrument_name, '1M0-SCICAM-SBIG')
+            self.assertEqual(request.telescope_class, '1m0')
+        self.user_request.refresh_from_db()
+        self.assertEqual(self.user_request.window_end, datetime(2016, 11, 5, tzinfo=timezone.utc))
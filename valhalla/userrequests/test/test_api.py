@@ -5,13 +5,21 @@ from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
 import valhalla.userrequests.signals.handlers  # noqa
 from valhalla.userrequests.test.test_state_changes import PondMolecule, PondBlock
 from valhalla.userrequests.contention import Pressure
+from valhalla.userrequests.serializers import UserRequestSerializer
+from valhalla.userrequests.jobs import JobRequest, JOB_ERROR_MSG
+from valhalla.userrequests.state_changes import bulk_request_state_change
 from valhalla.accounts.models import Profile
 
 from django.urls import reverse
 from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from rest_framework.test import APITestCase
+from rest_framework.utils.encoders import JSONEncoder
 from mixer.backend.django import mixer
 from mixer.main import mixer as basic_mixer
 from django.utils import timezone
@@ -23,7 +31,7 @@ import copy
 import json
 import random
 from urllib import parse
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
 generic_payload = {
     'proposal': 'temp',
@@ -307,6 +315,34 @@ class TestUserPostRequestApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['errors']['operator'][0], 'This field is required.')
 
+    def test_post_userrequest_inserts_each_child_table_once(self):
+        good_data = self.generic_payload.copy()
+        good_data['operator'] = 'MANY'
+        good_data['requests'] = [copy.deepcopy(good_data['requests'][0]) for _ in range(5)]
+        serializer = UserRequestSerializer(data=good_data, context={'request': JobRequest(self.user)})
+        self.assertTrue(serializer.is_valid())
+        with CaptureQueriesContext(connection) as context:
+            user_request = serializer.save()
+        self.assertEqual(user_request.requests.count(), 5)
+        self.assertEqual(Window.objects.filter(request__user_request=user_request).count(), 5)
+        for table in ('window', 'molecule', 'target', 'location', 'constraints'):
+            inserts = [q for q in context.captured_queries
+                       if q['sql'].startswith('INSERT INTO "userrequests_{}"'.format(table))]
+            self.assertEqual(len(inserts), 1)
+
+    def test_post_userrequest_persists_window_bounds_and_duration(self):
+        response = self.client.post(reverse('api:user_requests-list'), data=self.generic_payload)
+        self.assertEqual(response.status_code, 201)
+        user_request = UserRequest.objects.get(pk=response.json()['id'])
+        request = user_request.requests.first()
+        self.assertEqual(request.window_start, request.min_window_time)
+        self.assertEqual(request.window_end, request.max_window_time)
+        self.assertEqual(request.duration_seconds, response.json()['requests'][0]['duration'])
+        self.assertEqual(request.time_allocation_key, (request.semester_code, request.telescope_class,
+                                                       request.instrument_name))
+        self.assertEqual(user_request.window_end, user_request.max_window_time)
+        self.assertNotIn('window_end', response.json())
+
     def test_post_userrequest_duration_too_long(self):
         bad_data = self.generic_payload.copy()
         bad_data['requests'][0]['molecules'][0]['exposure_time'] = 999999999999
@@ -390,6 +426,18 @@ class TestUserRequestIPP(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         time_allocation = TimeAllocation.objects.get(pk=self.time_allocation_1m0_sbig.id)
         self.assertLess(time_allocation.ipp_time_available, 5.0)
 
+    def test_time_allocation_queries_do_not_grow_with_requests(self):
+        def count_time_allocation_queries(request_count):
+            ur = copy.deepcopy(self.generic_payload)
+            ur['operator'] = 'MANY' if request_count > 1 else 'SINGLE'
+            ur['requests'] = [copy.deepcopy(self.generic_payload['requests'][0]) for _ in range(request_count)]
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(reverse('api:user_requests-list'), data=ur)
+            self.assertEqual(response.status_code, 201)
+            return len([q for q in context.captured_queries if 'proposals_timeallocation' in q['sql']])
+
+        self.assertEqual(count_time_allocation_queries(1), count_time_allocation_queries(10))
+
     def test_user_request_credit_ipp_on_cancelation(self):
         user_request = self._build_user_request(self.generic_payload.copy())
         # verify that now that the TimeAllocation has been debited
@@ -504,6 +552,18 @@ class TestRequestIPP(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         time_allocation = TimeAllocation.objects.get(pk=self.time_allocation_1m0.id)
         self.assertEqual(time_allocation.ipp_time_available, debitted_ipp_value)
 
+    def test_bulk_cancel_credits_ipp(self):
+        user_request = self._build_user_request(self.generic_payload.copy())
+        time_allocation = TimeAllocation.objects.get(pk=self.time_allocation_1m0.id)
+        self.assertLess(time_allocation.ipp_time_available, 5.0)
+        changed_requests = bulk_request_state_change(user_request.requests.all(), 'CANCELED')
+        self.assertEqual(len(changed_requests), 1)
+        self.assertEqual(user_request.requests.first().state, 'CANCELED')
+        time_allocation = TimeAllocation.objects.get(pk=self.time_allocation_1m0.id)
+        self.assertEqual(time_allocation.ipp_time_available, 5.0)
+        # canceled requests cannot be canceled again, so nothing more is credited
+        self.assertFalse(bulk_request_state_change(user_request.requests.all(), 'CANCELED'))
+
     @patch('valhalla.userrequests.state_changes.logger')
     def test_request_debit_on_completion_after_expired_not_enough_time(self, mock_logger):
         user_request = self._build_user_request(self.generic_payload.copy())
@@ -681,6 +741,67 @@ class TestCadenceApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json()['requests']), 2)
 
+    def test_post_cadence_streamed(self):
+        response = self.client.post(reverse('api:user_requests-cadence') + '?stream=true', data=self.generic_payload)
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(len(lines[0]['request']['windows']), 1)
+        self.assertEqual(lines[-1]['summary'], {'operator': 'MANY', 'request_count': 2, 'errors': {}})
+
+    def test_post_cadence_streamed_invalid_before_streaming(self):
+        bad_data = self.generic_payload.copy()
+        bad_data['proposal'] = mixer.blend(Proposal).id
+        response = self.client.post(reverse('api:user_requests-cadence') + '?stream=true', data=bad_data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('do not belong to the proposal', str(response.json()))
+
+    @patch('valhalla.userrequests.jobs.CADENCE_CHUNK_SIZE', 1)
+    def test_post_cadence_streamed_stops_at_first_invalid_chunk(self):
+        expanded = self.client.post(reverse('api:user_requests-cadence'), data=self.generic_payload).json()
+        durations = self.client.post(reverse('api:user_requests-validate'), data=expanded).json()['request_durations']
+        mixer.blend(Profile, user=self.user)
+        # room for the first request of the cadence, but not for both
+        Membership.objects.filter(user=self.user).update(time_limit=durations['requests'][0]['duration'] * 1.5)
+
+        response = self.client.post(reverse('api:user_requests-cadence') + '?stream=true', data=self.generic_payload)
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['request'], expanded['requests'][0])
+        self.assertEqual(lines[-1]['summary']['request_count'], 1)
+        self.assertIn('exceed the time limit', str(lines[-1]['summary']['errors']))
+
+    @patch('valhalla.userrequests.jobs.CADENCE_CHUNK_SIZE', 1)
+    def test_post_cadence_streamed_stops_when_a_later_chunk_crosses_the_time_allocation(self):
+        longer_request = copy.deepcopy(generic_payload['requests'][0])
+        longer_request['molecules'][0]['exposure_time'] = 1000
+        self.generic_payload['requests'].append(longer_request)
+        expanded = self.client.post(reverse('api:user_requests-cadence'), data=self.generic_payload).json()
+        durations = self.client.post(reverse('api:user_requests-validate'), data=expanded).json()['request_durations']
+        # enough time for the cadence requests, but not for the longer request after them
+        cadence_duration, longer_duration = durations['requests'][0]['duration'], durations['requests'][-1]['duration']
+        self.time_allocation_1m0.std_allocation = (cadence_duration + longer_duration) / 2 / 3600 / 1.1
+        self.time_allocation_1m0.save()
+
+        response = self.client.post(reverse('api:user_requests-cadence'), data=self.generic_payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('does not have enough time allocated', str(response.content))
+
+        response = self.client.post(reverse('api:user_requests-cadence') + '?stream=true', data=self.generic_payload)
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['request'] for line in lines[:-1]], expanded['requests'][:2])
+        self.assertEqual(lines[-1]['summary']['operator'], 'MANY')
+        self.assertEqual(lines[-1]['summary']['request_count'], 2)
+        self.assertIn('does not have enough time allocated', str(lines[-1]['summary']['errors']))
+
+    def test_post_cadence_streamed_single_request_reports_its_operator(self):
+        self.generic_payload['requests'][0]['cadence']['end'] = '2016-09-02T06:12:19Z'
+        response = self.client.post(reverse('api:user_requests-cadence') + '?stream=true', data=self.generic_payload)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(lines[-1]['summary'], {'operator': 'SINGLE', 'request_count': 1, 'errors': {}})
+
     def test_cadence_invalid(self):
         bad_data = self.generic_payload.copy()
         bad_data['requests'][0]['cadence']['jitter'] = 'bug'
@@ -1612,6 +1733,103 @@ class TestAirmassApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         self.assertTrue(response.json()['airmass_data']['tst']['times'])
 
 
+@override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default-test'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'locmem-test'}
+    }
+)
+class TestAsyncJobApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.proposal = mixer.blend(Proposal)
+        self.user = mixer.blend(User)
+        mixer.blend(Profile, user=self.user)
+        self.client.force_login(self.user)
+        semester = mixer.blend(
+            Semester, id='2016B', start=datetime(2016, 9, 1, tzinfo=timezone.utc),
+            end=datetime(2016, 12, 31, tzinfo=timezone.utc)
+        )
+        mixer.blend(
+            TimeAllocation, proposal=self.proposal, semester=semester,
+            telescope_class='1m0', instrument_name='1M0-SCICAM-SBIG', std_allocation=100.0, std_time_used=0.0,
+            too_allocation=10, too_time_used=0.0, ipp_limit=10.0, ipp_time_available=5.0
+        )
+        mixer.blend(Membership, user=self.user, proposal=self.proposal)
+        self.generic_payload = copy.deepcopy(generic_payload)
+        self.generic_payload['proposal'] = self.proposal.id
+
+    def test_async_validation_matches_sync_validation(self):
+        response = self.client.post(reverse('api:user_requests-validate') + '?async=true', data=self.generic_payload)
+        self.assertEqual(response.status_code, 202)
+        job_response = self.client.get(response.json()['url'])
+        self.assertEqual(job_response.json()['state'], 'COMPLETED')
+        self.assertEqual(job_response.json()['status_code'], 200)
+        sync_response = self.client.post(reverse('api:user_requests-validate'), data=self.generic_payload)
+        self.assertEqual(job_response.json()['result'], sync_response.json())
+
+    @patch('valhalla.userrequests.tasks.run_job.delay')
+    def test_identical_pending_jobs_are_reused(self, run_job_delay):
+        url = reverse('api:user_requests-validate') + '?async=true'
+        first_response = self.client.post(url, data=self.generic_payload)
+        second_response = self.client.post(url, data=self.generic_payload)
+        self.assertEqual(first_response.json()['id'], second_response.json()['id'])
+        self.generic_payload['group_id'] = 'another title'
+        third_response = self.client.post(url, data=self.generic_payload)
+        self.assertNotEqual(first_response.json()['id'], third_response.json()['id'])
+        self.assertEqual(run_job_delay.call_count, 2)
+
+    def test_identical_finished_jobs_are_not_reused(self):
+        url = reverse('api:user_requests-validate') + '?async=true'
+        first_response = self.client.post(url, data=self.generic_payload)
+        self.assertEqual(self.client.get(first_response.json()['url']).json()['state'], 'COMPLETED')
+        second_response = self.client.post(url, data=self.generic_payload)
+        self.assertNotEqual(first_response.json()['id'], second_response.json()['id'])
+
+    def test_jobs_are_only_visible_to_their_user(self):
+        response = self.client.post(reverse('api:user_requests-validate') + '?async=true', data=self.generic_payload)
+        self.client.force_login(mixer.blend(User))
+        job_response = self.client.get(response.json()['url'])
+        self.assertEqual(job_response.status_code, 404)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+        'locmem': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    })
+    def test_jobs_run_synchronously_without_a_shared_cache(self):
+        response = self.client.post(reverse('api:user_requests-validate') + '?async=true', data=self.generic_payload)
+        self.assertEqual(response.status_code, 200)
+        sync_response = self.client.post(reverse('api:user_requests-validate'), data=self.generic_payload)
+        self.assertEqual(response.json(), sync_response.json())
+
+    def test_unknown_job_not_found(self):
+        response = self.client.get(reverse('api:job', kwargs={'job_id': 'abc123'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_async_cadence(self):
+        del self.generic_payload['requests'][0]['windows']
+        self.generic_payload['requests'][0]['cadence'] = {
+            'start': '2016-09-01T21:12:18Z',
+            'end': '2016-09-03T22:12:19Z',
+            'period': 24.0,
+            'jitter': 12.0
+        }
+        response = self.client.post(reverse('api:user_requests-cadence') + '?async=true', data=self.generic_payload)
+        job_response = self.client.get(response.json()['url'])
+        self.assertEqual(job_response.json()['status_code'], 200)
+        self.assertEqual(len(job_response.json()['result']['requests']), 2)
+
+    def test_failed_job_reports_error(self):
+        with patch.dict('valhalla.userrequests.jobs.JOB_FUNCTIONS', {'validate': Mock(side_effect=ValueError)}):
+            response = self.client.post(reverse('api:user_requests-validate') + '?async=true',
+                                        data=self.generic_payload)
+        job_response = self.client.get(response.json()['url'])
+        self.assertEqual(job_response.json()['state'], 'FAILED')
+        self.assertEqual(job_response.json()['status_code'], 500)
+        self.assertEqual(job_response.json()['result'], {'errors': [JOB_ERROR_MSG]})
+
+
 @patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
 class TestCancelUserrequestApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
     ''' Test canceling user requests via API. Mocking out modify_ipp_time_from_requets
@@ -1866,6 +2084,63 @@ class TestSchedulableRequestsApi(ConfigDBTestMixin, SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:user_requests-schedulable-requests'))
         self.assertEqual(response.status_code, 403)
 
+    def test_compact_serialization_matches_as_dict(self, modify_mock):
+        target = self.urs[0].requests.first().target
+        target.type = 'NON_SIDEREAL'
+        target.scheme = 'MPC_COMET'
+        target.save()
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+
+        expected = {ur.id: ur.as_dict for ur in self.urs}
+        for ur in response.json():
+            self.assertEqual(ur, json.loads(json.dumps(expected[ur['id']], cls=JSONEncoder)))
+
+    def test_streamed_response_matches(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        streamed_response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?stream=true')
+        self.assertEqual(json.loads(b''.join(streamed_response.streaming_content).decode()), response.json())
+
+    def test_since_returns_only_changed_userrequests(self, modify_mock):
+        last_week = timezone.now() - timedelta(days=7)
+        UserRequest.objects.update(modified=last_week)
+        Request.objects.update(modified=last_week)
+        since = timezone.now() - timedelta(days=1)
+        changed_request = self.urs[0].requests.first()
+        changed_request.observation_note = 'changed'
+        changed_request.save()
+        self.urs[1].state = 'CANCELED'
+        self.urs[1].save()
+
+        response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?since=' +
+                                   parse.quote(since.isoformat()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([ur['id'] for ur in response.json()['userrequests']], [self.urs[0].id])
+        self.assertEqual(response.json()['removed'], [self.urs[1].id])
+
+        since = timezone.now() + timedelta(minutes=5)
+        response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?since=' +
+                                   parse.quote(since.isoformat()))
+        self.assertEqual(response.json()['userrequests'], [])
+        self.assertEqual(response.json()['removed'], [])
+
+    def test_since_must_be_a_datetime(self, modify_mock):
+        response = self.client.get(reverse('api:user_requests-schedulable-requests') + '?since=yesterday-ish')
+        self.assertEqual(response.status_code, 400)
+
+    def test_query_count_does_not_grow_with_userrequests(self, modify_mock):
+        # the first request loads the semesters saved in setUp into the process cache
+        self.client.get(reverse('api:user_requests-schedulable-requests'))
+        with CaptureQueriesContext(connection) as all_queries:
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(len(response.json()), 10)
+        for ur in self.urs[5:]:
+            ur.state = 'CANCELED'
+            ur.save()
+        with CaptureQueriesContext(connection) as fewer_queries:
+            response = self.client.get(reverse('api:user_requests-schedulable-requests'))
+        self.assertEqual(len(response.json()), 5)
+        self.assertEqual(len(all_queries), len(fewer_queries))
+
 
 class TestContention(ConfigDBTestMixin, APITestCase):
     def setUp(self):
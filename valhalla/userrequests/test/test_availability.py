@@ -0,0 +1,76 @@
+from django.utils import timezone
+from datetime import datetime
+from unittest.mock import patch
+
+from valhalla.userrequests.availability import update_telescope_availability, get_telescope_availability_per_day
+from valhalla.userrequests.models import TelescopeAvailability
+from valhalla.common import telescope_states
+from valhalla.common.test_telescope_states import TelescopeStatesFakeInput
+
+
+@patch('valhalla.common.telescope_states.get_site_rise_set_intervals')
+class TestTelescopeAvailabilityRollup(TelescopeStatesFakeInput):
+    def setUp(self):
+        super().setUp()
+        self.intervals = [(datetime(2016, 9, 30, 18, 30, 0, tzinfo=timezone.utc),
+                           datetime(2016, 9, 30, 21, 0, 0, tzinfo=timezone.utc)),
+                          (datetime(2016, 10, 1, 18, 30, 0, tzinfo=timezone.utc),
+                           datetime(2016, 10, 1, 21, 0, 0, tzinfo=timezone.utc)),
+                          (datetime(2016, 10, 2, 18, 30, 0, tzinfo=timezone.utc),
+                           datetime(2016, 10, 2, 21, 0, 0, tzinfo=timezone.utc)),
+                          (datetime(2016, 10, 3, 18, 30, 0, tzinfo=timezone.utc),
+                           datetime(2016, 10, 3, 21, 0, 0, tzinfo=timezone.utc))]
+        self.start = datetime(2016, 9, 30, tzinfo=timezone.utc)
+        self.end = datetime(2016, 10, 3, 19, tzinfo=timezone.utc)
+
+    def test_only_finished_nights_are_stored(self, mock_intervals):
+        mock_intervals.return_value = self.intervals
+        update_telescope_availability(end=self.end, days=3)
+
+        nights = TelescopeAvailability.objects.filter(site=self.tk1.site, observatory=self.tk1.observatory,
+                                                      telescope=self.tk1.telescope)
+        self.assertEqual([night.night for night in nights], [datetime(2016, 10, 1).date(),
+                                                             datetime(2016, 10, 2).date()])
+        self.assertEqual(TelescopeAvailability.objects.count(), 4)
+
+    def test_stored_nights_match_computed_nights(self, mock_intervals):
+        mock_intervals.return_value = self.intervals
+        end = datetime(2016, 10, 3, tzinfo=timezone.utc)
+        expected = telescope_states.get_telescope_availability_per_day(self.start, end)
+        update_telescope_availability(end=end, days=3)
+
+        with patch('valhalla.userrequests.availability.get_telescope_availability_per_night',
+                   wraps=telescope_states.get_telescope_availability_per_night) as mock_nights:
+            availability = get_telescope_availability_per_day(self.start, end)
+
+        self.assertEqual(availability, expected)
+        # only the time before and after the stored nights is computed
+        self.assertEqual([call[0][:2] for call in mock_nights.call_args_list],
+                         [(self.start, datetime(2016, 10, 1, 18, 30, tzinfo=timezone.utc)),
+                          (datetime(2016, 10, 2, 21, tzinfo=timezone.utc), end)])
+
+    def test_nights_before_the_stored_ones_are_computed(self, mock_intervals):
+        mock_intervals.return_value = self.intervals
+        end = datetime(2016, 10, 3, tzinfo=timezone.utc)
+        expected = telescope_states.get_telescope_availability_per_day(self.start, end)
+        update_telescope_availability(end=end, days=3)
+        # as if the task had only stored the last night so far
+        TelescopeAvailability.objects.filter(night=datetime(2016, 10, 1).date()).delete()
+
+        self.assertEqual(get_telescope_availability_per_day(self.start, end), expected)
+
+    def test_night_stored_for_one_telescope_is_computed_for_the_others(self, mock_intervals):
+        mock_intervals.return_value = self.intervals
+        end = datetime(2016, 10, 3, tzinfo=timezone.utc)
+        expected = telescope_states.get_telescope_availability_per_day(self.start, end)
+        update_telescope_availability(end=end, days=3)
+        # as if the night had been cut off for the second telescope when the task ran
+        TelescopeAvailability.objects.filter(night=datetime(2016, 10, 1).date(), observatory=self.tk2.observatory,
+                                             telescope=self.tk2.telescope).delete()
+
+        self.assertEqual(get_telescope_availability_per_day(self.start, end), expected)
+
+    def test_nothing_stored_computes_everything(self, mock_intervals):
+        mock_intervals.return_value = self.intervals
+        self.assertEqual(get_telescope_availability_per_day(self.start, self.end),
+                         telescope_states.get_telescope_availability_per_day(self.start, self.end))
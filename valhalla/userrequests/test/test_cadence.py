@@ -1,10 +1,12 @@
 from django.test import TestCase
 from mixer.backend.django import mixer
 from django.utils import timezone
+from unittest.mock import patch
 import datetime
 
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
-from valhalla.userrequests.cadence import expand_cadence_request
+from valhalla.common.rise_set_utils import get_rise_set_intervals
+from valhalla.userrequests.cadence import expand_cadence_request, get_largest_interval_within
 from valhalla.userrequests.models import Request, Molecule, Target, Constraints, Location
 
 
@@ -68,3 +70,34 @@ class TestCadence(SetTimeMixin, ConfigDBTestMixin, TestCase):
 
         requests = expand_cadence_request(r_dict)
         self.assertEqual(len(requests), 5)
+
+    @patch('valhalla.userrequests.cadence.get_rise_set_intervals', wraps=get_rise_set_intervals)
+    def test_rise_set_computed_once_for_whole_cadence(self, mock_intervals):
+        r_dict = self.req.as_dict
+        r_dict['cadence'] = {
+            'start': datetime.datetime(2016, 9, 1, tzinfo=timezone.utc),
+            'end': datetime.datetime(2016, 10, 1, tzinfo=timezone.utc),
+            'period': 1.0,
+            'jitter': 2.0
+        }
+
+        requests = expand_cadence_request(r_dict)
+        self.assertEqual(mock_intervals.call_count, 1)
+        self.assertTrue(requests)
+        for request in requests:
+            self.assertEqual(len(request['windows']), 1)
+            self.assertLessEqual(request['windows'][0]['end'] - request['windows'][0]['start'],
+                                 datetime.timedelta(hours=2))
+
+    def test_largest_interval_within_window(self):
+        start = datetime.datetime(2016, 9, 1, tzinfo=timezone.utc)
+        intervals = [(start, start + datetime.timedelta(hours=1)),
+                     (start + datetime.timedelta(hours=2), start + datetime.timedelta(hours=5))]
+        interval_ends = [interval[1] for interval in intervals]
+
+        largest = get_largest_interval_within(intervals, interval_ends, start + datetime.timedelta(minutes=30),
+                                              start + datetime.timedelta(hours=3))
+        self.assertEqual(largest, datetime.timedelta(hours=1))
+        largest = get_largest_interval_within(intervals, interval_ends, start + datetime.timedelta(hours=5),
+                                              start + datetime.timedelta(hours=6))
+        self.assertEqual(largest, datetime.timedelta(seconds=0))
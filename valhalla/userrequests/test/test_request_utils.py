@@ -1,5 +1,6 @@
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
 from mixer.backend.django import mixer
 from datetime import datetime
 from unittest.mock import patch
@@ -10,6 +11,9 @@ from valhalla.userrequests.models import Request, Molecule, Target, UserRequest,
 from valhalla.proposals.models import Proposal, TimeAllocation, Semester
 from valhalla.common.test_telescope_states import TelescopeStatesFakeInput
 from valhalla.common.test_helpers import ConfigDBTestMixin, SetTimeMixin
+from valhalla.common.test_downtimedb import DOWNTIME_CACHES
+from valhalla.common.downtimedb import DowntimeDB
+from valhalla.common.tiered_cache import clear_local_caches
 
 
 class BaseSetupRequest(ConfigDBTestMixin, SetTimeMixin, TestCase):
@@ -44,7 +48,13 @@ class BaseSetupRequest(ConfigDBTestMixin, SetTimeMixin, TestCase):
         mixer.blend(Constraints, request=self.request)
 
 
+@override_settings(CACHES=DOWNTIME_CACHES)
 class TestRequestIntervals(BaseSetupRequest):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        clear_local_caches()
+
     def test_request_intervals_for_one_week(self):
         intervals = get_rise_set_intervals(self.request.as_dict)
 
@@ -82,6 +92,7 @@ class TestRequestIntervals(BaseSetupRequest):
                                        'telescope': '1m0a',
                                        'reason': 'Whatever'}
                                       ]
+        DowntimeDB.update_downtime_index()
 
         intervals = get_rise_set_intervals(self.request.as_dict)
 
@@ -143,6 +154,7 @@ class TestRequestIntervals(BaseSetupRequest):
                                        'telescope': '1m0a',
                                        'reason': 'Whatever'},
                                       ]
+        DowntimeDB.update_downtime_index()
 
         intervals = get_rise_set_intervals(self.request.as_dict)
 
@@ -172,6 +184,7 @@ class TestRequestIntervals(BaseSetupRequest):
                                        'telescope': '1m0a',
                                        'reason': 'Whatever'}
                                       ]
+        DowntimeDB.update_downtime_index()
 
         intervals = get_rise_set_intervals(self.request.as_dict)
 
@@ -206,6 +219,7 @@ class TestRequestIntervals(BaseSetupRequest):
                                        'telescope': '1m0a',
                                        'reason': 'Whatever'}
                                       ]
+        DowntimeDB.update_downtime_index()
 
         intervals = get_rise_set_intervals(self.request.as_dict)
 
@@ -267,6 +281,7 @@ class TestRequestIntervals(BaseSetupRequest):
                                        'telescope': '1m0a',
                                        'reason': 'Whatever'}
                                       ]
+        DowntimeDB.update_downtime_index()
 
         intervals = get_rise_set_intervals(self.request.as_dict)
 
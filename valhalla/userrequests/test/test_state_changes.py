@@ -1,4 +1,6 @@
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from mixer.main import mixer
 from mixer.backend.django import mixer as dmixer
 from django.utils import timezone
@@ -8,7 +10,7 @@ from unittest.mock import patch
 from valhalla.userrequests.models import Request, UserRequest, Window
 from valhalla.userrequests.state_changes import (
     get_request_state_from_pond_blocks, update_request_state, aggregate_request_states,
-    update_request_states_from_pond_blocks, update_request_states_for_window_expiration
+    update_request_states_from_pond_blocks, update_request_states_for_window_expiration, InvalidStateChange
 )
 
 
@@ -688,6 +690,36 @@ class TestUpdateRequestStates(TestCase):
         self.ur.refresh_from_db()
         self.assertEqual(self.ur.state, 'COMPLETED')
 
+    def _failed_pond_blocks(self, user_requests):
+        now = timezone.now()
+        pond_blocks = []
+        for ur in user_requests:
+            for request in ur.requests.all():
+                dmixer.blend(Window, request=request, start=now - timedelta(days=2), end=now + timedelta(days=1))
+                molecules = mixer.cycle(3).blend(PondMolecule, completed=False, failed=True, request_num=request.id,
+                                                 tracking_num=ur.id, event=[])
+                pond_blocks.append(mixer.blend(PondBlock, molecules=molecules, start=now - timedelta(minutes=30),
+                                               end=now - timedelta(minutes=20), canceled=False)._to_dict())
+        return pond_blocks
+
+    def test_query_count_does_not_grow_with_blocks(self, modify_mock):
+        few_blocks = self._failed_pond_blocks([self.ur])
+        more_urs = dmixer.cycle(5).blend(UserRequest, operator='MANY', state='PENDING')
+        for ur in more_urs:
+            dmixer.cycle(3).blend(Request, user_request=ur, state='PENDING')
+        many_blocks = self._failed_pond_blocks(more_urs)
+
+        with CaptureQueriesContext(connection) as few_queries:
+            self.assertTrue(update_request_states_from_pond_blocks(few_blocks))
+        with CaptureQueriesContext(connection) as many_queries:
+            self.assertTrue(update_request_states_from_pond_blocks(many_blocks))
+
+        self.assertEqual(len(few_queries), len(many_queries))
+        for ur in more_urs:
+            for request in ur.requests.all():
+                self.assertEqual(request.state, 'PENDING')
+                self.assertEqual(request.fail_count, 1)
+
 
 @patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
 class TestExpireRequests(TestCase):
@@ -724,3 +756,80 @@ class TestExpireRequests(TestCase):
         request.refresh_from_db()
         self.assertFalse(result)
         self.assertEqual(request.state, 'COMPLETED')
+
+    def test_userrequest_is_set_to_expired_with_its_requests(self, ipp_mock):
+        requests = dmixer.cycle(3).blend(Request, state='PENDING', user_request=self.userrequest)
+        dmixer.cycle(3).blend(Window, request=(r for r in requests), start=timezone.now() - timedelta(days=2),
+                              end=timezone.now() - timedelta(days=1))
+        other_userrequest = dmixer.blend(UserRequest, state='PENDING')
+        other_request = dmixer.blend(Request, state='PENDING', user_request=other_userrequest)
+        dmixer.blend(Window, request=other_request, start=timezone.now() - timedelta(days=2),
+                     end=timezone.now() + timedelta(days=1))
+
+        self.assertTrue(update_request_states_for_window_expiration())
+        self.userrequest.refresh_from_db()
+        other_userrequest.refresh_from_db()
+        self.assertEqual(self.userrequest.state, 'WINDOW_EXPIRED')
+        self.assertEqual(other_userrequest.state, 'PENDING')
+        for request in requests:
+            request.refresh_from_db()
+            self.assertEqual(request.state, 'WINDOW_EXPIRED')
+
+    def test_query_count_does_not_grow_with_expired_requests(self, ipp_mock):
+        self.userrequest.operator = 'MANY'
+        self.userrequest.save()
+
+        def expiring_requests(count):
+            requests = dmixer.cycle(count + 1).blend(Request, state='PENDING', user_request=self.userrequest)
+            dmixer.cycle(count).blend(Window, request=(r for r in requests[:count]),
+                                      start=timezone.now() - timedelta(days=2), end=timezone.now() - timedelta(days=1))
+            # one request is still schedulable, so the user request stays pending
+            dmixer.blend(Window, request=requests[count], start=timezone.now() - timedelta(days=2),
+                         end=timezone.now() + timedelta(days=1))
+
+        expiring_requests(1)
+        with CaptureQueriesContext(connection) as few_queries:
+            self.assertTrue(update_request_states_for_window_expiration())
+        expiring_requests(10)
+        with CaptureQueriesContext(connection) as many_queries:
+            self.assertTrue(update_request_states_for_window_expiration())
+
+        self.assertEqual(len(few_queries), len(many_queries))
+        self.assertEqual(self.userrequest.requests.filter(state='WINDOW_EXPIRED').count(), 11)
+
+
+class TestLoadedState(TestCase):
+    def setUp(self):
+        self.userrequest = dmixer.blend(UserRequest, state='PENDING', ipp_value=1.0)
+        self.request = dmixer.blend(Request, state='PENDING', user_request=self.userrequest)
+
+    def test_loaded_state_tracks_database_state(self):
+        request = Request.objects.get(pk=self.request.id)
+        request.state = 'SCHEDULED'
+        self.assertEqual(request.loaded_state, 'PENDING')
+        request.save()
+        self.assertEqual(request.loaded_state, 'SCHEDULED')
+        Request.objects.filter(pk=request.id).update(state='PENDING')
+        request.refresh_from_db()
+        self.assertEqual(request.loaded_state, 'PENDING')
+
+    def test_loaded_state_of_unloaded_instance_is_looked_up(self):
+        request = Request(id=self.request.id, state='SCHEDULED')
+        self.assertEqual(request.loaded_state, 'PENDING')
+
+    def test_state_change_does_not_refetch_request(self):
+        request = Request.objects.get(pk=self.request.id)
+        request.state = 'SCHEDULED'
+        with CaptureQueriesContext(connection) as context:
+            request.save()
+        selects = [q for q in context.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(selects, [])
+
+    @patch('valhalla.userrequests.state_changes.modify_ipp_time_from_requests')
+    def test_invalid_state_change_still_rejected(self, modify_mock):
+        request = Request.objects.get(pk=self.request.id)
+        request.state = 'COMPLETED'
+        request.save()
+        request.state = 'PENDING'
+        with self.assertRaises(InvalidStateChange):
+            request.save()
@@ -17,12 +17,12 @@ from rest_framework.views import APIView
 import logging
 
 from valhalla.common.configdb import configdb
-from valhalla.common.telescope_states import (TelescopeStates, get_telescope_availability_per_day,
-                                              combine_telescope_availabilities_by_site_and_class,
+from valhalla.common.telescope_states import (TelescopeStates, combine_telescope_availabilities_by_site_and_class,
                                               ElasticSearchException)
-from valhalla.userrequests.request_utils import get_airmasses_for_request_at_sites
+from valhalla.userrequests.availability import get_telescope_availability_per_day
 from valhalla.userrequests.models import UserRequest, Request
-from valhalla.userrequests.serializers import RequestSerializer
+from valhalla.userrequests.jobs import is_async_request, async_job_response, get_airmasses, get_job, job_data
+from valhalla.userrequests.tasks import submit_job
 from valhalla.userrequests.filters import UserRequestFilter
 from valhalla.userrequests.state_changes import update_request_states_from_pond_blocks
 from valhalla.userrequests.contention import Contention, Pressure
@@ -168,11 +168,21 @@ class AirmassView(APIView):
     permission_classes = (AllowAny,)
 
     def post(self, request):
-        serializer = RequestSerializer(data=request.data)
-        if serializer.is_valid():
-            return Response(get_airmasses_for_request_at_sites(serializer.validated_data))
-        else:
-            return Response(serializer.errors)
+        if is_async_request(request):
+            return async_job_response(submit_job('airmass', request.data, request.user))
+        ret_data, status = get_airmasses(request.data, request)
+        return Response(ret_data, status=status)
+
+
+class JobView(APIView):
+    ''' Polls for the state and result of an asynchronous api job '''
+    permission_classes = (AllowAny,)
+
+    def get(self, request, job_id):
+        job = get_job(job_id)
+        if not job or (job['user'] and job['user'] != request.user.id):
+            return Response({'detail': 'Not found.'}, status=404)
+        return Response(job_data(job))
 
 
 class InstrumentsInformationView(APIView):
@@ -2,22 +2,28 @@ from rest_framework import viewsets, filters
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser
+from rest_framework.utils.encoders import JSONEncoder
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from dateutil.parser import parse
+import itertools
 import logging
+import json
 
-from valhalla.proposals.models import Proposal, Semester, TimeAllocation
+from valhalla.proposals.models import Proposal, Semester
 from valhalla.userrequests.models import UserRequest, Request, DraftUserRequest
 from valhalla.userrequests.filters import UserRequestFilter, RequestFilter
-from valhalla.userrequests.cadence import expand_cadence_request
 from valhalla.userrequests.serializers import RequestSerializer, UserRequestSerializer
-from valhalla.userrequests.serializers import DraftUserRequestSerializer, CadenceRequestSerializer
-from valhalla.userrequests.duration_utils import (get_request_duration_dict, get_max_ipp_for_userrequest,
-                                                  OVERHEAD_ALLOWANCE)
+from valhalla.userrequests.serializers import DraftUserRequestSerializer
+from valhalla.userrequests.duration_utils import get_max_ipp_for_userrequest
 from valhalla.userrequests.state_changes import InvalidStateChange, TERMINAL_STATES
-from valhalla.userrequests.request_utils import (get_airmasses_for_request_at_sites,
-                                                 get_telescope_states_for_request)
+from valhalla.userrequests.request_utils import get_airmasses_for_request_at_sites
+from valhalla.userrequests.jobs import (is_async_request, async_job_response, validate_userrequest,
+                                        validate_cadence_requests, iter_validated_cadence_chunks,
+                                        expand_cadence_userrequest, get_telescope_states)
+from valhalla.userrequests.tasks import submit_job
+from valhalla.userrequests.schedulable import iter_schedulable_userrequests, get_schedulable_feed, stream_json_list
 logger = logging.getLogger(__name__)
 
 
@@ -57,7 +63,9 @@ class UserRequestViewSet(viewsets.ModelViewSet):
         '''
             Gets the set of schedulable User requests for the scheduler, should be called right after isDirty finishes
             Needs a start and end time specified as the range of time to get requests in. Usually this is the entire
-            semester for a scheduling run.
+            semester for a scheduling run. With a since datetime, only the User requests that changed since then are
+            returned, along with the ids of the ones that are no longer schedulable and a cursor to pass as the next
+            since.
         '''
         current_semester = Semester.current_semesters().first()
         start = parse(request.query_params.get('start', str(current_semester.start))).replace(tzinfo=timezone.utc)
@@ -66,43 +74,27 @@ class UserRequestViewSet(viewsets.ModelViewSet):
         # Schedulable requests are not in a terminal state, are part of an active proposal,
         # and have a window within this semester
         queryset = UserRequest.objects.exclude(state__in=TERMINAL_STATES).filter(
+            window_start__lte=end, window_end__gte=start,
             requests__windows__start__lte=end, requests__windows__start__gte=start,
-            proposal__active=True).prefetch_related('requests', 'requests__windows', 'requests__target', 'proposal',
-                                                    'proposal__timeallocation_set', 'requests__molecules', 'submitter',
-                                                    'requests__location', 'requests__constraints').distinct()
-
-        # queryset now contains all the schedulable URs and their associated requests and data
-        # Check that each request time available in its proposal still
-        ur_data = []
-        tas = {}
-        for ur in queryset.all():
-            total_duration_dict = ur.total_duration
-            for tak, duration in total_duration_dict.items():
-                if (tak, ur.proposal.id) in tas:
-                    time_allocation = tas[(tak, ur.proposal.id)]
-                else:
-                    time_allocation = TimeAllocation.objects.get(
-                        semester=tak.semester,
-                        instrument_name=tak.instrument_name,
-                        telescope_class=tak.telescope_class,
-                        proposal=ur.proposal.id,
-                    )
-                    tas[(tak, ur.proposal.id)] = time_allocation
-                if ur.observation_type == UserRequest.NORMAL:
-                    time_left = time_allocation.std_allocation - time_allocation.std_time_used
-                else:
-                    time_left = time_allocation.too_allocation - time_allocation.too_time_used
-                if time_left * OVERHEAD_ALLOWANCE >= (duration / 3600.0):
-                    ur_data.append(ur.as_dict)
-                    break
-                else:
-                    logger.warning(
-                        'not enough time left {0} in proposal {1} for ur {2} of duration {3}, skipping'.format(
-                            time_left, ur.proposal.id, ur.id, (duration / 3600.0)
-                        )
-                    )
-
-        return Response(ur_data)
+            proposal__active=True).distinct()
+
+        if request.query_params.get('since'):
+            # only return what changed since the scheduler's last pull, and which user requests left the set
+            try:
+                since = parse(request.query_params['since'])
+            except (ValueError, OverflowError):
+                return Response({'errors': ['since must be a datetime']}, status=400)
+            if timezone.is_naive(since):
+                since = since.replace(tzinfo=timezone.utc)
+            cursor = timezone.now()
+            userrequests, removed = get_schedulable_feed(queryset, since)
+            return Response({'cursor': cursor, 'userrequests': userrequests, 'removed': removed})
+
+        # Only user requests with time left in their proposal's time allocations are returned
+        ur_data = iter_schedulable_userrequests(queryset)
+        if request.query_params.get('stream', '').lower() in ('true', '1'):
+            return StreamingHttpResponse(stream_json_list(ur_data), content_type='application/json')
+        return Response(list(ur_data))
 
     @detail_route(methods=['post'])
     def cancel(self, request, pk=None):
@@ -116,16 +108,10 @@ class UserRequestViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['post'])
     def validate(self, request):
-        serializer = UserRequestSerializer(data=request.data, context={'request': request})
-        req_durations = {}
-        if serializer.is_valid():
-            req_durations = get_request_duration_dict(serializer.validated_data['requests'])
-            errors = {}
-        else:
-            errors = serializer.errors
-
-        return Response({'request_durations': req_durations,
-                         'errors': errors})
+        if is_async_request(request):
+            return async_job_response(submit_job('validate', request.data, request.user))
+        ret_data, status = validate_userrequest(request.data, request)
+        return Response(ret_data, status=status)
 
     @list_route(methods=['post'])
     def max_allowable_ipp(self, request):
@@ -140,27 +126,45 @@ class UserRequestViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['post'])
     def cadence(self, request):
-        expanded_requests = []
-        for req in request.data.get('requests', []):
-            if isinstance(req, dict) and req.get('cadence'):
-                cadence_request_serializer = CadenceRequestSerializer(data=req)
-                if cadence_request_serializer.is_valid():
-                    expanded_requests.extend(expand_cadence_request(cadence_request_serializer.validated_data))
-                else:
-                    return Response(cadence_request_serializer.errors, status=400)
-            else:
-                expanded_requests.append(req)
-
-        # now replace the originally sent requests with the cadence requests and send it back
-        ret_data = request.data.copy()
-        ret_data['requests'] = expanded_requests
-
-        if(len(ret_data['requests']) > 1):
-            ret_data['operator'] = 'MANY'
-        ur_serializer = UserRequestSerializer(data=ret_data, context={'request': request})
-        if not ur_serializer.is_valid():
-            return Response(ur_serializer.errors, status=400)
-        return Response(ret_data)
+        if is_async_request(request):
+            return async_job_response(submit_job('cadence', request.data, request.user))
+        if request.query_params.get('stream', '').lower() in ('true', '1'):
+            requests, errors = validate_cadence_requests(request.data)
+            if errors:
+                return Response(errors, status=400)
+            chunks = iter_validated_cadence_chunks(request.data, requests, request)
+            first_chunk = next(chunks)
+            if first_chunk[2]:
+                return Response(first_chunk[2], status=400)
+            return StreamingHttpResponse(
+                self._stream_cadence(itertools.chain([first_chunk], chunks)), content_type='application/x-ndjson'
+            )
+
+        ret_data, status = expand_cadence_userrequest(request.data, request)
+        return Response(ret_data, status=status)
+
+    def _stream_cadence(self, chunks):
+        ''' Yields a json line for each request as the cadence is expanded, followed by a summary line with the
+            operator to use and the errors of the first chunk of requests that failed validation, if any. The
+            requests of a chunk are only yielded once the chunk is valid.
+        '''
+        request_count = 0
+        operator = None
+        errors = {}
+        for chunk, chunk_operator, errors in chunks:
+            if errors:
+                break
+            operator = chunk_operator
+            for req in chunk:
+                request_count += 1
+                yield json.dumps({'request': req}, cls=JSONEncoder) + '\n'
+
+        summary = {
+            'operator': 'MANY' if request_count > 1 else operator,
+            'request_count': request_count,
+            'errors': errors
+        }
+        yield json.dumps({'summary': summary}, cls=JSONEncoder) + '\n'
 
 
 class RequestViewSet(viewsets.ReadOnlyModelViewSet):
@@ -190,10 +194,12 @@ class RequestViewSet(viewsets.ReadOnlyModelViewSet):
 
     @detail_route()
     def telescope_states(self, request, pk=None):
-        telescope_states = get_telescope_states_for_request(self.get_object())
-        str_telescope_states = {str(k): v for k, v in telescope_states.items()}
+        data = {'request_id': self.get_object().id}
+        if is_async_request(request):
+            return async_job_response(submit_job('telescope_states', data, request.user))
+        str_telescope_states, status = get_telescope_states(data, request)
 
-        return Response(str_telescope_states)
+        return Response(str_telescope_states, status=status)
 
     @detail_route()
     def blocks(self, request, pk=None):